@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+基准测试：共享连接池客户端 vs 每次调用新建 OpenAI 客户端
+
+在本地替身服务器上测量单次调用的平均开销，两种方式的差值
+即为 client 初始化 + 建立连接的成本（真实 HTTPS 端点上还要再加 TLS 握手）。
+"""
+
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from mock_server import start_mock_server
+from llm_client import create_client, get_api_config
+
+
+def run_calls(num_calls, make_client):
+    """
+    连续调用 num_calls 次，返回每次调用的耗时列表（秒）
+    """
+    latencies = []
+    messages = [{"role": "user", "content": "ping"}]
+    for _ in range(num_calls):
+        start = time.perf_counter()
+        client = make_client()
+        client.chat.completions.create(model="mock", messages=messages, max_tokens=10)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    num_calls = int(os.getenv("BENCH_CALLS", "200"))
+
+    server, base_url = start_mock_server()
+    config = get_api_config()
+    config["api_key"] = "mock"
+    config["base_url"] = base_url
+
+    shared_client = create_client(config)
+    # 预热一次，建立 keep-alive 连接
+    run_calls(1, lambda: shared_client)
+
+    fresh = run_calls(num_calls, lambda: create_client(config))
+    shared = run_calls(num_calls, lambda: shared_client)
+
+    shared_client.close()
+    server.shutdown()
+
+    fresh_ms = statistics.mean(fresh) * 1000
+    shared_ms = statistics.mean(shared) * 1000
+
+    print("=" * 60)
+    print(f"Client overhead benchmark ({num_calls} calls against {base_url})")
+    print("=" * 60)
+    print(f"  New client per call : {fresh_ms:8.3f} ms/call (p50 {statistics.median(fresh) * 1000:.3f} ms)")
+    print(f"  Shared pooled client: {shared_ms:8.3f} ms/call (p50 {statistics.median(shared) * 1000:.3f} ms)")
+    print(f"  Saved per call      : {fresh_ms - shared_ms:8.3f} ms ({(fresh_ms - shared_ms) / fresh_ms:.1%})")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
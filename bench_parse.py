@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+基准测试：parse_output 在长回答上的耗时
+
+合成约 8k tokens（约 32k 字符）推理文字 + 30x30 网格的回答，比较
+当前的单遍扫描（template._extract_grid_from_text）与原来的实现
+（非贪婪 DOTALL 正则 + json.loads，失败时逐字符拼接字符串），并检查两者结果一致。
+"chunked" 列为按 16 字符一块逐块喂入 GridScanner（scan_grid，流式场景）的耗时。
+
+用法:
+    python bench_parse.py
+环境变量 BENCH_ROUNDS 控制每个回答的重复次数（默认 20，取最快的一次）。
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from template import parse_output, scan_grid, _extract_grid_from_text
+
+
+def legacy_is_valid_grid(obj):
+    """
+    原来的 _is_valid_grid（二维整数列表），仅用于对比
+    """
+    if not isinstance(obj, list) or len(obj) == 0:
+        return False
+    return all(isinstance(row, list) and len(row) > 0 and all(isinstance(elem, int) for elem in row) for row in obj)
+
+
+def legacy_extract_grid_from_text(text):
+    """
+    原来的 _extract_grid_from_text，仅用于对比
+    """
+    pattern = r'\[\s*\[.*?\]\s*\]'
+    for match in re.findall(pattern, text, re.DOTALL):
+        try:
+            result = json.loads(match)
+            if legacy_is_valid_grid(result):
+                return result
+        except (json.JSONDecodeError, ValueError):
+            continue
+
+    start_idx = text.find('[[')
+    if start_idx != -1:
+        bracket_count = 0
+        result_str = ""
+        for i in range(start_idx, len(text)):
+            char = text[i]
+            result_str += char
+            if char == '[':
+                bracket_count += 1
+            elif char == ']':
+                bracket_count -= 1
+                if bracket_count == 0:
+                    try:
+                        result = json.loads(result_str)
+                        if legacy_is_valid_grid(result):
+                            return result
+                    except (json.JSONDecodeError, ValueError):
+                        pass
+                    break
+    return None
+
+
+def legacy_parse_output(text):
+    text = text.strip()
+    if "OUTPUT:" in text:
+        result = legacy_extract_grid_from_text(text[text.find("OUTPUT:") + len("OUTPUT:"):].strip())
+        if result:
+            return result
+    return legacy_extract_grid_from_text(text) or []
+
+
+def make_replies(rng, reasoning_chars=32000, size=30):
+    """
+    合成几类回答：(名称, 文本)
+    """
+    grid = [[rng.randrange(10) for _ in range(size)] for _ in range(size)]
+    words = ["the", "cell", "row", "column", "color", "object", "moves", "left", "grid", "pattern", "fills", "border"]
+
+    def reasoning(decoys=False):
+        parts = []
+        length = 0
+        while length < reasoning_chars:
+            if decoys and rng.random() < 0.05:
+                # 推理中常见的干扰项：单行列表、坐标、不完整的网格片段
+                part = rng.choice([f"[{rng.randrange(10)}, {rng.randrange(10)}]", f"row [[{rng.randrange(10)}, ...",
+                                   f"[[{rng.randrange(10)}, {rng.randrange(10)}] ->", "positions [(1, 2), (3, 4)]"])
+            else:
+                part = rng.choice(words)
+            parts.append(part)
+            length += len(part) + 1
+        return " ".join(parts)
+
+    grid_text = json.dumps(grid)
+    return grid, [
+        ("OUTPUT tag after reasoning", reasoning() + "\nOUTPUT: " + grid_text),
+        ("grid at end, no tag", reasoning() + "\n" + grid_text),
+        ("decoys + OUTPUT tag", reasoning(decoys=True) + "\nOUTPUT: " + grid_text + "\n" + reasoning(decoys=True)),
+        ("multi-line grid", reasoning() + "\nOUTPUT:\n[" + ",\n ".join(json.dumps(row) for row in grid) + "]"),
+        ("no grid", reasoning(decoys=True)),
+    ]
+
+
+def best_time(fn, text, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    rounds = int(os.getenv("BENCH_ROUNDS", "20"))
+    rng = random.Random(0)
+    grid, replies = make_replies(rng)
+
+    print("=" * 92)
+    print(f"parse_output benchmark: ~{len(replies[0][1]) // 1000}k-char replies, 30x30 grid, best of {rounds}")
+    print("=" * 92)
+    print(f"{'reply':<30}{'legacy (ms)':>13}{'scanner (ms)':>14}{'speedup':>10}{'chunked (ms)':>14}{'same':>8}")
+    for name, text in replies:
+        chunks = [text[i:i + 16] for i in range(0, len(text), 16)]
+        legacy = best_time(legacy_parse_output, text, rounds)
+        current = best_time(parse_output, text, rounds)
+        chunked = best_time(scan_grid, chunks, rounds)
+        same = legacy_parse_output(text) == parse_output(text) == scan_grid(chunks)
+        print(f"{name:<30}{legacy * 1000:>13.3f}{current * 1000:>14.3f}{legacy / current:>9.1f}x"
+              f"{chunked * 1000:>14.3f}{str(same):>8}")
+
+    # 最坏情况：大量未闭合的 "[[" 片段，扫描耗时随回答长度的变化
+    print("-" * 92)
+    print(f"{'unclosed [[ length':<30}{'legacy (ms)':>13}{'scanner (ms)':>14}")
+    for scale in (1, 2, 4):
+        text = "[[1, 2] " * (2000 * scale)
+        legacy = best_time(legacy_extract_grid_from_text, text, max(1, rounds // 4))
+        current = best_time(_extract_grid_from_text, text, max(1, rounds // 4))
+        print(f"{len(text):<30}{legacy * 1000:>13.3f}{current * 1000:>14.3f}")
+    print("=" * 92)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+端到端基准测试：按提示词版本 (V1-V5) 跑完整评测流程
+
+后端可选：
+- mock: 本地替身服务器（ground_truth 模式，按 --accuracy 给出正确答案，延迟按 --latency 分布）
+- replay: 回放已录制的回答缓存（--cache，RESPONSE_CACHE_MODE=replay），不发出任何网络请求
+
+对每个 (数据集, 版本) 组合报告：
+- 吞吐量 (tasks/s)、任务耗时 p50/p95/p99
+- 每个任务的 API 调用数、缓存命中数、tokens（以及命中服务端 prompt 缓存的比例）
+- prompt 构造 / 解析 / 代码执行的本地耗时
+结果写入 JSON 文件（默认 bench_results.json），便于在不同提交之间对比。
+
+用法:
+    python bench_pipeline.py --versions 1,3,5 --limit 20 --concurrency 8
+    python bench_pipeline.py --backend replay --cache responses.sqlite
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from mock_server import start_mock_server
+from grid import grids_equal
+from grid_codec import get_grid_encoding
+from prompt import V5_MODES, get_prompt_layout, get_prompt_token_budget, get_v5_mode
+from template import VOTING_POLICIES, get_voting_policy
+from sandbox import get_sandbox_pool
+
+
+def percentile(values, q):
+    """
+    返回第 q 百分位（最近秩法），values 为空时返回 None
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def git_commit():
+    """
+    当前提交的哈希，不在 git 仓库中时返回 None
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(results, wall_time):
+    """
+    汇总一次运行（一个数据集 + 一个版本）的结果
+
+    参数:
+    results: process_task 返回的结果列表
+    wall_time: 整次运行的墙钟时间（秒）
+
+    返回:
+    dict: 可 JSON 序列化的统计
+    """
+    num_tasks = len(results)
+    task_times = [r["task_time"] for r in results]
+    metrics = [r["metrics"] for r in results]
+    correct = sum(grids_equal(r["predicted_grid"], r["ground_truth"]) for r in results)
+
+    stages = sorted({stage for m in metrics for stage in m["stage_times"]})
+    stage_totals = {stage: sum(m["stage_times"].get(stage, 0.0) for m in metrics) for stage in stages}
+
+    def per_task(key):
+        return sum(m[key] for m in metrics) / num_tasks if num_tasks else 0.0
+
+    return {
+        "tasks": num_tasks,
+        "correct": correct,
+        "accuracy": correct / num_tasks if num_tasks else 0.0,
+        "wall_time": wall_time,
+        "throughput": num_tasks / wall_time if wall_time > 0 else None,
+        "latency": {
+            "mean": sum(task_times) / num_tasks if num_tasks else None,
+            "p50": percentile(task_times, 50),
+            "p95": percentile(task_times, 95),
+            "p99": percentile(task_times, 99),
+            "max": max(task_times) if task_times else None,
+        },
+        "per_task": {
+            "api_calls": per_task("api_calls"),
+            "cache_hits": per_task("cache_hits"),
+            "api_time": per_task("api_time"),
+            "prompt_tokens": per_task("prompt_tokens"),
+            "cached_tokens": per_task("cached_tokens"),
+            "completion_tokens": per_task("completion_tokens"),
+        },
+        "stage_time_total": stage_totals,
+        "stage_time_per_task": {stage: total / num_tasks for stage, total in stage_totals.items()},
+    }
+
+
+def run_benchmark(data_path, data, prompt_version, args):
+    """
+    用 test_prompt 的评测流程跑一个 (数据集, 版本) 组合，返回 summarize 的结果
+    """
+    from test_prompt import process_task, run_tasks_async
+
+    config = {
+        "model_name": args.model,
+        "temperature": 1.0,
+        "prompt_version": prompt_version,
+        "num_samples_v3": args.num_samples_v3,
+        "v3_early_stop": args.v3_early_stop,
+        "v3_min_samples": None,
+        "v3_confidence_threshold": None,
+        "task_deadline": 0,
+        "v5_mode": args.v5_mode,
+        "voting_policy": args.voting_policy,
+        "v4_repair": not args.no_v4_repair,
+        "num_programs_v4": args.num_programs_v4,
+    }
+    pending = list(enumerate(data))
+    silent = lambda msg="": None
+
+    start = time.perf_counter()
+    if args.concurrency > 1:
+        # run_tasks_async 会打印每个任务的缓冲日志，这里临时屏蔽标准输出
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            results = asyncio.run(run_tasks_async(pending, len(data), config, args.concurrency))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        results = [results[idx] for idx in range(len(data))]
+    else:
+        results = [process_task(idx, len(data), task, config, log=silent) for idx, task in pending]
+    wall_time = time.perf_counter() - start
+
+    summary = summarize(results, wall_time)
+    summary.update(data_path=data_path, prompt_version=prompt_version)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the evaluation pipeline per prompt version")
+    parser.add_argument("--versions", default="1,2,3,4,5", help="comma-separated prompt versions (default: 1,2,3,4,5)")
+    parser.add_argument("--data", default="val.jsonl,val_hard.jsonl", help="comma-separated dataset files")
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N tasks of each dataset (0 = all)")
+    parser.add_argument("--concurrency", type=int, default=1, help="tasks in flight (default: 1)")
+    parser.add_argument("--backend", choices=("mock", "replay"), default="mock",
+                        help="mock server or replay of a recorded response cache (default: mock)")
+    parser.add_argument("--cache", default="", help="response cache file for --backend replay")
+    parser.add_argument("--latency", default="0.02", help="mock latency spec, e.g. 0.05 or lognormal:0.5,0.6")
+    parser.add_argument("--accuracy", type=float, default=1.0, help="probability the mock answers correctly")
+    parser.add_argument("--reasoning-chars", type=int, default=200, help="mock reasoning text before the answer")
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "nex-n1"), help="model name sent to the backend")
+    parser.add_argument("--num-samples-v3", type=int, default=int(os.getenv("NUM_SAMPLES_V3", "5")))
+    parser.add_argument("--v3-early-stop", action="store_true", help="use adaptive V3 voting")
+    parser.add_argument("--voting-policy", choices=VOTING_POLICIES, default=get_voting_policy(),
+                        help="V3 voting: whole-grid match (exact) or per-cell majority (cell) (default: VOTING_POLICY or exact)")
+    parser.add_argument("--num-programs-v4", type=int, default=int(os.getenv("NUM_PROGRAMS_V4", "1")),
+                        help="V4 candidate programs per task (best-of-k when > 1)")
+    parser.add_argument("--no-v4-repair", action="store_true",
+                        help="V4: do not re-prompt when the program fails the training examples")
+    parser.add_argument("--v5-mode", choices=V5_MODES, default=get_v5_mode(),
+                        help="V5 as independent requests (chain) or one conversation (default: V5_MODE or chain)")
+    parser.add_argument("--prefill-latency", type=float, default=0.0,
+                        help="mock: extra seconds per 1000 prompt tokens not served from the prefix cache")
+    parser.add_argument("--output", default="bench_results.json", help="output file (default: bench_results.json)")
+    args = parser.parse_args()
+
+    versions = [int(v) for v in args.versions.split(",") if v.strip()]
+    data_paths = [p.strip() for p in args.data.split(",") if p.strip()]
+
+    # 后端配置必须在第一次创建客户端 / 缓存之前写入环境变量
+    server = None
+    if args.backend == "mock":
+        server, base_url = start_mock_server(latency=args.latency, answers="ground_truth", data_paths=data_paths,
+                                             accuracy=args.accuracy, reasoning_chars=args.reasoning_chars,
+                                             prefill_latency=args.prefill_latency)
+        os.environ["DEEPSEEK_BASE_URL"] = base_url
+        os.environ["DEEPSEEK_API_KEY"] = "mock"
+        os.environ["RESPONSE_CACHE_PATH"] = ""
+    else:
+        if not args.cache or not os.path.exists(args.cache):
+            parser.error("--backend replay needs an existing --cache file")
+        os.environ["RESPONSE_CACHE_PATH"] = args.cache
+        os.environ["RESPONSE_CACHE_MODE"] = "replay"
+        os.environ.setdefault("DEEPSEEK_API_KEY", "replay")
+    os.environ.setdefault("API_MAX_CONNECTIONS", str(max(32, args.concurrency * 2)))
+
+    from test_prompt import load_jsonl
+
+    # V4 的沙箱进程池在计时之前创建，启动开销不计入第一个任务
+    if 4 in versions:
+        get_sandbox_pool()
+
+    runs = []
+    print("=" * 78)
+    print(f"Pipeline benchmark ({args.backend} backend, concurrency {args.concurrency})")
+    print("=" * 78)
+    print(f"{'data':<16}{'ver':>4}{'tasks':>7}{'acc':>8}{'tasks/s':>9}{'p50':>8}{'p95':>8}{'p99':>8}"
+          f"{'calls':>7}{'tokens':>9}{'cached':>8}")
+    for data_path in data_paths:
+        data = load_jsonl(data_path)
+        if args.limit:
+            data = data[:args.limit]
+        for version in versions:
+            run = run_benchmark(data_path, data, version, args)
+            runs.append(run)
+            per_task = run["per_task"]
+            print(f"{data_path:<16}{version:>4}{run['tasks']:>7}{run['accuracy']:>8.1%}"
+                  f"{run['throughput']:>9.2f}{run['latency']['p50']:>8.3f}{run['latency']['p95']:>8.3f}"
+                  f"{run['latency']['p99']:>8.3f}{per_task['api_calls'] + per_task['cache_hits']:>7.1f}"
+                  f"{per_task['prompt_tokens'] + per_task['completion_tokens']:>9.0f}"
+                  f"{per_task['cached_tokens'] / per_task['prompt_tokens'] if per_task['prompt_tokens'] else 0:>8.1%}")
+            stages = ", ".join(f"{stage} {seconds * 1000:.2f} ms" for stage, seconds in run["stage_time_per_task"].items())
+            print(f"{'':<20}per task: {stages}")
+    print("=" * 78)
+
+    if server is not None:
+        server.shutdown()
+
+    report = {
+        "meta": {
+            "git_commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "backend": args.backend,
+            "grid_encoding": get_grid_encoding(),
+            "prompt_layout": get_prompt_layout(),
+            "prompt_token_budget": get_prompt_token_budget(),
+            "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        },
+        "runs": runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+基准测试：提示词构造的 CPU 耗时
+
+对数据集中的每个任务，构造一次评测会用到的全部提示词
+（V1-V4 各一次，V5 的假设 / 验证 / 预测三个阶段），比较两种方式：
+- 每次从任务字典构造：每个提示词都重新序列化全部网格
+- 先 prepare_task 一次：网格与形状只计算一次，各提示词复用
+
+用法:
+    python bench_prompt_build.py [val_hard.jsonl]
+环境变量 BENCH_ROUNDS 控制重复轮数（默认 5，取最快的一轮），
+GRID_ENCODING / PROMPT_LAYOUT 与评测时相同。
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from grid_codec import get_grid_encoding
+from prompt import (prepare_task, construct_prompt, get_prompt_layout, prompt_v5_chain1_hypothesis,
+                    prompt_v5_reflexion_verify, prompt_v5_chain2_predict)
+
+
+HYPOTHESIS = "Recolor every object according to its size."
+
+
+def build_all(d):
+    """
+    构造一个任务评测时用到的全部提示词，返回总字符数
+    """
+    chars = 0
+    prompts = [construct_prompt(d, version) for version in (1, 2, 3, 4)]
+    prompts.append(prompt_v5_chain1_hypothesis(d))
+    prompts.append(prompt_v5_reflexion_verify(d, HYPOTHESIS))
+    prompts.append(prompt_v5_chain2_predict(d, HYPOTHESIS))
+    for messages in prompts:
+        chars += sum(len(m["content"]) for m in messages)
+    return chars
+
+
+def time_rounds(fn, rounds):
+    """
+    重复 rounds 轮，返回最快一轮的秒数
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "val_hard.jsonl"
+    rounds = int(os.getenv("BENCH_ROUNDS", "5"))
+    with open(path, 'r') as f:
+        tasks = [json.loads(line) for line in f if line.strip()]
+
+    chars = sum(build_all(task) for task in tasks)
+    from_dict = time_rounds(lambda: [build_all(task) for task in tasks], rounds)
+    prepared = time_rounds(lambda: [build_all(prepare_task(task)) for task in tasks], rounds)
+    prepare_only = time_rounds(lambda: [prepare_task(task) for task in tasks], rounds)
+
+    per_task = lambda seconds: seconds / len(tasks) * 1000
+
+    print("=" * 70)
+    print(f"Prompt construction benchmark: {path} ({len(tasks)} tasks, best of {rounds} rounds)")
+    print(f"Encoding: {get_grid_encoding()}, layout: {get_prompt_layout()}, "
+          f"7 prompts per task, {chars / len(tasks) / 1000:.1f}k chars per task")
+    print("=" * 70)
+    print(f"  From task dict (re-serialize per prompt): {per_task(from_dict):8.3f} ms/task")
+    print(f"  prepare_task once, then build           : {per_task(prepared):8.3f} ms/task")
+    print(f"    of which prepare_task                 : {per_task(prepare_only):8.3f} ms/task")
+    print(f"  Speedup                                 : {from_dict / prepared:8.2f}x")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+基准测试：V5 的 chain 模式与 conversation 模式对比
+
+两种模式在两种提示词布局（legacy / shared）下各跑一遍 V5 评测（本地替身服务器，
+模拟服务端 prompt 前缀缓存，未命中缓存的 prompt tokens 按 --prefill-latency 增加延迟），
+并排报告每个任务的：
+- prompt tokens、命中前缀缓存的 tokens、需要 prefill 的（未命中）tokens
+- 任务耗时 p50/p95、API 耗时、准确率
+变化均相对于 legacy/chain（最初的 V5 流程）。
+
+用法:
+    python bench_v5_modes.py --data val_hard.jsonl --limit 20
+"""
+
+import os
+import sys
+import argparse
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from mock_server import PrefixCache, start_mock_server
+from prompt import PROMPT_LAYOUTS, V5_MODES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare V5 chain and conversation modes on the mock backend")
+    parser.add_argument("--data", default="val_hard.jsonl", help="dataset file (default: val_hard.jsonl)")
+    parser.add_argument("--limit", type=int, default=20, help="only use the first N tasks (0 = all)")
+    parser.add_argument("--concurrency", type=int, default=4, help="tasks in flight (default: 4)")
+    parser.add_argument("--latency", default="0.02", help="mock base latency spec")
+    parser.add_argument("--prefill-latency", type=float, default=0.05,
+                        help="extra seconds per 1000 uncached prompt tokens (default: 0.05)")
+    parser.add_argument("--reasoning-chars", type=int, default=600, help="mock reasoning text per reply")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(latency=args.latency, answers="ground_truth", data_paths=[args.data],
+                                         reasoning_chars=args.reasoning_chars, prefill_latency=args.prefill_latency)
+    os.environ["DEEPSEEK_BASE_URL"] = base_url
+    os.environ["DEEPSEEK_API_KEY"] = "mock"
+    os.environ["RESPONSE_CACHE_PATH"] = ""
+
+    from test_prompt import load_jsonl
+    from bench_pipeline import run_benchmark
+
+    data = load_jsonl(args.data)
+    if args.limit:
+        data = data[:args.limit]
+
+    runs = {}
+    for layout in reversed(PROMPT_LAYOUTS):
+        os.environ["PROMPT_LAYOUT"] = layout
+        for mode in V5_MODES:
+            run_args = SimpleNamespace(model="mock", num_samples_v3=1, v3_early_stop=False,
+                                       concurrency=args.concurrency, v5_mode=mode,
+                                       voting_policy="exact", no_v4_repair=False,
+                                       num_programs_v4=1)
+            # 每种组合各自从空缓存开始
+            server.prefix_cache = PrefixCache()
+            runs[f"{layout}/{mode}"] = run_benchmark(args.data, data, 5, run_args)
+    server.shutdown()
+
+    rows = [
+        ("prompt tokens / task", lambda r: r["per_task"]["prompt_tokens"], "{:.0f}"),
+        ("cached tokens / task", lambda r: r["per_task"]["cached_tokens"], "{:.0f}"),
+        ("uncached tokens / task", lambda r: r["per_task"]["prompt_tokens"] - r["per_task"]["cached_tokens"], "{:.0f}"),
+        ("completion tokens / task", lambda r: r["per_task"]["completion_tokens"], "{:.0f}"),
+        ("API time / task (s)", lambda r: r["per_task"]["api_time"], "{:.3f}"),
+        ("task time p50 (s)", lambda r: r["latency"]["p50"], "{:.3f}"),
+        ("task time p95 (s)", lambda r: r["latency"]["p95"], "{:.3f}"),
+        ("accuracy", lambda r: r["accuracy"], "{:.1%}"),
+    ]
+    baseline = runs["legacy/chain"]
+
+    print("=" * 114)
+    print(f"V5 chain vs conversation: {args.data} ({len(data)} tasks, prefill {args.prefill_latency}s / 1k uncached tokens)")
+    print("=" * 114)
+    print(f"{'':<26}" + "".join(f"{name:>22}" for name in runs))
+    for name, value, fmt in rows:
+        cells = []
+        for run in runs.values():
+            cell = fmt.format(value(run))
+            if run is not baseline and value(baseline) and name != "accuracy":
+                cell += f" ({value(run) / value(baseline) - 1:+.0%})"
+            cells.append(f"{cell:>22}")
+        print(f"{name:<26}" + "".join(cells))
+    print("=" * 114)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+"""
+call_policy.py - 模型调用策略层
+
+包在每次 API 请求外面，负责：
+- 令牌桶限流：每分钟请求数 (RPM) 与每分钟 tokens 数 (TPM)
+- 可重试错误（429 / 5xx / 超时 / 连接错误）的指数退避重试（带随机抖动）
+- 单个任务的截止时间（deadline）：作为整次请求的总时限，到期时调用方立即得到 DeadlineExceeded
+  并取消请求，不再重试；httpx 的超时只针对单次连接 / 读写，缓慢的流式回答可以远远超过它
+- 对冲请求：调用耗时超过近期 p95 时再发一个相同请求，取先返回的结果
+"""
+
+import os
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+import openai
+
+
+class DeadlineExceeded(Exception):
+    """
+    当前任务的截止时间已到
+    """
+    pass
+
+
+# ============================================================================
+# 限流
+# ============================================================================
+
+class TokenBucket:
+    """
+    令牌桶：以 rate_per_minute 的速度补充令牌，最多积攒 capacity 个
+
+    参数:
+    rate_per_minute: 每分钟补充的令牌数，<= 0 表示不限流
+    capacity: 桶容量（允许的突发量），默认等于每分钟速率
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """
+        取出 amount 个令牌，不足时阻塞等待；返回等待的秒数
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        # 单次请求超过桶容量时按容量计，避免永远等不到
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                sleep_time = (amount - self.tokens) / self.rate
+            time.sleep(sleep_time)
+            waited += sleep_time
+
+
+class RateLimiter:
+    """
+    同时限制每分钟请求数和每分钟 tokens 数
+
+    参数:
+    requests_per_minute: RPM 上限，<= 0 表示不限
+    tokens_per_minute: TPM 上限，<= 0 表示不限
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, estimated_tokens=0):
+        """
+        为一次请求获取配额，返回等待的总秒数
+        """
+        return self.requests.acquire(1) + self.tokens.acquire(estimated_tokens)
+
+
+def estimate_tokens(messages, max_tokens=0):
+    """
+    粗略估计一次请求消耗的 tokens（输入按 4 字符 / token 估计，再加上最大输出）
+    """
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return prompt_chars // 4 + max_tokens
+
+
+# ============================================================================
+# 截止时间
+# ============================================================================
+
+_deadline = contextvars.ContextVar("task_deadline", default=None)
+
+
+@contextmanager
+def task_deadline(seconds):
+    """
+    为当前任务设置截止时间（秒），None 或 <= 0 表示不限制
+
+    截止时间保存在 contextvars 中，因此同一任务内的所有调用
+    （包括通过 submit_with_context 提交到线程池的调用）都会遵守它。
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    """
+    返回当前任务剩余的秒数，没有截止时间时返回 None
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+_cancel_event = contextvars.ContextVar("request_cancel_event", default=None)
+
+
+def request_cancelled():
+    """
+    在请求函数 fn(timeout) 中调用：调用方已经放弃这次请求（截止时间已到，或对冲的另一个请求已先返回）时
+    返回 True。流式请求在收到每个分块后检查，返回 True 时关闭连接，服务端随之停止生成
+    """
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """
+    向线程池提交任务，并携带当前的 contextvars（截止时间等）
+    """
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, fn, *args, **kwargs)
+
+
+# ============================================================================
+# 重试与对冲
+# ============================================================================
+
+def is_retryable(exc):
+    """
+    判断异常是否值得重试：限流、服务端错误、超时、连接错误
+    """
+    if isinstance(exc, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                        openai.InternalServerError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    if isinstance(exc, (httpx.TimeoutException, httpx.TransportError)):
+        return True
+    return False
+
+
+def _retry_after(exc):
+    """
+    读取响应头中的 Retry-After（秒），没有则返回 None
+    """
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LatencyTracker:
+    """
+    记录最近 window 次调用的耗时，用于计算对冲阈值 (p95)
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies = []
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            if len(self._latencies) > self.window:
+                del self._latencies[0]
+
+    def percentile(self, q):
+        """
+        返回第 q 百分位的耗时，样本不足 min_samples 时返回 None
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class CallPolicy:
+    """
+    调用策略：限流 + 重试 + 截止时间 + 对冲
+
+    参数:
+    limiter: RateLimiter 实例，None 表示不限流
+    max_retries: 可重试错误的最大重试次数
+    base_delay: 第一次重试的退避上限（秒），之后每次翻倍
+    max_delay: 单次退避的最大秒数
+    hedge: 是否启用对冲请求
+    tracker: LatencyTracker 实例，用于计算 p95
+    """
+
+    def __init__(self, limiter=None, max_retries=3, base_delay=1.0, max_delay=30.0, hedge=False, tracker=None):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        # 有截止时间或启用对冲时，请求在这里的线程中执行，调用方只等待到截止时间
+        self._executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="call")
+
+    def call(self, fn, estimated_tokens=0, stats=None):
+        """
+        按策略执行一次调用
+
+        参数:
+        fn: 可调用对象 fn(timeout)，timeout 为本次请求允许的秒数（None 表示使用客户端默认值）
+        estimated_tokens: 本次请求预计消耗的 tokens（用于 TPM 限流）
+        stats: 可选字典，返回时写入 "retries" / "hedged" / "rate_limit_wait"
+
+        返回:
+        fn 的返回值；不可重试的错误、重试用尽或截止时间已到时抛出异常
+        """
+        if stats is None:
+            stats = {}
+        stats.setdefault("retries", 0)
+        stats.setdefault("hedged", False)
+        stats.setdefault("rate_limit_wait", 0.0)
+
+        attempt = 0
+        while True:
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded("Task deadline exceeded before the request was sent")
+
+            if self.limiter is not None:
+                stats["rate_limit_wait"] += self.limiter.acquire(estimated_tokens)
+
+            try:
+                return self._call_once(fn, stats)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+                # 带随机抖动的指数退避（full jitter），服务端给出 Retry-After 时优先使用
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = min(self.max_delay, retry_after)
+
+                remaining = remaining_time()
+                if remaining is not None and remaining <= delay:
+                    raise DeadlineExceeded(f"Task deadline exceeded while retrying: {str(e)}") from e
+
+                time.sleep(delay)
+                attempt += 1
+                stats["retries"] = attempt
+
+    def _request_timeout(self):
+        remaining = remaining_time()
+        return max(0.001, remaining) if remaining is not None else None
+
+    def _submit(self, fn, cancel):
+        """
+        在线程池中执行 fn(timeout)，携带当前的 contextvars，并让 fn 能通过 request_cancelled() 看到 cancel
+        """
+        ctx = contextvars.copy_context()
+        ctx.run(_cancel_event.set, cancel)
+        return self._executor.submit(ctx.run, fn, self._request_timeout())
+
+    def _wait(self, futures, timeout=None):
+        """
+        等待 futures 中任意一个完成，最多等待 timeout 秒（None 表示不限），且不超过当前任务的截止时间
+
+        异常:
+        DeadlineExceeded: 截止时间已到，仍没有请求完成
+        """
+        remaining = remaining_time()
+        until_deadline = remaining is not None and (timeout is None or remaining <= timeout)
+        if until_deadline:
+            timeout = max(0.0, remaining)
+        done, pending = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done and until_deadline:
+            raise DeadlineExceeded("Task deadline exceeded while waiting for the response")
+        return done, pending
+
+    def _call_once(self, fn, stats):
+        """
+        执行一次请求；启用对冲且耗时超过 p95 时再发一个相同请求，取先成功的结果。
+        有截止时间时最多等到截止时间，之后抛出 DeadlineExceeded 并取消仍在进行的请求
+        """
+        threshold = self.tracker.percentile(95) if self.hedge else None
+        start = time.monotonic()
+
+        if threshold is None and remaining_time() is None:
+            result = fn(self._request_timeout())
+            self.tracker.record(time.monotonic() - start)
+            return result
+
+        cancel = threading.Event()
+        try:
+            primary = self._submit(fn, cancel)
+            done, pending = self._wait({primary}, timeout=threshold)
+            if not done:
+                # 主请求超过 p95 仍未返回：发出对冲请求
+                stats["hedged"] = True
+                pending = {primary, self._submit(fn, cancel)}
+            error = None
+            while True:
+                for future in done:
+                    if future.exception() is None:
+                        self.tracker.record(time.monotonic() - start)
+                        return future.result()
+                    error = future.exception()
+                if not pending:
+                    raise error
+                done, pending = self._wait(pending)
+        finally:
+            # 落后的对冲请求、超过截止时间的请求：流式请求在下一个分块时关闭连接，
+            # 非流式请求无法中断，最迟在 httpx 超时（不超过发出时剩余的时间）后结束
+            cancel.set()
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_call_policy():
+    """
+    按环境变量获取共享的调用策略
+
+    环境变量:
+    API_RPM / API_TPM: 每分钟请求数 / tokens 数上限，0（默认）表示不限
+    API_MAX_RETRIES: 最大重试次数，默认 3
+    API_RETRY_BASE_DELAY / API_RETRY_MAX_DELAY: 退避的初始上限与最大值（秒），默认 1 / 30
+    API_HEDGE: 是否启用对冲请求（0/1），默认 0
+    """
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                limiter = RateLimiter(
+                    requests_per_minute=float(os.getenv("API_RPM", "0")),
+                    tokens_per_minute=float(os.getenv("API_TPM", "0")),
+                )
+                _policy = CallPolicy(
+                    limiter=limiter,
+                    max_retries=int(os.getenv("API_MAX_RETRIES", "3")),
+                    base_delay=float(os.getenv("API_RETRY_BASE_DELAY", "1.0")),
+                    max_delay=float(os.getenv("API_RETRY_MAX_DELAY", "30")),
+                    hedge=os.getenv("API_HEDGE", "0") == "1",
+                )
+    return _policy
@@ -20,6 +20,35 @@ configs = {
     "FAST_MODE": ("0", "快速模式（0=关闭, 1=开启）"),
     "PROMPT_VERSION": ("1", "提示词版本（1-5）"),
     "NUM_SAMPLES_V3": ("5", "V3 采样次数"),
+    "EVAL_CONCURRENCY": ("1", "并发任务数（1=顺序执行）"),
+    "API_MAX_CONNECTIONS": ("32", "连接池最大连接数"),
+    "API_HTTP2": ("0", "HTTP/2（0=关闭, 1=开启，需要 h2）"),
+    "API_SUPPORTS_N": ("auto", "V3 是否用 n 参数一次请求多个采样（auto/1/0）"),
+    "V3_EARLY_STOP": ("0", "V3 自适应投票，结果确定后提前停止（0/1）"),
+    "NUM_PROGRAMS_V4": ("1", "V4 候选程序数（>1 时并发采样，取第一个通过训练样本的程序）"),
+    "V4_REPAIR": ("1", "V4 代码未通过训练样本时带差异说明请求一次修正（0/1）"),
+    "VOTING_POLICY": ("exact", "V3 投票规则（exact=整格匹配，cell=逐格多数表决）"),
+    "API_RPM": ("0", "每分钟请求数上限（0=不限）"),
+    "API_TPM": ("0", "每分钟 tokens 上限（0=不限）"),
+    "API_MAX_RETRIES": ("3", "429/5xx/超时的最大重试次数"),
+    "TASK_DEADLINE_SECONDS": ("0", "单个任务的截止时间（秒，0=不限）"),
+    "API_HEDGE": ("0", "超过 p95 耗时时发送对冲请求（0/1）"),
+    "API_STREAM": ("0", "流式输出，OUTPUT 网格完整后提前取消（0/1）"),
+    "RESPONSE_CACHE_PATH": ("", "回答缓存 SQLite 路径（为空则不启用）"),
+    "RESPONSE_CACHE_MODE": ("readwrite", "缓存模式（readwrite/replay）"),
+    "PROMPT_LAYOUT": ("shared", "提示词布局（shared=共享前缀便于 prompt 缓存，legacy=原提示词）"),
+    "PROMPT_TOKEN_BUDGET": ("0", "提示词 tokens 预算，超出时丢弃部分训练样本（0=不限）"),
+    "MODEL_CONTEXT_TOKENS": ("0", "模型上下文长度，预算不超过它减去 API_MAX_TOKENS（0=不检查）"),
+    "V5_MODE": ("chain", "V5 的三个阶段：chain=独立请求，conversation=同一段对话"),
+    "GRID_ENCODING": ("json", "提示词中的网格格式（json/rows/rle/sparse）"),
+    "SANDBOX_WORKERS": ("4", "V4 代码执行的工作进程数（0=在评测进程内执行，默认 min(4, CPU 数)）"),
+    "SANDBOX_TIMEOUT_SECONDS": ("5", "V4 代码单次执行的超时（秒）"),
+    "CODE_CACHE_SIZE": ("256", "每个进程缓存的已编译 transform 代码数（0=不缓存）"),
+    "RESULT_CACHE_SIZE": ("4096", "(代码, 输入网格) -> 输出 的内存缓存条数（0=不缓存）"),
+    "RESULT_CACHE_PATH": ("", "执行结果 SQLite 路径（未设置时放在回答缓存旁边）"),
+    "SANDBOX_MEMORY_MB": ("512", "V4 代码执行进程可额外使用的内存（MB，0=不限）"),
+    "CALL_METRICS_LOG": ("call_metrics.jsonl", "逐次调用记录 JSONL（为空则不写）"),
+    "METRICS_PROM_PATH": ("metrics.prom", "Prometheus 文本快照（为空则不写）"),
 }
 
 print("\n当前配置:")
@@ -39,6 +68,8 @@ try:
     prompt_version = int(config_dict["PROMPT_VERSION"])
     fast_mode = int(config_dict["FAST_MODE"])
     num_samples = int(config_dict["NUM_SAMPLES_V3"])
+    num_programs = int(config_dict["NUM_PROGRAMS_V4"])
+    concurrency = max(1, int(config_dict["EVAL_CONCURRENCY"]))
     
     task_count = 5 if fast_mode else 30
     
@@ -46,8 +77,8 @@ try:
     api_calls_per_task = {
         1: 1,   # V1: 简单
         2: 1,   # V2: CoT
-        3: num_samples,  # V3: 多采样
-        4: 1,   # V4: 代码生成
+        3: num_samples,  # V3: 多采样（支持 n 参数时为 1 次请求，否则并发发送）
+        4: num_programs,  # V4: 代码生成（候选程序数，支持 n 参数时为 1 次请求）
         5: 3,   # V5: 链式推理
     }
     
@@ -57,8 +88,9 @@ try:
     # 时间预估（每个 API 调用约 3-5 秒）
     time_per_call_min = 3
     time_per_call_max = 5
-    total_time_min = total_calls * time_per_call_min
-    total_time_max = total_calls * time_per_call_max
+    # 并发模式下墙钟时间约按并发数等比缩短
+    total_time_min = total_calls * time_per_call_min // concurrency
+    total_time_max = total_calls * time_per_call_max // concurrency
     
     version_names = {1: "简单", 2: "CoT", 3: "自洽投票", 4: "代码生成", 5: "链式推理"}
     version_name = version_names.get(prompt_version, "未知")
@@ -67,6 +99,7 @@ try:
     print(f"  任务数: {task_count}")
     print(f"  每任务 API 调用: {calls_per_task}")
     print(f"  总 API 调用: {total_calls}")
+    print(f"  并发任务数: {concurrency}")
     print(f"  预估耗时: {total_time_min//60}m{total_time_min%60}s - {total_time_max//60}m{total_time_max%60}s")
     
     if total_calls >= 150:
@@ -93,6 +126,12 @@ try:
 except ImportError:
     print("✗ httpx 库未安装: pip install httpx")
 
+try:
+    import h2
+    print("✓ h2 库已安装（可使用 API_HTTP2=1）")
+except ImportError:
+    print("○ h2 库未安装（可选，HTTP/2 需要: pip install httpx[http2]）")
+
 try:
     import dotenv
     print("✓ python-dotenv 库已安装")
@@ -107,4 +146,11 @@ print("\n2. 标准运行（所有 30 个任务）:")
 print("   python test_prompt.py")
 print("\n3. 自定义配置:")
 print("   API_TIMEOUT_SECONDS=30 API_MAX_TOKENS=500 python test_prompt.py")
+print("\n4. 并发评测（同时处理 8 个任务）:")
+print("   EVAL_CONCURRENCY=8 python test_prompt.py")
+print("\n5. 缓存回答，修改解析代码后离线重跑:")
+print("   RESPONSE_CACHE_PATH=.response_cache.sqlite python test_prompt.py")
+print("   RESPONSE_CACHE_PATH=.response_cache.sqlite RESPONSE_CACHE_MODE=replay python test_prompt.py")
+print("\n6. 中断后从结果日志断点续跑:")
+print("   python test_prompt.py --resume")
 print("=" * 60)
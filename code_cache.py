@@ -0,0 +1,331 @@
+"""
+code_cache.py - 生成代码的编译缓存与执行结果缓存
+
+同一段（或只有注释、格式不同的）transform 代码会在重跑、多次采样和修复之间反复出现。
+这里按规范化源码的哈希（code_fingerprint）缓存：
+- 已编译的代码对象：每个进程（评测进程或沙箱工作进程）各自一份，省去重复的 compile
+- 执行结果：(代码哈希, 输入网格哈希) -> transform 的输出（或代码抛出的异常信息），
+  命中时不再发给沙箱执行；超时、工作进程崩溃等整批失败，以及 MemoryError / RecursionError
+  这类与工作进程当时状态有关的错误不缓存（见 sandbox.TRANSIENT_ERRORS）
+
+两个内存缓存都是有上限的 LRU，超出时淘汰最久未使用的条目。
+执行成功的结果还会写入 SQLite（ResultStore），内存 LRU 作为前一层：重新评分一份已记录的评测
+（例如用回答缓存回放）总是在新进程中进行，此时直接从文件读出上次的执行结果，不再发给沙箱。
+代码抛出的异常只缓存在内存中：它们可能取决于沙箱的限制（例如被禁止的 import），限制改变后应重新执行。
+
+环境变量:
+CODE_CACHE_SIZE: 每个进程缓存的已编译代码数，默认 256，0 表示不缓存
+RESULT_CACHE_SIZE: 内存中缓存的执行结果条数，默认 4096，0 表示不缓存
+RESULT_CACHE_PATH: 执行结果的 SQLite 文件路径；未设置时放在回答缓存旁边
+                   （RESPONSE_CACHE_PATH 为 .response_cache.sqlite 时为 .response_cache.results.sqlite），
+                   两者都为空时不写入磁盘
+"""
+
+import os
+import json
+import types
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存
+
+    参数:
+    max_entries (int): 最多保存的条目数，0 表示不缓存
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        返回 key 对应的值，没有时返回 None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        返回统计信息：hits / misses / hit_rate / entries
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+def _digest_code_object(code_object, digest):
+    # 不含行号表和文件名：注释、空行只改变行号，不改变字节码
+    digest.update(code_object.co_code)
+    digest.update(repr((code_object.co_name, code_object.co_names, code_object.co_varnames, code_object.co_freevars,
+                        code_object.co_cellvars, code_object.co_argcount, code_object.co_kwonlyargcount,
+                        code_object.co_flags)).encode("utf-8"))
+    for const in code_object.co_consts:
+        if isinstance(const, types.CodeType):
+            _digest_code_object(const, digest)
+        else:
+            digest.update(repr(const).encode("utf-8"))
+
+
+def code_fingerprint(code):
+    """
+    规范化源码的哈希：按编译后的字节码、常量和名字计算，注释、空行、行内空白和引号等
+    不改变字节码的差异不影响结果；有语法错误时按去掉空行和行尾空白的源码计算
+
+    参数:
+    code (str): Python 代码
+
+    返回:
+    str: 十六进制哈希
+    """
+    digest = hashlib.sha256()
+    try:
+        _digest_code_object(compile(code, "<transform>", "exec"), digest)
+    except (SyntaxError, ValueError):
+        digest.update("\n".join(line.rstrip() for line in code.strip().splitlines() if line.strip()).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# 原文哈希 -> 规范化哈希：同一段源码再次出现时不必重新编译
+_fingerprints = LRUCache(4096)
+
+
+def code_key(code):
+    """
+    返回代码的缓存键（code_fingerprint），原文完全相同时直接查表
+    """
+    raw = hashlib.sha256(code.encode("utf-8")).digest()
+    key = _fingerprints.get(raw)
+    if key is None:
+        key = code_fingerprint(code)
+        _fingerprints.put(raw, key)
+    return key
+
+
+def grid_key(grid):
+    """
+    输入网格的缓存键
+    """
+    return hashlib.blake2b(json.dumps(grid, separators=(",", ":")).encode("utf-8"), digest_size=16).digest()
+
+
+_compiled = LRUCache(int(os.getenv("CODE_CACHE_SIZE", "256")))
+
+
+def compile_transform(code, key=None):
+    """
+    编译代码，按 code_key 缓存代码对象（注释 / 格式不同的同一段代码共用一个）
+
+    参数:
+    code (str): Python 代码
+    key (str): code_key(code)，调用方已经算过时传入
+
+    返回:
+    code: 代码对象
+
+    异常:
+    SyntaxError 等 compile 抛出的异常（不缓存）
+    """
+    key = key or code_key(code)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = compile(code, "<transform>", "exec")
+        _compiled.put(key, compiled)
+    return compiled
+
+
+class ResultStore:
+    """
+    执行结果的持久化存储（SQLite，线程安全，多个进程可以同时使用同一个文件）：
+    (code_key, grid_key) -> transform 的输出（JSON）
+
+    参数:
+    path: SQLite 文件路径
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 丢失最后几条结果只会让它们重新执行，不需要每次提交都 fsync
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                code_key TEXT NOT NULL,
+                grid_key BLOB NOT NULL,
+                output TEXT NOT NULL,
+                PRIMARY KEY (code_key, grid_key)
+            )"""
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        """
+        读取 key = (code_key, grid_key) 的输出，没有时返回 None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT output FROM results WHERE code_key = ? AND grid_key = ?", key).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, output):
+        """
+        写入输出；JSON 往返后不完全相同的输出（元组、numpy 数组等）不写入
+        """
+        try:
+            text = json.dumps(output, separators=(",", ":"))
+        except (TypeError, ValueError):
+            return
+        if json.loads(text) != output:
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO results (code_key, grid_key, output) VALUES (?, ?, ?)",
+                               (key[0], key[1], text))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResultCache:
+    """
+    执行结果缓存：内存 LRU 在前，ResultStore（可选）在后；只有 ("ok", 输出) 写入 ResultStore
+
+    参数:
+    memory (LRUCache): 内存缓存
+    store (ResultStore): 持久化存储，None 表示只用内存
+    """
+
+    def __init__(self, memory, store=None):
+        self.memory = memory
+        self.store = store
+        self.stored_hits = 0
+
+    def get(self, key):
+        """
+        返回 key 对应的 ("ok", 输出) 或 ("error", 错误信息)，没有时返回 None；
+        从 ResultStore 读到的结果同时放入内存缓存
+        """
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            output = self.store.get(key)
+            if output is not None:
+                value = ("ok", output)
+                self.memory.put(key, value)
+                self.stored_hits += 1
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.store is not None and value[0] == "ok":
+            self.store.put(key, value[1])
+
+    def clear(self):
+        """
+        清空内存缓存和统计（不删除 ResultStore 中的结果）
+        """
+        self.memory.clear()
+        self.stored_hits = 0
+
+    def stats(self):
+        """
+        返回统计信息：hits（包括从 ResultStore 读到的）/ misses / hit_rate / entries（内存中的条目数）/
+        stored_hits / stored_entries（ResultStore 中的条目数，没有 ResultStore 时为 0）
+        """
+        memory = self.memory.stats()
+        hits = memory["hits"] + self.stored_hits
+        misses = memory["misses"] - self.stored_hits
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": memory["entries"],
+            "stored_hits": self.stored_hits,
+            "stored_entries": len(self.store) if self.store is not None else 0,
+        }
+
+
+def get_result_store_path():
+    """
+    返回执行结果的 SQLite 文件路径（见 RESULT_CACHE_PATH），不写入磁盘时返回空字符串
+    """
+    path = os.getenv("RESULT_CACHE_PATH")
+    if path is None:
+        response_path = os.getenv("RESPONSE_CACHE_PATH", "")
+        if not response_path:
+            return ""
+        root, ext = os.path.splitext(response_path)
+        path = root + ".results" + (ext or ".sqlite")
+    return path
+
+
+_results = None
+_results_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    返回进程内共享的执行结果缓存（首次调用时创建，线程安全）：
+    (code_key, grid_key) -> ("ok", 输出) 或 ("error", 错误信息)
+    """
+    global _results
+    if _results is None:
+        with _results_lock:
+            if _results is None:
+                path = get_result_store_path()
+                _results = ResultCache(LRUCache(int(os.getenv("RESULT_CACHE_SIZE", "4096"))),
+                                       ResultStore(path) if path else None)
+    return _results
+
+
+def copy_output(value):
+    """
+    复制缓存中的输出网格，避免调用方修改缓存内容
+    """
+    if isinstance(value, list):
+        return [list(row) if isinstance(row, list) else row for row in value]
+    return value
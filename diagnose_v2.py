@@ -10,10 +10,9 @@ from dotenv import load_dotenv
 
 sys.path.insert(0, os.path.dirname(__file__))
 
-from openai import OpenAI
-from httpx import Timeout
-from prompt import construct_prompt
-from template import parse_output
+from grid import to_list
+from strategies import TaskContext, get_strategy, run_strategy
+from test_prompt import MODEL_CALLS
 
 load_dotenv()
 
@@ -25,35 +24,20 @@ print("=" * 70)
 print(f"V2 诊断测试 - 前 {len(data)} 个任务")
 print("=" * 70)
 
-api_key = os.getenv("DEEPSEEK_API_KEY")
-base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-timeout = int(os.getenv("API_TIMEOUT_SECONDS", "60"))
-max_tokens = int(os.getenv("API_MAX_TOKENS", "1000"))
-
-client = OpenAI(api_key=api_key, base_url=base_url, timeout=Timeout(timeout))
-
 correct = 0
 empty_outputs = 0
+# 与 test_prompt.py 的 V2 走同一套策略阶段（构造 prompt、调用、解析）
+strategy = get_strategy(2)
+config = {"model_name": "deepseek-chat", "temperature": 1.0}
 
 for idx, task in enumerate(data):
     print(f"\n[{idx+1}/{len(data)}] 任务处理中...")
     
     try:
-        # 生成 V2 prompt
-        messages = construct_prompt(task, version=2)
-        
-        # 调用 API
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=messages,
-            temperature=1.0,
-            max_tokens=max_tokens
-        )
-        
-        reply_text = response.choices[0].message.content
-        
-        # 解析输出
-        predicted_grid = parse_output(reply_text)
+        # 生成 V2 prompt、调用 API（与 test_prompt.py 共用同一个连接池客户端）并解析输出
+        ctx = TaskContext(task, config, MODEL_CALLS)
+        predicted_grid = to_list(run_strategy(strategy, ctx))
+        reply_text = ctx.replies[-1] if ctx.replies else ""
         
         # 获取真实答案
         ground_truth = task['test'][0]['output']
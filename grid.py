@@ -0,0 +1,146 @@
+"""
+grid.py - 紧凑的网格表示
+
+评测流程内部（解析、投票、判分、报告）用 Grid 表示网格：
+- 数据保存在只读的 uint8 二维数组中（ARC 的颜色为 0-9）
+- key 为 "形状 + tobytes()" 的字节串，首次使用时计算并缓存，作为投票计数的字典键
+- 哈希值缓存，== 比较 key（C 层的字节比较），diff 用数组运算找出不同的格子
+
+只在边界处与二维列表互相转换：模型回答解析出的列表、数据集中的真值、
+写入结果日志 / 投票统计的 JSON。as_grid / to_list 负责这两个方向的转换。
+"""
+
+import numpy as np
+
+
+class Grid:
+    """
+    只读网格
+
+    参数:
+    cells (np.ndarray): 二维 uint8 数组（不会被复制，调用方之后不应再修改）
+    """
+
+    __slots__ = ("cells", "_key", "_hash")
+
+    def __init__(self, cells):
+        if cells.ndim != 2 or cells.dtype != np.uint8:
+            raise ValueError(f"Grid needs a 2D uint8 array, got {cells.ndim}D {cells.dtype}")
+        cells.flags.writeable = False
+        self.cells = cells
+        self._key = None
+        self._hash = None
+
+    @classmethod
+    def from_list(cls, rows):
+        """
+        从二维整数列表构造；不是非空矩形整数网格（或颜色超出 0-255）时抛出 ValueError
+        """
+        if not isinstance(rows, list) or not rows:
+            raise ValueError("Grid needs a non-empty 2D list")
+        width = len(rows[0]) if isinstance(rows[0], list) else 0
+        if width == 0 or any(not isinstance(row, list) or len(row) != width for row in rows):
+            raise ValueError("Grid needs a rectangular 2D list")
+        cells = np.array(rows)
+        if cells.dtype.kind not in "iu" or cells.min() < 0 or cells.max() > 255:
+            raise ValueError("Grid cells must be integers in 0-255")
+        return cls(cells.astype(np.uint8))
+
+    @property
+    def shape(self):
+        return self.cells.shape
+
+    @property
+    def key(self):
+        """
+        可哈希、可直接比较的字节串：形状 + 所有格子
+        """
+        if self._key is None:
+            height, width = self.cells.shape
+            self._key = b"%dx%d:" % (height, width) + self.cells.tobytes()
+        return self._key
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.key)
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Grid):
+            if not isinstance(other, list):
+                return NotImplemented
+            other = as_grid(other)
+            if other is None:
+                return False
+        return self.key == other.key
+
+    def __len__(self):
+        return self.cells.shape[0]
+
+    def __bool__(self):
+        return self.cells.size > 0
+
+    def __getitem__(self, index):
+        return self.cells[index].tolist()
+
+    def __iter__(self):
+        return iter(self.cells.tolist())
+
+    def __repr__(self):
+        return repr(self.cells.tolist())
+
+    def tolist(self):
+        return self.cells.tolist()
+
+    def diff(self, other):
+        """
+        与另一个网格逐格比较
+
+        参数:
+        other (Grid): 要比较的网格（形状可以不同）
+
+        返回:
+        np.ndarray: 与本网格同形状的布尔数组，重叠区域内取值不同的格子为 True
+        """
+        mask = np.zeros(self.cells.shape, dtype=bool)
+        height = min(self.cells.shape[0], other.cells.shape[0])
+        width = min(self.cells.shape[1], other.cells.shape[1])
+        mask[:height, :width] = self.cells[:height, :width] != other.cells[:height, :width]
+        return mask
+
+
+def as_grid(value):
+    """
+    把 Grid 或二维列表转为 Grid；空值或无效网格返回 None
+
+    参数:
+    value: Grid、二维列表、空列表或 None
+
+    返回:
+    Grid 或 None
+    """
+    if isinstance(value, Grid):
+        return value
+    if not value:
+        return None
+    try:
+        return Grid.from_list(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def to_list(value):
+    """
+    把 Grid 转为二维列表（写入 JSON 等边界处使用）；空值返回空列表，列表原样返回
+    """
+    if isinstance(value, Grid):
+        return value.tolist()
+    return value if value else []
+
+
+def grids_equal(a, b):
+    """
+    判断两个网格（Grid 或二维列表）是否完全相同；任一方为空或无效时返回 False
+    """
+    a, b = as_grid(a), as_grid(b)
+    return a is not None and b is not None and a.key == b.key
@@ -0,0 +1,271 @@
+"""
+grid_codec.py - 网格的序列化格式（编码 / 解码）
+
+json.dumps 的网格每个格子要花 ", " 分隔符，30x30 的网格很容易上千 tokens。
+这里提供几种更省 tokens 的格式，供 prompt.py 的所有提示词共用，
+template.parse_output 用对应的解码器读回模型的回答：
+
+- "json":   [[0, 1, 1], [0, 0, 2]]（默认，与原来的提示词完全一致）
+- "rows":   每行一串数字，行之间换行
+            011
+            002
+- "rle":    每行按游程编码，"颜色*次数"，单个格子只写颜色
+            0 1*2
+            0*2 2
+- "sparse": 第一行给出尺寸和背景色，之后只列出非背景格子 "行,列=颜色"
+            2x3 background 0
+            0,1=1 0,2=1 1,2=2
+
+通过环境变量 GRID_ENCODING 选择格式，也可以向提示词构造函数显式传入 encoding。
+"""
+
+import os
+import re
+import json
+from collections import Counter
+
+
+GRID_ENCODINGS = ("json", "rows", "rle", "sparse")
+
+# 各格式的说明，附加在 system message 之后（json 不附加，保持原提示词不变）
+_FORMAT_NOTES = {
+    "rows": "Grids are written one row per line, each cell as a single digit with no separators "
+            "(e.g. the 2x3 grid [[0,1,1],[0,0,2]] is written as:\n011\n002)",
+    "rle": "Grids are written one row per line with run-length encoding: each run is COLOR*COUNT, "
+           "a single cell is just COLOR, runs are separated by spaces "
+           "(e.g. the 2x3 grid [[0,1,1],[0,0,2]] is written as:\n0 1*2\n0*2 2)",
+    "sparse": "Grids are written sparsely: the first line is ROWSxCOLS background COLOR, "
+              "followed by ROW,COL=COLOR for every cell that differs from the background (0-indexed) "
+              "(e.g. the 2x3 grid [[0,1,1],[0,0,2]] is written as:\n2x3 background 0\n0,1=1 0,2=1 1,2=2)",
+}
+
+_ROWS_LINE = re.compile(r'^[0-9]+$')
+_RLE_LINE = re.compile(r'^[0-9](?:\*[0-9]+)?(?:\s+[0-9](?:\*[0-9]+)?)*$')
+_SPARSE_HEADER = re.compile(r'(\d+)\s*x\s*(\d+)\s+background\s+(\d)', re.IGNORECASE)
+_SPARSE_CELL = re.compile(r'(\d+)\s*,\s*(\d+)\s*=\s*(\d)')
+_LINE_PATTERNS = {"rows": _ROWS_LINE, "rle": _RLE_LINE}
+# 各格式网格行中可能出现的字符（另有空白）；还没写完的一行中出现其他字符时，这一行已经不属于网格
+_GRID_LINE_CHARS = {
+    "rows": frozenset("0123456789`"),
+    "rle": frozenset("0123456789*`"),
+    "sparse": frozenset("0123456789,=`"),
+}
+
+
+def get_grid_encoding(encoding=None):
+    """
+    返回要使用的网格格式：encoding 不为 None 时直接使用，否则读取环境变量 GRID_ENCODING（默认 json）
+
+    参数:
+    encoding (str): 显式指定的格式，可为 None
+
+    返回:
+    str: GRID_ENCODINGS 中的一个
+    """
+    if encoding is None:
+        encoding = os.getenv("GRID_ENCODING", "json")
+    encoding = encoding.strip().lower()
+    if encoding not in GRID_ENCODINGS:
+        raise ValueError(f"Unknown grid encoding: {encoding} (expected one of {', '.join(GRID_ENCODINGS)})")
+    return encoding
+
+
+def encode_grid(grid, encoding=None):
+    """
+    把网格序列化为字符串
+
+    参数:
+    grid (list): 二维整数列表
+    encoding (str): 格式，默认按 GRID_ENCODING
+
+    返回:
+    str: 序列化结果（rows / rle / sparse 为多行文本）
+    """
+    encoding = get_grid_encoding(encoding)
+    if encoding == "json":
+        return json.dumps(grid)
+    if encoding == "rows":
+        return "\n".join("".join(str(cell) for cell in row) for row in grid)
+    if encoding == "rle":
+        return "\n".join(_encode_rle_row(row) for row in grid)
+    return _encode_sparse(grid)
+
+
+def _encode_rle_row(row):
+    runs = []
+    i = 0
+    while i < len(row):
+        j = i
+        while j < len(row) and row[j] == row[i]:
+            j += 1
+        runs.append(str(row[i]) if j - i == 1 else f"{row[i]}*{j - i}")
+        i = j
+    return " ".join(runs)
+
+
+def _encode_sparse(grid):
+    height = len(grid)
+    width = len(grid[0]) if grid else 0
+    counts = Counter(cell for row in grid for cell in row)
+    background = counts.most_common(1)[0][0] if counts else 0
+    cells = [f"{r},{c}={cell}" for r, row in enumerate(grid) for c, cell in enumerate(row) if cell != background]
+    header = f"{height}x{width} background {background}"
+    return header + "\n" + " ".join(cells) if cells else header
+
+
+def decode_grid(text, encoding=None, min_rows=1):
+    """
+    从文本中读出第一个指定格式的网格
+
+    参数:
+    text (str): 模型回答（或其中 "OUTPUT:" 之后的部分）
+    encoding (str): 格式，默认按 GRID_ENCODING
+    min_rows (int): rows / rle 格式至少要有的行数。在整段回答（而不是 "OUTPUT:" 之后）中查找时传 2，
+                    避免把推理中单独一行的数字（例如 "2024"、"3"）当成网格
+
+    返回:
+    list: 二维整数列表；找不到有效网格时返回空列表
+    """
+    if not text:
+        return []
+    encoding = get_grid_encoding(encoding)
+    if encoding == "json":
+        try:
+            grid = json.loads(text.strip())
+        except (json.JSONDecodeError, ValueError):
+            return []
+        return grid if _is_rectangular(grid) else []
+    if encoding == "sparse":
+        grid = _decode_sparse(text)
+        return grid if _is_rectangular(grid) else []
+    # rows / rle：依次检查每段连续的网格行，返回第一段行数足够且各行等宽的
+    for block in _blocks(text.splitlines(), _LINE_PATTERNS[encoding]):
+        grid = _decode_rows(block, encoding)
+        if len(grid) >= min_rows and _is_rectangular(grid):
+            return grid
+    return []
+
+
+def decode_complete_grid(text, encoding=None):
+    """
+    流式解析用：text 为 "OUTPUT:" 之后目前收到的文本。网格已经结束（后面出现了一整行不属于网格的内容，
+    例如空行、代码块围栏或说明文字）时返回网格，网格可能还没写完时返回 None。
+    只看以换行结尾的完整行，以及已经出现网格行中不会有的字符的最后一行（例如紧接在网格后的说明文字），
+    返回的网格与对完整回答调用 decode_grid 的结果相同
+
+    参数:
+    text (str): "OUTPUT:" 之后的文本
+    encoding (str): rows / rle / sparse，默认按 GRID_ENCODING
+
+    返回:
+    list 或 None
+    """
+    encoding = get_grid_encoding(encoding)
+    lines = text.split("\n")
+    if not set(lines[-1]) - _GRID_LINE_CHARS[encoding] - set(" \t\r"):
+        lines.pop()
+    if encoding == "sparse":
+        complete = "\n".join(lines)
+        header = _SPARSE_HEADER.search(complete)
+        if header is None:
+            return None
+        # 表头所在行的剩余部分之后，第一行没有格子坐标的完整行表示网格结束
+        height = int(header.group(1))
+        following = complete[header.end():].split("\n")[1:]
+        cell_lines = 0
+        for line in following:
+            if not _SPARSE_CELL.search(line) or cell_lines >= height:
+                grid = _decode_sparse(complete)
+                return grid if _is_rectangular(grid) else None
+            cell_lines += 1
+        return None
+    blocks = _blocks(lines, _LINE_PATTERNS[encoding], closed_only=True)
+    block = next(blocks, None)
+    if block is None:
+        return None
+    grid = _decode_rows(block, encoding)
+    return grid if _is_rectangular(grid) else None
+
+
+def _blocks(lines, line_pattern, closed_only=False):
+    """
+    依次给出每段连续匹配 line_pattern 的行（忽略行首尾空白和代码块围栏）；
+    closed_only 时不给出最后一段没有以不匹配的行结束的行
+    """
+    block = []
+    for line in lines:
+        line = line.strip().strip('`')
+        if line and line_pattern.match(line):
+            block.append(line)
+        elif block:
+            yield block
+            block = []
+    if block and not closed_only:
+        yield block
+
+
+def _decode_rows(block, encoding):
+    if encoding == "rows":
+        return [[int(ch) for ch in line] for line in block]
+    return [_decode_rle_row(line) for line in block]
+
+
+def _decode_rle_row(line):
+    row = []
+    for run in line.split():
+        color, _, count = run.partition("*")
+        row.extend([int(color)] * (int(count) if count else 1))
+    return row
+
+
+def _decode_sparse(text):
+    header = _SPARSE_HEADER.search(text)
+    if header is None:
+        return []
+    height, width, background = (int(x) for x in header.groups())
+    if height == 0 or width == 0 or height > 100 or width > 100:
+        return []
+    grid = [[background] * width for _ in range(height)]
+    for line in text[header.end():].splitlines()[:height + 1]:
+        for r, c, color in _SPARSE_CELL.findall(line):
+            r, c = int(r), int(c)
+            if r >= height or c >= width:
+                return []
+            grid[r][c] = int(color)
+    return grid
+
+
+def _is_rectangular(grid):
+    if not isinstance(grid, list) or not grid:
+        return False
+    width = None
+    for row in grid:
+        if not isinstance(row, list) or not row or not all(isinstance(cell, int) for cell in row):
+            return False
+        if width is not None and len(row) != width:
+            return False
+        width = len(row)
+    return True
+
+
+def grid_format_note(encoding=None, answer="grid"):
+    """
+    返回附加在 system message 之后的格式说明；json 格式返回空字符串（提示词保持原样）
+
+    参数:
+    encoding (str): 格式，默认按 GRID_ENCODING
+    answer (str): 模型回答的内容："grid"（要求用同样的格式写出答案网格）、
+                  "code"（PAL：代码仍然读写二维列表）或 None（回答里没有网格）
+
+    返回:
+    str: 以空行开头的说明文字，或空字符串
+    """
+    encoding = get_grid_encoding(encoding)
+    if encoding == "json":
+        return ""
+    note = "\n\nGRID FORMAT: " + _FORMAT_NOTES[encoding] + "."
+    if answer == "grid":
+        note += " Wherever a 2D list is requested, write your answer grid in this same format after OUTPUT:."
+    elif answer == "code":
+        note += " Your code still receives and returns grids as 2D lists of integers."
+    return note
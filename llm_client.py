@@ -0,0 +1,117 @@
+"""
+llm_client.py - 共享的大模型客户端
+
+所有入口（test_prompt.py / diagnose_v2.py / test_v2_output.py 等）共用同一个
+OpenAI 客户端及其底层 httpx 连接池：
+- 连接保持 keep-alive，避免每次调用都重新建立 TCP/TLS 连接
+- 连接池大小可配置（需要与并发数匹配）
+- 可选开启 HTTP/2（需要安装 h2: pip install httpx[http2]）
+"""
+
+import os
+import threading
+import importlib.util
+
+import httpx
+from openai import OpenAI
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_api_config():
+    """
+    从环境变量读取 API 与连接池配置
+
+    返回:
+    dict: 配置字典
+        - "api_key" / "base_url": API 地址与密钥
+        - "timeout": 单次请求超时（秒）
+        - "max_tokens": 最大生成 tokens
+        - "max_connections": 连接池最大连接数
+        - "max_keepalive_connections": 保持 keep-alive 的空闲连接数
+        - "keepalive_expiry": 空闲连接的保活时间（秒）
+        - "http2": 是否启用 HTTP/2
+        - "stream": 是否使用流式输出（OUTPUT 网格完整后提前取消）
+    """
+    return {
+        "api_key": os.getenv("DEEPSEEK_API_KEY"),
+        "base_url": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+        "timeout": int(os.getenv("API_TIMEOUT_SECONDS", "60")),
+        "max_tokens": int(os.getenv("API_MAX_TOKENS", "1000")),
+        "max_connections": int(os.getenv("API_MAX_CONNECTIONS", "32")),
+        "max_keepalive_connections": int(os.getenv("API_MAX_KEEPALIVE", "16")),
+        "keepalive_expiry": float(os.getenv("API_KEEPALIVE_EXPIRY", "60")),
+        "http2": os.getenv("API_HTTP2", "0") == "1",
+        "stream": os.getenv("API_STREAM", "0") == "1",
+    }
+
+
+def create_client(config=None):
+    """
+    按配置创建一个新的 OpenAI 客户端（带独立的 httpx 连接池）
+
+    一般不直接调用，请使用 get_client() 获取共享客户端。
+
+    参数:
+    config: 配置字典，默认为 get_api_config() 的结果
+
+    返回:
+    OpenAI: 客户端实例
+    """
+    if config is None:
+        config = get_api_config()
+
+    http2 = config["http2"]
+    if http2 and importlib.util.find_spec("h2") is None:
+        # HTTP/2 是可选依赖，未安装时退回 HTTP/1.1
+        print("Warning: API_HTTP2=1 but h2 is not installed (pip install httpx[http2]), falling back to HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        keepalive_expiry=config["keepalive_expiry"],
+    )
+    http_client = httpx.Client(
+        limits=limits,
+        http2=http2,
+        timeout=httpx.Timeout(config["timeout"]),
+    )
+
+    # DeepSeek 兼容 OpenAI 接口
+    # 重试由 call_policy.py 统一负责，这里关闭 SDK 自带的重试，避免两层重试叠加
+    return OpenAI(
+        api_key=config["api_key"],
+        base_url=config["base_url"],
+        timeout=httpx.Timeout(config["timeout"]),
+        max_retries=0,
+        http_client=http_client,
+    )
+
+
+def get_client():
+    """
+    获取进程内共享的 OpenAI 客户端（首次调用时创建，线程安全）
+
+    返回:
+    OpenAI: 共享客户端实例
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_client()
+    return _client
+
+
+def close_client():
+    """
+    关闭共享客户端并释放连接池；之后再调用 get_client() 会按当前环境变量重新创建
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,403 @@
+"""
+metrics.py - 评测过程的计时与调用统计
+
+每个任务在 collect_task_metrics() 中运行，期间：
+- timed("prompt" / "parse" / "execute" ...) 累计各阶段的本地耗时
+- call_stage("chain1" / "reflexion" ...) 标记之后的模型调用属于哪个阶段
+- record_api_call(...) 为每次模型调用（包括失败的调用）记一条调用记录
+- record_cache_hit() 为由回答缓存直接返回（未发出请求）的调用记一条调用记录
+- call_sample(i) 标记之后的模型调用是第几个采样（V3 / 多程序 V4 的并发采样）
+- record_parse(...) 按采样序号把解析结果回填到当前阶段的调用记录
+
+当前任务的统计对象保存在 contextvars 中，因此通过 submit_with_context
+提交到线程池的调用（V3 并发采样、对冲请求）也会计入同一个任务。
+
+任务结束时，调用记录交给 CallMetricsLog：逐条追加到 JSONL 文件，
+并汇总成 Prometheus 文本格式的快照（write_prometheus）。
+"""
+
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+_current_task = contextvars.ContextVar("task_metrics", default=None)
+_current_stage = contextvars.ContextVar("call_stage", default="predict")
+_current_sample = contextvars.ContextVar("call_sample", default=0)
+
+# 调用耗时直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class TaskMetrics:
+    """
+    单个任务的统计（线程安全）
+
+    参数:
+    labels: 写入每条调用记录的标签（例如 prompt_version / task_index）
+    """
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.stage_times = {}
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cache_hits = 0
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+
+    def add_call(self, latency, prompt_tokens=0, completion_tokens=0, cached_tokens=0):
+        with self._lock:
+            self.api_calls += 1
+            self.api_time += latency
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+            self.cached_tokens += cached_tokens or 0
+
+    def add_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def add_record(self, record):
+        with self._lock:
+            self.calls.append(record)
+
+    def mark_parsed(self, stage, successes):
+        """
+        把解析结果回填到 stage 阶段尚未回填的调用记录
+
+        解析结果按采样序号排列（与 speak_and_listen_multiple 的返回顺序一致），
+        调用记录按完成顺序追加，并发采样时两者不一定相同；这里按记录的 sample_indices
+        把每个结果对应到回答它的那次调用。序号相同的记录（同一阶段的多次单独调用）按调用顺序回填
+
+        参数:
+        stage: 阶段名
+        successes: 每个回答是否解析成功（bool 列表，按采样序号排列）
+        """
+        successes = list(successes)
+        with self._lock:
+            pending = [record for record in self.calls
+                       if record["stage"] == stage and not record["error"] and record["parse_ok"] is None]
+            # 展开为 (采样序号, 记录)，按序号排序（稳定排序，序号相同时保持调用顺序）
+            answers = sorted(((index, n) for n, record in enumerate(pending) for index in record["sample_indices"]),
+                             key=lambda item: item[0])
+            for (_, n), ok in zip(answers, successes):
+                record = pending[n]
+                record["parse_ok"] = (record["parse_ok"] or 0) + bool(ok)
+
+    def as_dict(self):
+        """
+        返回可 JSON 序列化的统计结果（不含逐次调用记录）
+        """
+        with self._lock:
+            return {
+                "api_calls": self.api_calls,
+                "api_time": self.api_time,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cache_hits": self.cache_hits,
+                "stage_times": dict(self.stage_times),
+            }
+
+
+class CallMetricsLog:
+    """
+    调用记录的 JSONL 日志 + 内存中的汇总（线程安全）
+
+    参数:
+    path: JSONL 文件路径，None 表示只汇总不落盘
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """
+        清空日志文件，开始新的一次评测
+        """
+        if self.path:
+            with self._lock:
+                with open(self.path, 'w', encoding='utf-8'):
+                    pass
+
+    def extend(self, records):
+        """
+        追加一个任务的全部调用记录，并计入汇总
+        """
+        if not records:
+            return
+        with self._lock:
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            for record in records:
+                self._add_to_totals(record)
+
+    def _add_to_totals(self, record):
+        key = (str(record.get("prompt_version", "")), record["stage"])
+        totals = self._totals.get(key)
+        if totals is None:
+            totals = {
+                "calls": 0, "samples": 0, "errors": 0, "cache_hits": 0, "retries": 0, "hedged": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                "parse_ok": 0, "parse_failed": 0,
+                "latency_sum": 0.0, "latency_buckets": [0] * len(LATENCY_BUCKETS),
+            }
+            self._totals[key] = totals
+
+        totals["calls"] += 1
+        totals["samples"] += record["samples"]
+        totals["errors"] += record["error"] is not None
+        totals["cache_hits"] += record["cache_hit"]
+        totals["retries"] += record["retries"]
+        totals["hedged"] += record["hedged"]
+        totals["prompt_tokens"] += record["prompt_tokens"]
+        totals["completion_tokens"] += record["completion_tokens"]
+        totals["cached_tokens"] += record["cached_tokens"]
+        if record["parse_ok"] is not None:
+            totals["parse_ok"] += record["parse_ok"]
+            totals["parse_failed"] += record["samples"] - record["parse_ok"]
+        if not record["cache_hit"]:
+            totals["latency_sum"] += record["latency"]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if record["latency"] <= bound:
+                    totals["latency_buckets"][i] += 1
+
+    def summary(self):
+        """
+        返回 (prompt_version, stage) -> 汇总计数的副本
+        """
+        with self._lock:
+            return {key: dict(totals, latency_buckets=list(totals["latency_buckets"]))
+                    for key, totals in self._totals.items()}
+
+    def write_prometheus(self, path):
+        """
+        把汇总写成 Prometheus 文本格式（可由 node_exporter 的 textfile collector 采集）
+        """
+        summary = self.summary()
+        counters = [
+            ("arc_model_calls_total", "calls", "Model calls, including cache hits and failures"),
+            ("arc_model_samples_total", "samples", "Sampled answers returned by model calls"),
+            ("arc_model_errors_total", "errors", "Model calls that raised an error"),
+            ("arc_model_cache_hits_total", "cache_hits", "Model calls answered from the response cache"),
+            ("arc_model_retries_total", "retries", "Retries performed by the call policy"),
+            ("arc_model_hedged_total", "hedged", "Model calls that sent a hedge request"),
+            ("arc_prompt_tokens_total", "prompt_tokens", "Prompt tokens reported by the API"),
+            ("arc_completion_tokens_total", "completion_tokens", "Completion tokens reported by the API"),
+            ("arc_cached_prompt_tokens_total", "cached_tokens", "Prompt tokens served from the provider prompt cache"),
+            ("arc_parse_success_total", "parse_ok", "Answers parsed successfully (grid, hypothesis or verdict)"),
+            ("arc_parse_failure_total", "parse_failed", "Answers that could not be parsed"),
+        ]
+
+        lines = []
+        for name, field, help_text in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (version, stage), totals in sorted(summary.items()):
+                lines.append(f'{name}{{prompt_version="{version}",stage="{stage}"}} {totals[field]}')
+
+        name = "arc_model_call_latency_seconds"
+        lines.append(f"# HELP {name} Latency of model calls that reached the API")
+        lines.append(f"# TYPE {name} histogram")
+        for (version, stage), totals in sorted(summary.items()):
+            labels = f'prompt_version="{version}",stage="{stage}"'
+            # 直方图的桶是累计计数
+            count = totals["calls"] - totals["cache_hits"]
+            for bound, bucket_count in zip(LATENCY_BUCKETS, totals["latency_buckets"]):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {totals["latency_sum"]:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {count}')
+
+        # 先写临时文件再替换，采集方不会读到写了一半的快照
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+_call_log = None
+
+
+def set_call_metrics_log(call_log):
+    """
+    设置接收调用记录的 CallMetricsLog，None 表示不收集
+    """
+    global _call_log
+    _call_log = call_log
+
+
+@contextmanager
+def collect_task_metrics(**labels):
+    """
+    在当前上下文中收集一个任务的统计，yield TaskMetrics 对象
+
+    参数:
+    labels: 写入该任务每条调用记录的标签（例如 prompt_version=3, task_index=12）
+    """
+    metrics = TaskMetrics(labels)
+    token = _current_task.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_task.reset(token)
+        if _call_log is not None:
+            _call_log.extend(metrics.calls)
+
+
+@contextmanager
+def timed(stage):
+    """
+    把 with 块的耗时累计到当前任务的 stage 阶段；不在任务中时什么也不做
+    """
+    metrics = _current_task.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.add_time(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def call_stage(stage):
+    """
+    把 with 块内的模型调用标记为 stage 阶段（例如 V5 的 "chain1" / "reflexion" / "chain2"）
+    """
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+@contextmanager
+def call_sample(index):
+    """
+    把 with 块内的模型调用标记为第 index 个采样（写入调用记录的 sample_indices），
+    record_parse 按采样序号把解析结果对应到调用记录
+    """
+    token = _current_sample.set(index)
+    try:
+        yield
+    finally:
+        _current_sample.reset(token)
+
+
+def cached_prompt_tokens(usage):
+    """
+    从 usage 中读取命中服务端 prompt 缓存的 tokens 数
+    （OpenAI: prompt_tokens_details.cached_tokens，DeepSeek: prompt_cache_hit_tokens）
+    """
+    if usage is None:
+        return 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return cached or 0
+
+
+def _new_record(metrics, **fields):
+    record = {
+        **metrics.labels,
+        "stage": _current_stage.get(),
+        "timestamp": time.time(),
+        "latency": 0.0,
+        "samples": 1,
+        "sample_indices": [_current_sample.get()],
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "retries": 0,
+        "hedged": False,
+        "rate_limit_wait": 0.0,
+        "cache_hit": False,
+        "error": None,
+        "parse_ok": None,
+    }
+    record.update(fields)
+    return record
+
+
+def record_api_call(latency, usage=None, stats=None, samples=1, error=None, sample_indices=None):
+    """
+    记录一次 API 调用
+
+    参数:
+    latency: 调用耗时（秒）
+    usage: 响应中的 usage 对象（含 prompt_tokens / completion_tokens），可为 None
+    stats: CallPolicy.call 写入的统计（retries / hedged / rate_limit_wait），可为 None
+    samples: 本次调用返回的回答数（n 参数请求大于 1）
+    error: 调用失败时的异常，成功时为 None
+    sample_indices: 本次调用回答的采样序号列表，默认从当前采样序号（call_sample）起连续 samples 个
+    """
+    metrics = _current_task.get()
+    if metrics is None:
+        return
+    prompt_tokens = (getattr(usage, "prompt_tokens", 0) or 0) if usage is not None else 0
+    completion_tokens = (getattr(usage, "completion_tokens", 0) or 0) if usage is not None else 0
+    cached_tokens = cached_prompt_tokens(usage)
+    stats = stats or {}
+    if sample_indices is None:
+        first = _current_sample.get()
+        sample_indices = list(range(first, first + samples))
+    if error is None:
+        metrics.add_call(latency, prompt_tokens, completion_tokens, cached_tokens)
+    metrics.add_record(_new_record(
+        metrics,
+        latency=latency,
+        samples=samples,
+        sample_indices=list(sample_indices),
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cached_tokens=cached_tokens,
+        retries=stats.get("retries", 0),
+        hedged=bool(stats.get("hedged", False)),
+        rate_limit_wait=stats.get("rate_limit_wait", 0.0),
+        error=type(error).__name__ if error is not None else None,
+    ))
+
+
+def record_cache_hit(sample_index=None):
+    """
+    记录一次由回答缓存直接返回的调用
+
+    参数:
+    sample_index: 缓存的回答的采样序号，默认为当前采样序号（call_sample）
+    """
+    metrics = _current_task.get()
+    if metrics is None:
+        return
+    metrics.add_cache_hit()
+    index = _current_sample.get() if sample_index is None else sample_index
+    metrics.add_record(_new_record(metrics, cache_hit=True, sample_indices=[index]))
+
+
+def record_parse(results, stage=None):
+    """
+    把回答的解析结果回填到调用记录
+
+    参数:
+    results: 按采样序号排列的解析结果（网格、提取出的文本等），空值 / None 表示解析失败
+    stage: 回答所属的阶段，默认为当前阶段
+    """
+    metrics = _current_task.get()
+    if metrics is None:
+        return
+    metrics.mark_parsed(stage or _current_stage.get(), [bool(result) for result in results])
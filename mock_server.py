@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+mock_server.py - 本地 OpenAI 兼容的 chat-completions 替身服务器
+
+用于在没有网络 / API Key 的机器上对整个评测流程做压测和基准测试：
+- 实现 POST .../chat/completions，支持 n 参数与流式输出（stream=True，SSE 分块返回）
+- 支持 HTTP/1.1 keep-alive
+- 延迟分布可配置：fixed / uniform / normal / lognormal / exp
+- 故障注入：按比例返回 429 / 500 等错误、按比例注入慢请求（长尾延迟）
+- 回答可以是固定文本，也可以根据 val.jsonl / val_hard.jsonl 的真值生成
+  （按比例给出错误答案，用于模拟不同的准确率）
+
+命令行示例:
+python mock_server.py --answers ground_truth --data val.jsonl,val_hard.jsonl \
+    --latency lognormal:0.5,0.4 --accuracy 0.6 --error-rate 0.02
+DEEPSEEK_BASE_URL=http://127.0.0.1:8011/v1 DEEPSEEK_API_KEY=mock python test_prompt.py
+"""
+
+import json
+import time
+import hashlib
+import math
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from grid_codec import GRID_ENCODINGS, encode_grid
+
+
+def parse_latency(spec):
+    """
+    解析延迟分布
+
+    参数:
+    spec: 数字（固定秒数）或字符串:
+          "fixed:S" / "uniform:LO,HI" / "normal:MEAN,STD" /
+          "lognormal:MEDIAN,SIGMA" / "exp:MEAN"（单位均为秒）
+
+    返回:
+    function: 无参函数，每次调用返回一个采样的延迟（秒，不小于 0）
+    """
+    if isinstance(spec, (int, float)):
+        value = float(spec)
+        return lambda: value
+
+    spec = str(spec).strip()
+    if ":" not in spec:
+        value = float(spec)
+        return lambda: value
+
+    kind, _, args = spec.partition(":")
+    params = [float(x) for x in args.split(",") if x.strip()]
+    kind = kind.lower()
+
+    if kind == "fixed":
+        return lambda: params[0]
+    if kind == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        # 以中位数和对数标准差描述，更贴近真实 API 的长尾延迟
+        mu = math.log(params[0])
+        return lambda: random.lognormvariate(mu, params[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1.0 / params[0])
+
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def load_answer_index(paths):
+    """
+    从数据集构建 "测试输入序列化 -> (真值输出, 网格格式, 任务)" 的索引
+    每个测试输入按 grid_codec 的每种格式各索引一次，提示词用哪种格式都能找到
+
+    参数:
+    paths: jsonl 文件路径列表
+
+    返回:
+    dict: encode_grid(test_input, encoding) -> (test_output, encoding, task)，
+          按键长度从长到短排列，避免短网格的序列化误匹配到长网格中
+    """
+    index = {}
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                task = json.loads(line)
+                test = task['test'][0]
+                if 'output' in test:
+                    for encoding in GRID_ENCODINGS:
+                        index.setdefault(encode_grid(test['input'], encoding), (test['output'], encoding, task))
+    return dict(sorted(index.items(), key=lambda item: -len(item[0])))
+
+
+def _perturb_grid(grid):
+    """
+    修改网格中的一个格子，得到一个错误答案
+    """
+    wrong = [list(row) for row in grid]
+    i = random.randrange(len(wrong))
+    j = random.randrange(len(wrong[i]))
+    wrong[i][j] = (wrong[i][j] + 1) % 10
+    return wrong
+
+
+def _pal_program(train, test_input, answer, correct):
+    """
+    PAL 回答中的 transform：按输入查表。正确时训练样本全部对得上；
+    错误时（答案被改动过）同时改动一个训练样本的输出，像一个错误的规律那样在训练样本上暴露出来
+    """
+    pairs = [(example['input'], example['output']) for example in train]
+    if not correct and pairs:
+        i = random.randrange(len(pairs))
+        pairs[i] = (pairs[i][0], _perturb_grid(pairs[i][1]))
+    table = {json.dumps(grid_in): grid_out for grid_in, grid_out in pairs + [(test_input, answer)]}
+    return f"def transform(input_grid):\n    table = {table!r}\n    return table.get(json.dumps(input_grid))"
+
+
+def make_reply(body, settings):
+    """
+    根据请求内容生成一个回答
+
+    - answers="canned"：直接返回固定文本
+    - answers="ground_truth"：在 prompt 中查找数据集里的测试输入，
+      以 accuracy 的概率给出真值（否则改动一个格子），并按 prompt 的要求组织格式：
+      PAL 提示词返回 transform 函数（查表实现，答错时在训练样本上也对不上），
+      V4 修复提示（多轮对话）按整个对话查找任务，V5 假设 / 验证阶段返回 HYPOTHESIS / VERIFICATION
+
+    参数:
+    body: 请求体
+    settings: 服务器配置
+
+    返回:
+    str: 回答文本
+    """
+    if settings["answers"] != "ground_truth":
+        return settings["reply"]
+
+    # 多轮对话（V5_MODE=conversation）按最后一条用户消息判断当前阶段
+    messages = body.get("messages", [])
+    user_turns = [m for m in messages if m.get("role") == "user"]
+    if len(user_turns) > 1:
+        prompt = str(user_turns[-1].get("content", ""))
+    else:
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    filler = "Reasoning about the examples. " * (settings["reasoning_chars"] // 30)
+    trailing = "Additional notes after the answer. " * (settings["trailing_chars"] // 35)
+
+    answer = None
+    encoding = "json"
+    # V4 修复提示的最后一条用户消息中没有测试输入，按整个对话查找
+    pal = "transform(input_grid)" in prompt
+    search = "\n".join(str(m.get("content", "")) for m in messages) if pal else prompt
+    correct = random.random() < settings["accuracy"]
+    for key, (output, encoding, task) in settings["answer_index"].items():
+        if key in search:
+            answer = output if correct else _perturb_grid(output)
+            break
+
+    if "VERIFICATION: PASSED" in prompt and "VERIFICATION: FAILED" in prompt:
+        return f"{filler}\n✓ Correct\nVERIFICATION: PASSED"
+    if "HYPOTHESIS:" in prompt and answer is None:
+        return f"OBSERVATIONS: {filler}\nHYPOTHESIS: Apply the mock transformation rule."
+    if answer is None:
+        return settings["reply"]
+    if pal:
+        program = _pal_program(task['train'], task['test'][0]['input'], answer, correct)
+        return f"{filler}\n```python\n{program}\n```\n{trailing}"
+    if encoding != "json":
+        return f"OBSERVATIONS: {filler}\nOUTPUT:\n{encode_grid(answer, encoding)}\n{trailing}"
+    return f"OBSERVATIONS: {filler}\nOUTPUT: {json.dumps(answer)}\n{trailing}"
+
+
+class PrefixCache:
+    """
+    模拟服务端的 prompt 前缀缓存（DeepSeek 以 64 tokens 为单位缓存请求前缀）：
+    记录见过的前缀，每个请求命中的部分为与之前请求逐字节相同的最长整块前缀
+
+    参数:
+    block_chars: 缓存单位（字符数），默认 256（约 64 tokens）
+    """
+
+    def __init__(self, block_chars=256):
+        self.block_chars = block_chars
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def lookup_and_store(self, prompt):
+        """
+        返回 prompt 命中缓存的字符数，并把 prompt 的所有整块前缀加入缓存
+        """
+        digest = hashlib.sha1()
+        keys = []
+        for start in range(0, len(prompt) - self.block_chars + 1, self.block_chars):
+            digest.update(prompt[start:start + self.block_chars].encode("utf-8"))
+            keys.append(digest.copy().hexdigest())
+
+        with self._lock:
+            cached_blocks = 0
+            for key in keys:
+                if key not in self._seen:
+                    break
+                cached_blocks += 1
+            self._seen.update(keys)
+        return cached_blocks * self.block_chars
+
+
+def build_completion(model, contents, prompt_tokens=0, cached_tokens=0):
+    """
+    构造一个 OpenAI 格式的 chat.completion 响应体
+
+    参数:
+    model: 模型名称
+    contents: 列表，每个元素是一个 choice 的回答文本
+    prompt_tokens: 输入 tokens 数（用于 usage 字段）
+    cached_tokens: 命中前缀缓存的输入 tokens 数（同时按 OpenAI 与 DeepSeek 的字段返回）
+
+    返回:
+    dict: 响应体
+    """
+    completion_tokens = sum(max(1, len(c) // 4) for c in contents)
+    return {
+        "id": f"chatcmpl-mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+            for i, content in enumerate(contents)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            "prompt_cache_hit_tokens": cached_tokens,
+            "prompt_cache_miss_tokens": prompt_tokens - cached_tokens,
+        },
+    }
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """
+    chat-completions 请求处理器；配置保存在 self.server.settings 中
+    """
+    protocol_version = "HTTP/1.1"
+    # 头部与正文分两次写出，关闭 Nagle 以免 keep-alive 连接上出现 40ms 的延迟确认等待
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        try:
+            body = json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+
+        settings = self.server.settings
+        with self.server.stats_lock:
+            self.server.request_count += 1
+
+        # 故障注入：按比例直接返回错误状态码
+        if settings["error_rate"] > 0 and random.random() < settings["error_rate"]:
+            status = random.choice(settings["error_statuses"])
+            self._send_json(status, {"error": {"message": f"Injected error {status}", "type": "mock_error"}})
+            return
+
+        latency = settings["latency"]()
+        # 故障注入：按比例注入慢请求
+        if settings["slow_rate"] > 0 and random.random() < settings["slow_rate"]:
+            latency += settings["slow_latency"]
+
+        model = body.get("model", "mock")
+        prompt = "".join(f"<|{m.get('role', '')}|>{m.get('content', '')}" for m in body.get("messages", []))
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+        cached_chars = min(prompt_chars, self.server.prefix_cache.lookup_and_store(prompt)) if settings["prefix_cache"] else 0
+        # 未命中前缀缓存的 tokens 需要 prefill
+        latency += (prompt_chars - cached_chars) // 4 / 1000 * settings["prefill_latency"]
+        if latency > 0:
+            time.sleep(latency)
+        if body.get("stream"):
+            self._send_stream(model, make_reply(body, settings))
+            return
+
+        # 不支持 n 的后端（如 DeepSeek）只返回一个 choice
+        n = max(1, int(body.get("n") or 1)) if settings["supports_n"] else 1
+        contents = [make_reply(body, settings) for _ in range(n)]
+        payload = build_completion(model, contents, prompt_tokens=prompt_chars // 4, cached_tokens=cached_chars // 4)
+        self._send_json(200, payload)
+
+    def _send_stream(self, model, content):
+        """
+        以 SSE（text/event-stream）分块返回回答，每块 stream_chunk_chars 个字符
+        """
+        settings = self.server.settings
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk_chars = max(1, settings["stream_chunk_chars"])
+        pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+        created = int(time.time())
+        try:
+            for i, piece in enumerate(pieces + [None]):
+                choice = {"index": 0, "delta": {"content": piece} if piece is not None else {},
+                          "finish_reason": None if piece is not None else "stop"}
+                event = {"id": "chatcmpl-mock-stream", "object": "chat.completion.chunk",
+                         "created": created, "model": model, "choices": [choice]}
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                if piece is not None and settings["stream_chunk_delay"] > 0:
+                    time.sleep(settings["stream_chunk_delay"])
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前取消了流，记录后直接结束
+            with self.server.stats_lock:
+                self.server.cancelled_streams += 1
+            self.close_connection = True
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已放弃请求（超时 / 对冲请求的落后方），忽略即可
+            pass
+
+    def log_message(self, format, *args):
+        # 关闭默认的逐请求日志，避免压测时刷屏
+        pass
+
+
+def start_mock_server(host="127.0.0.1", port=0, latency=0.0, reply="OUTPUT: [[0]]",
+                      error_rate=0.0, error_statuses=(429, 500), slow_rate=0.0, slow_latency=0.0,
+                      stream_chunk_chars=8, stream_chunk_delay=0.0,
+                      answers="canned", data_paths=("val.jsonl",), accuracy=1.0,
+                      reasoning_chars=0, trailing_chars=0, supports_n=True, prefix_cache=True,
+                      prefill_latency=0.0):
+    """
+    在后台线程中启动替身服务器
+
+    参数:
+    host: 监听地址
+    port: 监听端口，0 表示自动分配
+    latency: 每个请求的延迟：秒数或分布描述（见 parse_latency）
+    reply: 固定的回答文本（answers="canned"，或 ground_truth 模式下找不到任务时使用）
+    error_rate: 直接返回错误的请求比例 (0-1)
+    error_statuses: 注入错误时随机选用的状态码
+    slow_rate: 额外增加 slow_latency 延迟的请求比例 (0-1)
+    slow_latency: 慢请求的额外延迟（秒）
+    stream_chunk_chars: 流式输出时每个分块的字符数
+    stream_chunk_delay: 流式输出时相邻分块的间隔（秒）
+    answers: "canned"（固定回答）或 "ground_truth"（根据数据集真值生成回答）
+    data_paths: ground_truth 模式使用的数据集文件
+    accuracy: ground_truth 模式下给出正确答案的概率 (0-1)
+    reasoning_chars: 答案前的推理文字长度（字符数）
+    trailing_chars: 答案后的多余文字长度（字符数），用于测试流式提前取消
+    supports_n: 是否支持 n 参数；False 时与 DeepSeek 一样只返回一个 choice
+    prefix_cache: 是否模拟服务端 prompt 前缀缓存（在 usage 中返回 cached tokens）
+    prefill_latency: 每 1000 个未命中缓存的 prompt tokens 增加的延迟（秒）
+
+    返回:
+    tuple: (server, base_url)，base_url 可直接作为 DEEPSEEK_BASE_URL 使用；
+           结束时调用 server.shutdown()；server.request_count 为已收到的请求数，
+           server.cancelled_streams 为被客户端提前取消的流式请求数
+    """
+    server = ThreadingHTTPServer((host, port), MockChatHandler)
+    server.daemon_threads = True
+    server.settings = {
+        "latency": parse_latency(latency),
+        "reply": reply,
+        "error_rate": error_rate,
+        "error_statuses": list(error_statuses),
+        "slow_rate": slow_rate,
+        "slow_latency": slow_latency,
+        "stream_chunk_chars": stream_chunk_chars,
+        "stream_chunk_delay": stream_chunk_delay,
+        "answers": answers,
+        "answer_index": load_answer_index(data_paths) if answers == "ground_truth" else {},
+        "accuracy": accuracy,
+        "reasoning_chars": reasoning_chars,
+        "trailing_chars": trailing_chars,
+        "supports_n": supports_n,
+        "prefix_cache": prefix_cache,
+        "prefill_latency": prefill_latency,
+    }
+    server.prefix_cache = PrefixCache()
+    server.request_count = 0
+    server.cancelled_streams = 0
+    server.stats_lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{host}:{server.server_address[1]}/v1"
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--latency", default="0", help="seconds, or fixed:S / uniform:LO,HI / normal:MEAN,STD / lognormal:MEDIAN,SIGMA / exp:MEAN")
+    parser.add_argument("--reply", default="OUTPUT: [[0]]", help="canned reply text")
+    parser.add_argument("--answers", choices=["canned", "ground_truth"], default="canned")
+    parser.add_argument("--data", default="val.jsonl", help="comma-separated datasets for --answers ground_truth")
+    parser.add_argument("--accuracy", type=float, default=1.0, help="probability of answering correctly (ground_truth mode)")
+    parser.add_argument("--reasoning-chars", type=int, default=0, help="length of reasoning text before the answer")
+    parser.add_argument("--trailing-chars", type=int, default=0, help="length of extra text after the answer")
+    parser.add_argument("--no-n", action="store_true", help="ignore the n parameter (return a single choice)")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="do not simulate provider prompt prefix caching")
+    parser.add_argument("--prefill-latency", type=float, default=0.0,
+                        help="extra seconds per 1000 prompt tokens not served from the prefix cache")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-statuses", default="429,500", help="comma-separated status codes to inject")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of requests that get extra latency")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="extra latency for slow requests (seconds)")
+    parser.add_argument("--stream-chunk-chars", type=int, default=8, help="characters per streamed chunk")
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.0, help="delay between streamed chunks (seconds)")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(
+        args.host, args.port, args.latency, args.reply,
+        error_rate=args.error_rate,
+        error_statuses=[int(s) for s in args.error_statuses.split(",")],
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        stream_chunk_chars=args.stream_chunk_chars,
+        stream_chunk_delay=args.stream_chunk_delay,
+        answers=args.answers,
+        data_paths=args.data.split(","),
+        accuracy=args.accuracy,
+        reasoning_chars=args.reasoning_chars,
+        trailing_chars=args.trailing_chars,
+        supports_n=not args.no_n,
+        prefix_cache=not args.no_prefix_cache,
+        prefill_latency=args.prefill_latency,
+    )
+    print(f"Mock server listening on {base_url}")
+    print(f"Use: DEEPSEEK_BASE_URL={base_url} DEEPSEEK_API_KEY=mock python test_prompt.py")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
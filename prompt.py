@@ -1,36 +1,353 @@
 """
 prompt.py - 提示词构造策略
+
+所有提示词构造函数都接受：
+- d：ARC 任务字典，或 prepare_task 返回的 PreparedTask
+  （同一任务要构造多个提示词时先 prepare_task 一次，网格只序列化一次）
+- encoding 参数：网格的序列化格式（见 grid_codec.py），默认按环境变量 GRID_ENCODING（json）
+- 训练样本按 tokens 预算筛选（见 select_train_pairs），默认不限制
+- layout 参数：提示词布局，默认按环境变量 PROMPT_LAYOUT
+  - "shared"（默认）：同一任务的所有请求共享相同的 system message 与训练样本前缀，
+    便于服务端的 prompt 缓存命中
+  - "legacy"：各版本原来的提示词（json 格式下与最初的实现逐字节一致）
+- V5 的三个阶段可以是独立请求（默认），也可以是同一段对话（V5_MODE=conversation）
+"""
+
+import os
+import re
+
+from grid_codec import encode_grid, grid_format_note, get_grid_encoding
+
+
+class PreparedTask:
+    """
+    预处理过的任务：每个网格只序列化一次，形状字符串和 shared 布局的前缀也只计算一次
+
+    设置了 tokens 预算时，train_* 只包含 select_train_pairs 选中的训练样本
+    （保持原顺序），train_indices / dropped_train 记录选中与被丢弃的原始下标。
+
+    参数:
+    task (dict): ARC 任务数据
+    encoding (str): 网格格式，默认按 GRID_ENCODING
+    token_budget (int): 提示词 tokens 预算，默认按 get_prompt_token_budget()，0 表示不限制
+    """
+
+    __slots__ = ("task", "encoding", "token_budget", "num_train", "train_indices", "dropped_train",
+                 "train_inputs", "train_outputs", "train_input_shapes", "train_output_shapes",
+                 "test_input", "test_input_shape", "_shared_prefix")
+
+    def __init__(self, task, encoding=None, token_budget=None):
+        self.task = task
+        self.encoding = get_grid_encoding(encoding)
+        self.token_budget = get_prompt_token_budget() if token_budget is None else token_budget
+        train = task['train']
+        train_inputs = [encode_grid(example['input'], self.encoding) for example in train]
+        train_outputs = [encode_grid(example['output'], self.encoding) for example in train]
+        test_input = task['test'][0]['input']
+        self.test_input = encode_grid(test_input, self.encoding)
+        self.test_input_shape = _shape(test_input)
+
+        keep = range(len(train))
+        if self.token_budget > 0:
+            pair_tokens = [estimate_text_tokens(train_inputs[i]) + estimate_text_tokens(train_outputs[i]) + _PAIR_OVERHEAD_TOKENS
+                           for i in keep]
+            available = self.token_budget - _FIXED_OVERHEAD_TOKENS - estimate_text_tokens(self.test_input)
+            keep = select_train_pairs(train, pair_tokens, available)
+        self.train_indices = tuple(keep)
+        self.dropped_train = tuple(sorted(set(range(len(train))) - set(keep)))
+        self.num_train = len(self.train_indices)
+        self.train_inputs = tuple(train_inputs[i] for i in self.train_indices)
+        self.train_outputs = tuple(train_outputs[i] for i in self.train_indices)
+        self.train_input_shapes = tuple(_shape(train[i]['input']) for i in self.train_indices)
+        self.train_output_shapes = tuple(_shape(train[i]['output']) for i in self.train_indices)
+        self._shared_prefix = None
+
+    def shared_prefix(self):
+        """
+        shared 布局的 (system message, 训练样本块)，首次调用时拼接并缓存
+        """
+        if self._shared_prefix is None:
+            system_message = SHARED_SYSTEM_MESSAGE + grid_format_note(self.encoding, answer=None)
+            parts = ["Training examples:\n\n"]
+            for i in range(self.num_train):
+                parts.append(f"Training Example {i+1}:\n"
+                             f"Input (shape {self.train_input_shapes[i]}):\n{self.train_inputs[i]}\n"
+                             f"Output (shape {self.train_output_shapes[i]}):\n{self.train_outputs[i]}\n\n")
+            self._shared_prefix = (system_message, "".join(parts))
+        return self._shared_prefix
+
+
+def prepare_task(d, encoding=None, token_budget=None):
+    """
+    返回任务的 PreparedTask；d 已经是同一格式、同一预算的 PreparedTask 时直接返回
+
+    参数:
+    d: ARC 任务字典或 PreparedTask
+    encoding (str): 网格格式，默认按 GRID_ENCODING
+    token_budget (int): 提示词 tokens 预算，默认按 get_prompt_token_budget()
+
+    返回:
+    PreparedTask
+    """
+    if isinstance(d, PreparedTask):
+        if ((encoding is None or get_grid_encoding(encoding) == d.encoding)
+                and (token_budget is None or token_budget == d.token_budget)):
+            return d
+        if encoding is None:
+            encoding = d.encoding
+        d = d.task
+    return PreparedTask(d, encoding, token_budget)
+
+
+def _shape(grid):
+    return f"{len(grid)}x{len(grid[0]) if grid else 0}"
+
+
+# ============================================================================
+# 训练样本的 tokens 预算（PROMPT_TOKEN_BUDGET / MODEL_CONTEXT_TOKENS）
+# ============================================================================
+#
+# val_hard 的任务最多 6 对 30x30 的训练样本，全部放进提示词可能超出模型上下文。
+# 设置预算后，PreparedTask 只保留放得下的训练样本：先选最小的一对，
+# 之后每次在放得下的样本中选带来最多新特征（形状、颜色、是否改变尺寸）的一对，
+# 相同时选更小的。同一任务的所有提示词共用同一组样本，shared 前缀保持一致。
+
+# 近似 cl100k 的预切分：1-3 位数字一组、带前导空格的单词、标点串、空白
+_APPROX_TOKEN = re.compile(r"\d{1,3}| ?[A-Za-z]+| ?[^\sA-Za-z\d]+|\s+")
+
+# 每对样本的标题（"Training Example 1:" / "Input (shape 3x3):" 等）
+_PAIR_OVERHEAD_TOKENS = 24
+# system message、格式说明、测试输入标题和最长的阶段说明（含 V5 的假设）
+_FIXED_OVERHEAD_TOKENS = 800
+
+
+def estimate_text_tokens(text):
+    """
+    近似估计文本的 tokens 数（不依赖 tokenizer，网格文本上与 cl100k 接近）
+    """
+    return len(_APPROX_TOKEN.findall(text))
+
+
+def get_prompt_token_budget():
+    """
+    返回提示词 tokens 预算：PROMPT_TOKEN_BUDGET（0 表示不限制）；
+    设置了 MODEL_CONTEXT_TOKENS 时不超过上下文长度减去 API_MAX_TOKENS
+    """
+    budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "0"))
+    context = int(os.getenv("MODEL_CONTEXT_TOKENS", "0"))
+    if context > 0:
+        limit = max(1, context - int(os.getenv("API_MAX_TOKENS", "1000")))
+        budget = min(budget, limit) if budget > 0 else limit
+    return budget
+
+
+def _pair_features(example):
+    inp, out = example['input'], example['output']
+    features = {("in_shape", _shape(inp)), ("out_shape", _shape(out)),
+                ("resize", _shape(inp) != _shape(out))}
+    features.update(("in_color", color) for color in set().union(*inp))
+    features.update(("out_color", color) for color in set().union(*out))
+    return features
+
+
+def select_train_pairs(train, pair_tokens, available):
+    """
+    在 tokens 预算内选择训练样本
+
+    参数:
+    train (list): 训练样本 [{"input": ..., "output": ...}]
+    pair_tokens (list): 每对样本的估计 tokens 数
+    available (int): 留给训练样本的 tokens 数
+
+    返回:
+    list: 选中样本的原始下标（升序）；至少保留最小的一对
+    """
+    if sum(pair_tokens) <= available:
+        return list(range(len(train)))
+    remaining = sorted(range(len(train)), key=lambda i: pair_tokens[i])
+    first = remaining.pop(0)
+    selected = [first]
+    covered = _pair_features(train[first])
+    used = pair_tokens[first]
+    features = {i: _pair_features(train[i]) for i in remaining}
+    while True:
+        fitting = [i for i in remaining if used + pair_tokens[i] <= available]
+        if not fitting:
+            break
+        best = max(fitting, key=lambda i: (len(features[i] - covered), -pair_tokens[i]))
+        remaining.remove(best)
+        selected.append(best)
+        covered |= features[best]
+        used += pair_tokens[best]
+    return sorted(selected)
+
+
+# ============================================================================
+# 共享前缀布局（PROMPT_LAYOUT=shared）
+# ============================================================================
+#
+# 服务端的 prompt 缓存只对逐字节相同的前缀生效。shared 布局下同一任务的所有请求
+# （V1-V5 各版本、V3 的每个采样、V5 的三个阶段）都以相同的内容开头：
+#   system: SHARED_SYSTEM_MESSAGE（+ 网格格式说明）
+#   user:   训练样本块 + 本阶段的说明（测试输入、输出格式等只出现在训练样本之后）
+# legacy 布局保留原来各版本各自的 system message 和标题，用于复现旧结果。
+
+PROMPT_LAYOUTS = ("shared", "legacy")
+
+SHARED_SYSTEM_MESSAGE = """You are an expert at visual reasoning and pattern analysis.
+Each task shows training examples: pairs of input and output grids of integers (colors 0-9) that follow one hidden transformation rule.
+The training examples come first. The instructions after them say what to do in this step: describe the rule, verify a hypothesis, write a Python function, or predict the output for a test input.
+Follow the output format requested in those instructions exactly."""
+
+
+def get_prompt_layout(layout=None):
+    """
+    返回提示词布局：layout 不为 None 时直接使用，否则读取环境变量 PROMPT_LAYOUT（默认 shared）
+    """
+    if layout is None:
+        layout = os.getenv("PROMPT_LAYOUT", "shared")
+    layout = layout.strip().lower()
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Unknown prompt layout: {layout} (expected one of {', '.join(PROMPT_LAYOUTS)})")
+    return layout
+
+
+def _shared_messages(t, instructions):
+    """
+    组装 shared 布局的 messages：共享的 system message 与训练样本块在前，本阶段的说明在后
+    """
+    system_message, train_block = t.shared_prefix()
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": train_block + instructions}
+    ]
+
+
+def _answer_format(encoding):
+    """
+    要求模型输出网格时的格式说明
+    """
+    if encoding == "json":
+        return "a 2D list of integers, e.g. [[0,1,2],[3,4,5]]"
+    return "a grid in the GRID FORMAT described above (not a 2D list)"
+
+
+def _test_input_block(t):
+    return f"Test Input (shape {t.test_input_shape}):\n{t.test_input}\n\n"
+
+
+def _v1_instructions(t):
+    return ("TASK: Predict the output for this test input.\n\n"
+            + _test_input_block(t)
+            + f"Answer with the output grid as {_answer_format(t.encoding)}, on the last line in the form:\n"
+            + "OUTPUT: <grid>")
+
+
+def _v2_instructions(t):
+    return ("TASK: Analyze step by step, then predict the output for this test input.\n\n"
+            + _test_input_block(t)
+            + """Step 1: OBSERVATIONS
+What patterns do you notice? How does each input transform to output?
+
+Step 2: PATTERN RULE
+State the exact transformation rule clearly and concisely.
+
+Step 3: REASONING
+How does this rule apply to the test input? Show your work.
+
+Step 4: OUTPUT (REQUIRED - must come last)
+"""
+            + f"Give the predicted output grid as {_answer_format(t.encoding)}, in exactly this form with no text after it:\n"
+            + "OUTPUT: <grid>")
+
+
+def _v3_instructions(t):
+    return ("TASK: Analyze step by step, then predict the output for this test input.\n\n"
+            + _test_input_block(t)
+            + f"""Format your answer as:
+OBSERVATIONS: [what patterns you notice, how each input transforms to its output]
+PATTERN RULE: [the exact transformation rule]
+REASONING: [how the rule applies to the test input]
+OUTPUT: [the predicted output grid as {_answer_format(t.encoding)}]""")
+
+
+def _v4_instructions(t):
+    return ("TASK: Write a Python function named `transform(input_grid)` that implements the transformation.\n"
+            "- It takes the input grid as a 2D list of integers and returns the output grid as a 2D list of integers\n"
+            "- It must reproduce every training example and work for the test input below\n\n"
+            + _test_input_block(t)
+            + """Briefly analyze the transformation first, then output your code in a Python code block:
+```python
+def transform(input_grid):
+    # Your implementation here
+    pass
+```
+""")
+
+
+def _v5_chain1_instructions(t):
+    return """TASK: Propose a hypothesis about the transformation rule. Be precise and testable.
+
+Format your answer as:
+OBSERVATIONS: [your observations]
+HYPOTHESIS: [the transformation rule hypothesis]"""
+
+
+def _v5_reflexion_instructions(t, hypothesis):
+    return f"""TASK: Verify this hypothesis against the training examples above:
+{hypothesis}
+
+For each example:
+1. Apply the hypothesis to the input
+2. Compare with the expected output
+3. If they match, say "✓ Correct"
+4. If they don't match, say "✗ Mismatch" and explain what's wrong
+
+After checking all examples:
+- If all match, respond: "VERIFICATION: PASSED"
+- If any don't match, respond with the corrections needed:
+  "VERIFICATION: FAILED - ERROR ANALYSIS: [explain what's wrong] - CORRECTED HYPOTHESIS: [new hypothesis]"
 """
 
-import json
 
+def _v5_chain2_instructions(t, final_hypothesis):
+    return (f"TASK: Apply this validated transformation rule precisely to the test input:\n{final_hypothesis}\n\n"
+            + _test_input_block(t)
+            + f"Apply the rule step by step and provide:\nOUTPUT: [the predicted output as {_answer_format(t.encoding)}]\n")
 
-def prompt_v1_simple(d):
+
+def prompt_v1_simple(d, encoding=None, layout=None):
     """
     V1: 简单提示词（基础版本）
     直接给出训练样本和测试输入，要求模型预测
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v1_instructions(t))
+    
     system_message = "You are an expert at solving visual reasoning tasks. Given input and output grid examples, identify the transformation rule and apply it to predict the output for new inputs."
     
-    user_content = ""
-    user_content += "Here are training examples:\n\n"
-    for i, example in enumerate(d['train']):
-        user_content += f"Example {i+1}:\n"
-        user_content += f"Input:\n{json.dumps(example['input'])}\n"
-        user_content += f"Output:\n{json.dumps(example['output'])}\n\n"
+    parts = []
+    parts.append("Here are training examples:\n\n")
+    for i in range(t.num_train):
+        parts.append(f"Example {i+1}:\n")
+        parts.append(f"Input:\n{t.train_inputs[i]}\n")
+        parts.append(f"Output:\n{t.train_outputs[i]}\n\n")
+    
+    parts.append("Now predict the output for this test input:\n")
+    parts.append(f"Input:\n{t.test_input}\n")
+    parts.append("Output (as a 2D list):\n")
     
-    user_content += "Now predict the output for this test input:\n"
-    user_content += f"Input:\n{json.dumps(d['test'][0]['input'])}\n"
-    user_content += "Output (as a 2D list):\n"
+    system_message += grid_format_note(t.encoding)
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
-def prompt_v2_fewshot_cot(d):
+def prompt_v2_fewshot_cot(d, encoding=None, layout=None):
     """
     V2: 基准推理流（Few-Shot + Chain of Thought）
     组合策略：少样本学习 + 链式思考
@@ -40,6 +357,10 @@ def prompt_v2_fewshot_cot(d):
     2. 链式思考：要求模型先生成自然语言的观察和规律总结
     3. 最终输出：然后生成预测的输出矩阵
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v2_instructions(t))
+    
     system_message = """You are an expert at visual reasoning and pattern analysis. 
 Your task is to:
 1. Analyze the training examples carefully
@@ -50,23 +371,22 @@ Your task is to:
 IMPORTANT: Your OUTPUT must be ONLY a valid 2D list of integers, nothing else after the final ]]
 Example format: [[0,1,2],[3,4,5],[6,7,8]]"""
     
-    user_content = ""
-    user_content += "Analyze these training examples to identify the transformation pattern:\n\n"
+    parts = []
+    parts.append("Analyze these training examples to identify the transformation pattern:\n\n")
     
     # 详细展示每个训练样本
-    for i, example in enumerate(d['train']):
-        user_content += f"Training Example {i+1}:\n"
-        user_content += f"Input (shape {len(example['input'])}x{len(example['input'][0]) if example['input'] else 0}):\n"
-        user_content += json.dumps(example['input']) + "\n"
-        user_content += f"Output (shape {len(example['output'])}x{len(example['output'][0]) if example['output'] else 0}):\n"
-        user_content += json.dumps(example['output']) + "\n\n"
+    for i in range(t.num_train):
+        parts.append(f"Training Example {i+1}:\n")
+        parts.append(f"Input (shape {t.train_input_shapes[i]}):\n")
+        parts.append(t.train_inputs[i] + "\n")
+        parts.append(f"Output (shape {t.train_output_shapes[i]}):\n")
+        parts.append(t.train_outputs[i] + "\n\n")
     
     # 提供测试样本
-    test_input = d['test'][0]['input']
-    user_content += f"Test Input (shape {len(test_input)}x{len(test_input[0]) if test_input else 0}):\n"
-    user_content += json.dumps(test_input) + "\n\n"
+    parts.append(f"Test Input (shape {t.test_input_shape}):\n")
+    parts.append(t.test_input + "\n\n")
     
-    user_content += """TASK: Analyze step by step and provide your final answer.
+    parts.append("""TASK: Analyze step by step and provide your final answer.
 
 Step 1: OBSERVATIONS
 What patterns do you notice? How does each input transform to output?
@@ -82,16 +402,18 @@ Compute the predicted output grid.
 Your final output MUST be exactly in this format (no other text after this):
 OUTPUT: [[...],[...],...]
 
-CRITICAL: After "OUTPUT:", immediately provide ONLY the 2D list of integers with no additional text."""
+CRITICAL: After "OUTPUT:", immediately provide ONLY the 2D list of integers with no additional text.""")
+    
+    system_message += grid_format_note(t.encoding)
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
-def prompt_v3_robust(d):
+def prompt_v3_robust(d, encoding=None, layout=None):
     """
     V3: 鲁棒性增强流（Few-Shot + CoT + Self-Consistency）
     
@@ -105,6 +427,10 @@ def prompt_v3_robust(d):
     
     此函数与 V2 的提示词相同，主要区别在于调用策略
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v3_instructions(t))
+    
     system_message = """You are an expert at visual reasoning and pattern analysis. 
 Your task is to:
 1. Analyze the training examples carefully
@@ -118,23 +444,22 @@ PATTERN RULE: [State the transformation rule clearly]
 REASONING: [Explain how this rule applies to the test case]
 OUTPUT: [Provide the predicted grid as a 2D list]"""
     
-    user_content = ""
-    user_content += "Analyze these training examples to identify the transformation pattern:\n\n"
+    parts = []
+    parts.append("Analyze these training examples to identify the transformation pattern:\n\n")
     
     # 详细展示每个训练样本
-    for i, example in enumerate(d['train']):
-        user_content += f"Training Example {i+1}:\n"
-        user_content += f"Input (shape {len(example['input'])}x{len(example['input'][0]) if example['input'] else 0}):\n"
-        user_content += json.dumps(example['input']) + "\n"
-        user_content += f"Output (shape {len(example['output'])}x{len(example['output'][0]) if example['output'] else 0}):\n"
-        user_content += json.dumps(example['output']) + "\n\n"
+    for i in range(t.num_train):
+        parts.append(f"Training Example {i+1}:\n")
+        parts.append(f"Input (shape {t.train_input_shapes[i]}):\n")
+        parts.append(t.train_inputs[i] + "\n")
+        parts.append(f"Output (shape {t.train_output_shapes[i]}):\n")
+        parts.append(t.train_outputs[i] + "\n\n")
     
     # 提供测试样本
-    test_input = d['test'][0]['input']
-    user_content += f"Test Input (shape {len(test_input)}x{len(test_input[0]) if test_input else 0}):\n"
-    user_content += json.dumps(test_input) + "\n\n"
+    parts.append(f"Test Input (shape {t.test_input_shape}):\n")
+    parts.append(t.test_input + "\n\n")
     
-    user_content += """Please analyze step by step:
+    parts.append("""Please analyze step by step:
 
 1. OBSERVATIONS: What patterns do you notice? How does each input transform to output?
 
@@ -148,16 +473,18 @@ Format your final answer as:
 OBSERVATIONS: [your observations]
 PATTERN RULE: [the rule]
 REASONING: [your reasoning]
-OUTPUT: [the 2D list]"""
+OUTPUT: [the 2D list]""")
+    
+    system_message += grid_format_note(t.encoding)
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
-def prompt_v4_pal(d):
+def prompt_v4_pal(d, encoding=None, layout=None):
     """
     V4: 程序辅助语言模型 (Program-Aided Language Models - PAL)
     
@@ -169,6 +496,10 @@ def prompt_v4_pal(d):
     - 然后执行代码获得结果
     - 代码逻辑比直接猜测更严谨
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v4_instructions(t))
+    
     system_message = """You are an expert programmer specializing in grid transformations and pattern analysis.
 Your task is to:
 1. Analyze the training examples to understand the transformation pattern
@@ -186,23 +517,22 @@ Important:
 - Make sure the function handles the transformation correctly
 - Test your logic against the provided examples"""
     
-    user_content = ""
-    user_content += """Analyze these training examples and write a transformation function:
+    parts = []
+    parts.append("""Analyze these training examples and write a transformation function:
 
-"""
+""")
     
     # 详细展示每个训练样本
-    for i, example in enumerate(d['train']):
-        user_content += f"Training Example {i+1}:\n"
-        user_content += f"Input:\n{json.dumps(example['input'])}\n"
-        user_content += f"Expected Output:\n{json.dumps(example['output'])}\n\n"
+    for i in range(t.num_train):
+        parts.append(f"Training Example {i+1}:\n")
+        parts.append(f"Input:\n{t.train_inputs[i]}\n")
+        parts.append(f"Expected Output:\n{t.train_outputs[i]}\n\n")
     
     # 提供测试样本
-    test_input = d['test'][0]['input']
-    user_content += f"""Based on the patterns above, write a Python function to transform the input:
+    parts.append(f"""Based on the patterns above, write a Python function to transform the input:
 
 Test Input:
-{json.dumps(test_input)}
+{t.test_input}
 
 Instructions:
 1. First, analyze what transformation is happening in the examples
@@ -216,77 +546,134 @@ def transform(input_grid):
     # Your implementation here
     pass
 ```
-"""
+""")
+    
+    system_message += grid_format_note(t.encoding, answer="code")
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
-def prompt_v5_chain1_hypothesis(d):
+def _v4_repair_instructions(t, failures):
+    parts = ["Your `transform(input_grid)` does not reproduce every training example:\n"]
+    for failure in failures:
+        index = failure["index"]
+        if index in t.train_indices:
+            parts.append(f"- Training Example {t.train_indices.index(index) + 1}: {failure['detail']}\n")
+        else:
+            # 因 tokens 预算没有放进提示词的训练样本，附上它的输入
+            example = t.task['train'][index]
+            parts.append(f"- Additional training example: {failure['detail']}\n"
+                         f"  Input:\n{encode_grid(example['input'], t.encoding)}\n"
+                         f"  Expected Output:\n{encode_grid(example['output'], t.encoding)}\n")
+    parts.append("""
+Rows and columns are numbered from 0. Fix the function so that it reproduces every training example, \
+then output the complete corrected code in a Python code block:
+```python
+def transform(input_grid):
+    # Your implementation here
+    pass
+```
+""")
+    return "".join(parts)
+
+
+def prompt_v4_repair(d, history, reply, failures, encoding=None):
+    """
+    V4 修复提示：代码在训练样本上验证失败时，在原对话之后追加模型的回答和差异说明，
+    要求模型修正代码（只追加一轮，原对话的前缀不变，可以命中 prompt 缓存）
+
+    参数:
+    d: ARC 任务字典或 PreparedTask
+    history (list): 原来的 V4 messages
+    reply (str): 模型给出代码的回答
+    failures (list): verify_transform_code 返回的未通过样本
+
+    返回:
+    list: 新的 messages（不修改 history）
+    """
+    t = prepare_task(d, encoding)
+    return history + [
+        {"role": "assistant", "content": reply},
+        {"role": "user", "content": _v4_repair_instructions(t, failures)}
+    ]
+
+
+def prompt_v5_chain1_hypothesis(d, encoding=None, layout=None):
     """
     V5 Chain 1 - 假设阶段
     让模型根据训练数据猜测一个变换规律
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v5_chain1_instructions(t))
+    
     system_message = """You are an expert at analyzing patterns and transformation rules in visual puzzles.
 Your task is to examine the training examples and propose a clear hypothesis about the transformation rule.
 Focus on being precise and testable."""
     
-    user_content = ""
-    user_content += """Analyze these training examples and propose a transformation rule:
+    parts = []
+    parts.append("""Analyze these training examples and propose a transformation rule:
 
-"""
+""")
     
     # 展示训练样本
-    for i, example in enumerate(d['train']):
-        user_content += f"Training Example {i+1}:\n"
-        user_content += f"Input:\n{json.dumps(example['input'])}\n"
-        user_content += f"Output:\n{json.dumps(example['output'])}\n\n"
+    for i in range(t.num_train):
+        parts.append(f"Training Example {i+1}:\n")
+        parts.append(f"Input:\n{t.train_inputs[i]}\n")
+        parts.append(f"Output:\n{t.train_outputs[i]}\n\n")
     
-    user_content += """Based on these examples, propose your hypothesis:
+    parts.append("""Based on these examples, propose your hypothesis:
 
 1. OBSERVATIONS: What patterns do you notice?
 2. HYPOTHESIS: State your hypothesis about the transformation rule clearly and precisely.
 
 Format your answer as:
 OBSERVATIONS: [your observations]
-HYPOTHESIS: [the transformation rule hypothesis]"""
+HYPOTHESIS: [the transformation rule hypothesis]""")
+    
+    system_message += grid_format_note(t.encoding, answer=None)
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
-def prompt_v5_reflexion_verify(d, hypothesis):
+def prompt_v5_reflexion_verify(d, hypothesis, encoding=None, layout=None):
     """
     V5 Reflexion - 验证阶段
     让模型用提出的假设验证训练数据
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v5_reflexion_instructions(t, hypothesis))
+    
     system_message = """You are an expert at validating hypotheses about transformation rules.
 Your task is to:
 1. Apply the given hypothesis to each training input
 2. Check if the result matches the expected training output
 3. If there's a mismatch, identify the error and suggest a correction"""
     
-    user_content = ""
-    user_content += f"""Given this hypothesis:
+    parts = []
+    parts.append(f"""Given this hypothesis:
 {hypothesis}
 
 Verify it against the training examples:
 
-"""
+""")
     
     # 展示训练样本用于验证
-    for i, example in enumerate(d['train']):
-        user_content += f"Training Example {i+1}:\n"
-        user_content += f"Input:\n{json.dumps(example['input'])}\n"
-        user_content += f"Expected Output:\n{json.dumps(example['output'])}\n\n"
+    for i in range(t.num_train):
+        parts.append(f"Training Example {i+1}:\n")
+        parts.append(f"Input:\n{t.train_inputs[i]}\n")
+        parts.append(f"Expected Output:\n{t.train_outputs[i]}\n\n")
     
-    user_content += """Now verify the hypothesis:
+    parts.append("""Now verify the hypothesis:
 
 For each example:
 1. Apply the hypothesis to the input
@@ -298,47 +685,120 @@ After checking all examples:
 - If all match, respond: "VERIFICATION: PASSED"
 - If any don't match, respond with the corrections needed:
   "VERIFICATION: FAILED - ERROR ANALYSIS: [explain what's wrong] - CORRECTED HYPOTHESIS: [new hypothesis]"
-"""
+""")
+    
+    system_message += grid_format_note(t.encoding, answer=None)
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
-def prompt_v5_chain2_predict(d, final_hypothesis):
+def prompt_v5_chain2_predict(d, final_hypothesis, encoding=None, layout=None):
     """
     V5 Chain 2 - 应用阶段
     使用验证过的假设来预测测试输出
     """
+    t = prepare_task(d, encoding)
+    if get_prompt_layout(layout) == "shared":
+        return _shared_messages(t, _v5_chain2_instructions(t, final_hypothesis))
+    
     system_message = """You are an expert at applying validated transformation rules to new inputs.
 Apply the given rule precisely to generate the output."""
     
-    user_content = ""
-    user_content += f"""Using this validated transformation rule:
+    parts = []
+    parts.append(f"""Using this validated transformation rule:
 {final_hypothesis}
 
 Apply it to the test input:
 
-"""
+""")
     
-    test_input = d['test'][0]['input']
-    user_content += f"Test Input:\n{json.dumps(test_input)}\n\n"
+    parts.append(f"Test Input:\n{t.test_input}\n\n")
     
-    user_content += """Generate the output:
+    parts.append("""Generate the output:
 
 Apply the rule step by step and provide:
 OUTPUT: [the predicted output as a 2D list]
-"""
+""")
+    
+    system_message += grid_format_note(t.encoding)
     
     messages = [
         {"role": "system", "content": system_message},
-        {"role": "user", "content": user_content}
+        {"role": "user", "content": "".join(parts)}
     ]
     return messages
 
 
+# ============================================================================
+# V5 对话模式（V5_MODE=conversation）
+# ============================================================================
+#
+# chain 模式（默认）的三个阶段各自是独立请求，每次都重新发送训练样本。
+# 对话模式下三个阶段是同一段对话：Chain 1 的 messages 之后依次追加模型的回答
+# 和下一阶段的说明。每次请求都以上一次请求（连同模型回答）为逐字节相同的前缀，
+# 服务端的 prompt 缓存可以覆盖之前的全部内容，模型也能看到自己之前的分析。
+
+V5_MODES = ("chain", "conversation")
+
+
+def get_v5_mode(mode=None):
+    """
+    返回 V5 的运行方式：mode 不为 None 时直接使用，否则读取环境变量 V5_MODE（默认 chain）
+    """
+    if mode is None:
+        mode = os.getenv("V5_MODE", "chain")
+    mode = mode.strip().lower()
+    if mode not in V5_MODES:
+        raise ValueError(f"Unknown V5 mode: {mode} (expected one of {', '.join(V5_MODES)})")
+    return mode
+
+
+def prompt_v5_conversation_verify(d, history, chain1_reply, hypothesis, encoding=None):
+    """
+    V5 对话模式 - 验证阶段
+    在 Chain 1 的对话之后追加模型的假设和验证说明（训练样本不再重复发送）
+
+    参数:
+    d: ARC 任务字典或 PreparedTask
+    history (list): Chain 1 的 messages（prompt_v5_chain1_hypothesis 的返回值）
+    chain1_reply (str): 模型在 Chain 1 的回答
+    hypothesis (str): 从回答中提取的假设
+
+    返回:
+    list: 新的 messages（不修改 history）
+    """
+    t = prepare_task(d, encoding)
+    return history + [
+        {"role": "assistant", "content": chain1_reply},
+        {"role": "user", "content": _v5_reflexion_instructions(t, hypothesis)}
+    ]
+
+
+def prompt_v5_conversation_predict(d, history, reflexion_reply, final_hypothesis, encoding=None):
+    """
+    V5 对话模式 - 应用阶段
+    在验证阶段的对话之后追加模型的验证结果、测试输入和输出要求
+
+    参数:
+    d: ARC 任务字典或 PreparedTask
+    history (list): 验证阶段的 messages（prompt_v5_conversation_verify 的返回值）
+    reflexion_reply (str): 模型在验证阶段的回答
+    final_hypothesis (str): 验证或修正后的假设
+
+    返回:
+    list: 新的 messages（不修改 history）
+    """
+    t = prepare_task(d, encoding)
+    return history + [
+        {"role": "assistant", "content": reflexion_reply},
+        {"role": "user", "content": _v5_chain2_instructions(t, final_hypothesis)}
+    ]
+
+
 def get_prompt_function(version=1):
     """
     获取指定版本的提示词函数
@@ -359,17 +819,19 @@ def get_prompt_function(version=1):
     return prompt_functions.get(version, prompt_v1_simple)
 
 
-def construct_prompt(d, version=1):
+def construct_prompt(d, version=1, encoding=None, layout=None):
     """
     通用提示词构造函数
     
     参数:
     d (dict): ARC 任务数据
     version (int): 使用哪个版本的提示词 (1-4)
+    encoding (str): 网格格式（json / rows / rle / sparse，见 grid_codec.py），默认按 GRID_ENCODING
+    layout (str): 提示词布局（shared / legacy），默认按 PROMPT_LAYOUT
     
     返回:
     list: OpenAI API 格式的 messages
     """
     prompt_func = get_prompt_function(version)
-    return prompt_func(d)
+    return prompt_func(d, encoding=encoding, layout=layout)
 
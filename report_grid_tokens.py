@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+统计各网格格式（grid_codec.py）在数据集上的 tokens 数
+
+对每个数据集、每种格式报告：
+- 所有网格（train 输入输出 + 测试输入）序列化后的 tokens 总数
+- V1-V4 与 V5 三个阶段提示词的平均 tokens 数
+- 与 json 格式相比节省的比例
+同时检查每个网格编码后能否原样解码回来。
+
+计数优先使用 tiktoken（可选依赖: pip install tiktoken，编码由 TOKENIZER_ENCODING 指定，
+默认 cl100k_base）；未安装时用近似 BPE 预切分的正则估计（数字按 1-3 位一组）。
+
+用法:
+    python report_grid_tokens.py [val.jsonl val_hard.jsonl]
+"""
+
+import os
+import sys
+import json
+import importlib.util
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from grid_codec import GRID_ENCODINGS, encode_grid, decode_grid
+from prompt import (construct_prompt, estimate_text_tokens, prompt_v5_chain1_hypothesis,
+                    prompt_v5_reflexion_verify, prompt_v5_chain2_predict)
+
+
+def get_token_counter():
+    """
+    返回 (计数函数, 说明)
+    """
+    if importlib.util.find_spec("tiktoken") is not None:
+        import tiktoken
+        name = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+        encoder = tiktoken.get_encoding(name)
+        return (lambda text: len(encoder.encode(text))), f"tiktoken {name}"
+    return estimate_text_tokens, "approximate (tiktoken not installed)"
+
+
+def load_jsonl(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def task_grids(task):
+    grids = []
+    for example in task['train']:
+        grids.append(example['input'])
+        grids.append(example['output'])
+    grids.append(task['test'][0]['input'])
+    return grids
+
+
+def prompt_builders(encoding):
+    """
+    各提示词（名称, 构造函数）；V5 的验证 / 预测阶段用固定的占位假设
+    """
+    hypothesis = "Recolor every object according to its size."
+    return [
+        ("V1", lambda d: construct_prompt(d, 1, encoding=encoding)),
+        ("V2", lambda d: construct_prompt(d, 2, encoding=encoding)),
+        ("V3", lambda d: construct_prompt(d, 3, encoding=encoding)),
+        ("V4", lambda d: construct_prompt(d, 4, encoding=encoding)),
+        ("V5-1", lambda d: prompt_v5_chain1_hypothesis(d, encoding=encoding)),
+        ("V5-R", lambda d: prompt_v5_reflexion_verify(d, hypothesis, encoding=encoding)),
+        ("V5-2", lambda d: prompt_v5_chain2_predict(d, hypothesis, encoding=encoding)),
+    ]
+
+
+def main():
+    paths = sys.argv[1:] or ["val.jsonl", "val_hard.jsonl"]
+    count_tokens, tokenizer_name = get_token_counter()
+
+    print("=" * 100)
+    print(f"Grid encoding token report (tokenizer: {tokenizer_name})")
+    print("=" * 100)
+
+    for path in paths:
+        tasks = load_jsonl(path)
+        grids = [grid for task in tasks for grid in task_grids(task)]
+        print(f"\n{path}: {len(tasks)} tasks, {len(grids)} grids, {sum(len(g) * len(g[0]) for g in grids)} cells")
+
+        names = [name for name, _ in prompt_builders("json")]
+        print(f"  {'encoding':<9}{'grid tokens':>12}{'saved':>8}{'roundtrip':>11}  "
+              + "".join(f"{name:>8}" for name in names) + "   (avg prompt tokens)")
+
+        baseline = None
+        for encoding in GRID_ENCODINGS:
+            grid_tokens = sum(count_tokens(encode_grid(grid, encoding)) for grid in grids)
+            roundtrip = sum(decode_grid(encode_grid(grid, encoding), encoding) == grid for grid in grids)
+            averages = []
+            for _, build in prompt_builders(encoding):
+                total = sum(count_tokens(m["content"]) for task in tasks for m in build(task))
+                averages.append(total / len(tasks))
+            if baseline is None:
+                baseline = grid_tokens
+            saved = 1 - grid_tokens / baseline if baseline else 0.0
+            print(f"  {encoding:<9}{grid_tokens:>12}{saved:>8.1%}{f'{roundtrip}/{len(grids)}':>11}  "
+                  + "".join(f"{avg:>8.0f}" for avg in averages))
+
+    print("\n" + "=" * 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+response_cache.py - 模型回答的持久化缓存
+
+以请求内容的哈希为键（内容寻址），把模型回答压缩后存入 SQLite：
+- 键覆盖 messages / model / temperature / max_tokens / sample_index
+- 按总大小做 LRU 淘汰
+- 统计命中 / 未命中次数
+- replay（只读回放）模式：只读缓存，不写入也不发起新请求
+
+修改 parse_output 或报告代码后重新运行评测时，所有回答都直接从缓存读取。
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import urllib.parse
+
+
+class CacheMissError(Exception):
+    """
+    回放模式下请求的回答不在缓存中
+    """
+    pass
+
+
+def make_cache_key(messages, model, temperature, max_tokens, sample_index=0):
+    """
+    计算请求的缓存键
+
+    参数:
+    messages: 对话消息列表
+    model: 模型名称
+    temperature: 采样温度
+    max_tokens: 最大生成 tokens
+    sample_index: 采样序号（同一请求的第几个采样）
+
+    返回:
+    str: sha256 十六进制字符串
+    """
+    payload = {
+        "messages": messages,
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "sample_index": sample_index,
+    }
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    基于 SQLite 的回答缓存（线程安全）
+
+    参数:
+    path: SQLite 文件路径
+    max_bytes: 压缩后数据的总大小上限，超出后按最近访问时间淘汰
+    readonly: 只读回放模式，不写入新回答、不更新访问时间；以只读方式打开已有的文件，
+              文件不存在时抛出 FileNotFoundError
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, readonly=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if readonly:
+            # 回放时以只读方式打开已有的缓存：路径写错时直接报错，而不是新建一个空库让每个请求都未命中
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Response cache not found: {path} (replay mode needs an existing cache)")
+            uri = "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            # 不是回答缓存（没有 responses 表）时在这里抛出 sqlite3.OperationalError
+            self._conn.execute("SELECT 1 FROM responses LIMIT 1").fetchall()
+            return
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+        self._conn.commit()
+
+    def get(self, key):
+        """
+        读取缓存的回答，未命中返回 None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if not self.readonly:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key, text):
+        """
+        写入回答；只读模式下忽略
+        """
+        if self.readonly or text is None:
+            return
+
+        value = zlib.compress(text.encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """
+        总大小超过上限时，按最近访问时间从旧到新删除，直到降到上限的 90%
+        """
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        """
+        返回缓存统计信息
+
+        返回:
+        dict: "hits" / "misses" / "hit_rate" / "entries" / "size_bytes"
+        """
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    按环境变量获取共享的回答缓存，未启用时返回 None
+
+    环境变量:
+    RESPONSE_CACHE_PATH: SQLite 文件路径，为空表示不启用缓存
+    RESPONSE_CACHE_MAX_MB: 缓存大小上限（MB），默认 512
+    RESPONSE_CACHE_MODE: "readwrite"（默认）或 "replay"（只读回放，未命中即报错）
+    """
+    global _cache
+    path = os.getenv("RESPONSE_CACHE_PATH", "")
+    if not path:
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                max_bytes = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "512")) * 1024 * 1024)
+                readonly = os.getenv("RESPONSE_CACHE_MODE", "readwrite") == "replay"
+                _cache = ResponseCache(path, max_bytes=max_bytes, readonly=readonly)
+    return _cache
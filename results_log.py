@@ -0,0 +1,82 @@
+"""
+results_log.py - 评测结果的追加式日志（断点续跑）
+
+每完成一个任务就向 jsonl 文件追加一行记录并立即落盘：
+任务下标、模型原始回答、解析出的网格、真值、耗时、投票统计，
+以及任务出错时的错误信息（"error"，例如超过截止时间、API 错误、回放缓存未命中）。
+评测中途崩溃或被 Ctrl-C 中断后，可用 --resume 跳过已完成的任务，
+并从日志重建最终准确率和 output.md 报告；出错的任务不算完成，续跑时重新执行。
+"""
+
+import os
+import json
+import threading
+
+
+class ResultsLog:
+    """
+    追加式结果日志（线程安全）
+
+    参数:
+    path: jsonl 文件路径
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """
+        清空日志，开始新的一次评测
+        """
+        with self._lock:
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+
+    def append(self, record):
+        """
+        追加一条任务记录，并 fsync 保证进程崩溃后记录仍然存在
+
+        参数:
+        record: dict，需包含 "index" 字段
+        """
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self, include_errors=False, **match):
+        """
+        读取已完成的任务记录
+
+        参数:
+        include_errors: 是否包含出错的任务记录（"error" 字段非空），默认不包含，
+                        这些任务在续跑时重新执行，一次偶然的失败不会变成最终结果
+        match: 需要匹配的字段（例如 prompt_version=3, data_path="val.jsonl"），
+               字段值不一致的记录会被忽略，避免混用不同配置的结果
+
+        返回:
+        dict: 任务下标 -> 记录；同一任务有多条记录时以最后一条为准
+        """
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时可能留下写了一半的最后一行，跳过即可
+                    continue
+                if any(record.get(key) != value for key, value in match.items()):
+                    continue
+                if record.get("error") and not include_errors:
+                    continue
+                records[record["index"]] = record
+
+        return records
@@ -0,0 +1,428 @@
+"""
+sandbox.py - 在独立进程中执行模型生成的 transform 代码
+
+V4（PAL）会执行模型写出的代码。直接在评测进程里 exec 时，一个死循环就会卡住整个评测，
+一次超大的内存分配也可能拖垮进程。这里维护一个预先启动的工作进程池：
+- 每次执行由一个空闲的工作进程完成，工作进程反复使用，不需要每次都启动新进程
+- 每次执行有墙钟超时，超时的工作进程直接杀掉并补上一个新的
+- 工作进程启动时用 RLIMIT_AS 限制地址空间（在当前用量的基础上增加上限），
+  超出时代码里会抛出 MemoryError，不影响评测进程
+- 不能 import BLOCKED_MODULES 中的模块（os、subprocess、socket 等），
+  并去掉 open、eval、exec 等几个内置函数（见 SAFE_BUILTINS），避免模型代码误用；这不是安全边界（例如模块对象仍可拿到完整的 builtins），隔离依靠独立的工作进程和 rlimit
+- 已编译的代码和执行结果按规范化源码缓存（见 code_cache.py），重复的代码 / 输入不再重复编译和执行
+
+工作进程通过 forkserver（不支持时用 spawn）启动，启动时会重新导入主脚本：
+调用 execute_transform_code 等函数的脚本必须把入口放在 if __name__ == "__main__": 之下，
+否则工作进程会重新执行脚本的顶层代码并启动失败。此时 get_sandbox_pool() 打印警告，
+退回到在当前进程内执行（与 SANDBOX_WORKERS=0 相同，没有超时和内存限制）。
+
+环境变量:
+SANDBOX_WORKERS: 工作进程数，默认 min(4, CPU 数)；0 表示不使用进程池，在当前进程内执行（没有超时和内存限制）
+SANDBOX_TIMEOUT_SECONDS: 单次执行的超时（秒），默认 5
+SANDBOX_MEMORY_MB: 每个工作进程可额外使用的内存（MB），默认 512，0 表示不限制
+"""
+
+import os
+import json
+import queue
+import atexit
+import builtins
+import threading
+import multiprocessing
+
+from code_cache import code_key, grid_key, compile_transform, get_result_cache, copy_output
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不限制内存
+    resource = None
+
+
+# 模型代码不能 import 的模块：访问文件系统、进程、网络和解释器底层的模块；其他模块（sys、re、random、
+# numpy 等）与原来在评测进程中 exec 时一样可以 import
+BLOCKED_MODULES = frozenset({
+    "os", "posix", "nt", "io", "pathlib", "shutil", "tempfile", "glob", "subprocess", "pty", "signal",
+    "multiprocessing", "threading", "_thread", "socket", "ssl", "select", "selectors", "asyncio", "urllib",
+    "http", "ftplib", "smtplib", "ctypes", "importlib", "builtins", "resource", "fcntl", "mmap", "pickle",
+})
+
+
+def _safe_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name.split(".")[0] in BLOCKED_MODULES:
+        raise ImportError(f"import of '{name}' is not allowed in the sandbox")
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+
+# 从 builtins 中去掉的名字：读写文件、动态执行代码、读取输入和解释器状态
+BLOCKED_BUILTINS = frozenset({"open", "eval", "exec", "compile", "input", "breakpoint", "globals", "vars"})
+
+# 代码可用的内置函数：完整的 builtins（类、super、getattr、各种异常等）去掉 BLOCKED_BUILTINS
+SAFE_BUILTINS = {name: value for name, value in builtins.__dict__.items() if name not in BLOCKED_BUILTINS}
+SAFE_BUILTINS["__import__"] = _safe_import
+
+
+class SandboxError(Exception):
+    """代码执行失败（异常、超时、内存超限、工作进程崩溃）"""
+    pass
+
+
+class SandboxTimeout(SandboxError):
+    """代码执行超时"""
+    pass
+
+
+def _load_transform(code, key=None):
+    exec_globals = {
+        "__builtins__": SAFE_BUILTINS,
+        "__name__": "sandbox_transform",
+        "json": json,
+    }
+    exec(compile_transform(code, key), exec_globals)
+    return exec_globals.get("transform")
+
+
+def run_transform(code, test_input):
+    """
+    在 SAFE_BUILTINS 下执行 code，并用 test_input 调用其中的 transform 函数
+
+    参数:
+    code (str): 包含 transform 函数的 Python 代码
+    test_input: 测试输入网格
+
+    返回:
+    transform 的返回值；代码中没有 transform 函数时返回 None
+    """
+    transform_func = _load_transform(code)
+    if transform_func is None:
+        return None
+    return transform_func(test_input)
+
+
+def run_transform_batch(code, inputs, key=None):
+    """
+    执行一次 code，再对每个输入分别调用 transform；某个输入抛出异常不影响其余输入
+
+    参数:
+    code (str): 包含 transform 函数的 Python 代码
+    inputs (list): 输入网格列表
+    key (str): code_key(code)，用于查找已编译的代码；调用方已经算过时传入
+
+    返回:
+    list: 每个输入一项，("ok", transform 的返回值) 或 ("error", 错误信息)；
+          没有 transform 函数时每项为 ("ok", None)
+    """
+    transform_func = _load_transform(code, key)
+    if transform_func is None:
+        return [("ok", None)] * len(inputs)
+    outcomes = []
+    for grid in inputs:
+        try:
+            outcomes.append(("ok", transform_func(grid)))
+        except Exception as e:
+            outcomes.append(("error", f"{type(e).__name__}: {e}"))
+    return outcomes
+
+
+def _limit_memory(memory_mb):
+    """
+    把地址空间上限设为当前用量 + memory_mb
+    """
+    if resource is None or memory_mb <= 0:
+        return
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = 0
+    limit = current + memory_mb * 1024 * 1024
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ValueError, OSError):
+        pass
+
+
+def _worker_main(conn, memory_mb):
+    """
+    工作进程主循环：接收 (code, key, inputs)，返回 ("ok", run_transform_batch 的结果) 或 ("error", 错误信息)
+    """
+    _limit_memory(memory_mb)
+    # 启动完成（forkserver / spawn 下包括导入主模块），可以接收代码
+    conn.send("ready")
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        code, key, inputs = request
+        try:
+            reply = ("ok", run_transform_batch(code, inputs, key))
+        except BaseException as e:
+            reply = ("error", f"{type(e).__name__}: {e}")
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # 结果无法序列化等情况
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, context, memory_mb):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout=60):
+        """
+        等待工作进程启动完成，避免第一次执行承担启动开销
+
+        异常:
+        SandboxError: 工作进程没有在 timeout 秒内启动
+        """
+        try:
+            if self.conn.poll(timeout) and self.conn.recv() == "ready":
+                return
+        except (EOFError, OSError):
+            pass
+        self.kill()
+        raise SandboxError("sandbox worker failed to start")
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    """
+    预先启动的工作进程池（线程安全，可在多个评测线程中同时使用）
+
+    参数:
+    workers (int): 工作进程数
+    timeout (float): 单次执行的超时（秒）
+    memory_mb (int): 每个工作进程可额外使用的内存（MB），0 表示不限制
+    """
+
+    def __init__(self, workers=4, timeout=5.0, memory_mb=512):
+        # 不直接 fork：进程池在评测线程中懒创建，超时后也会补建工作进程，此时进程里有多个线程，
+        # fork 出的子进程可能继承被其他线程持有的锁（import、logging 等）。forkserver 从一个
+        # 单线程的服务进程 fork 工作进程，并预先导入本模块；不支持时（Windows 等）用 spawn
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("forkserver")
+            self._context.set_forkserver_preload([__name__])
+        else:
+            self._context = multiprocessing.get_context("spawn")
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.restarts = 0
+        self._closed = False
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        # 先启动全部工作进程，再逐个等待就绪，启动过程互相重叠
+        self._all = [_Worker(self._context, memory_mb) for _ in range(max(1, workers))]
+        try:
+            for worker in self._all:
+                worker.wait_ready()
+                self._idle.put(worker)
+        except SandboxError:
+            for worker in self._all:
+                worker.kill()
+            raise
+
+    def _replace(self, worker):
+        worker.kill()
+        replacement = _Worker(self._context, self.memory_mb)
+        replacement.wait_ready()
+        with self._lock:
+            self._all[self._all.index(worker)] = replacement
+            self.restarts += 1
+        return replacement
+
+    def run(self, code, test_input, timeout=None):
+        """
+        在空闲的工作进程中执行 run_transform(code, test_input)
+
+        参数:
+        code (str): 包含 transform 函数的 Python 代码
+        test_input: 测试输入网格
+        timeout (float): 本次执行的超时（秒），默认使用池的设置
+
+        返回:
+        transform 的返回值（没有 transform 函数时为 None）
+
+        异常:
+        SandboxError: 代码抛出异常、内存超限或工作进程崩溃（超时为 SandboxTimeout）
+        """
+        status, value = self.run_batch(code, [test_input], timeout)[0]
+        if status == "error":
+            raise SandboxError(value)
+        return value
+
+    def run_batch(self, code, inputs, timeout=None, key=None):
+        """
+        在一个空闲的工作进程中执行 run_transform_batch(code, inputs)：代码只执行一次，
+        只有一次进程间往返；超时针对整批输入。key 为 code_key(code)（可选）
+
+        返回:
+        list: 每个输入一项，("ok", 返回值) 或 ("error", 错误信息)
+
+        异常:
+        SandboxError: 代码本身执行失败、超时（SandboxTimeout）或工作进程崩溃
+        """
+        if self._closed:
+            raise SandboxError("sandbox pool is closed")
+        timeout = self.timeout if timeout is None else timeout
+        worker = self._idle.get()
+        try:
+            worker.conn.send((code, key, list(inputs)))
+            if not worker.conn.poll(timeout):
+                worker = self._replace(worker)
+                raise SandboxTimeout(f"timed out after {timeout:g}s")
+            status, value = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # 工作进程意外退出（例如被系统杀掉），补上一个新的
+            worker = self._replace(worker)
+            raise SandboxError(f"worker exited unexpectedly ({type(e).__name__})")
+        finally:
+            self._idle.put(worker)
+        if status == "error":
+            raise SandboxError(value)
+        return value
+
+    def close(self):
+        """
+        停止所有工作进程
+        """
+        self._closed = True
+        with self._lock:
+            workers, self._all = self._all, []
+        for worker in workers:
+            worker.stop()
+
+
+def get_sandbox_config():
+    """
+    从环境变量读取沙箱配置
+
+    返回:
+    dict: "workers" / "timeout" / "memory_mb"
+    """
+    return {
+        "workers": int(os.getenv("SANDBOX_WORKERS", str(min(4, os.cpu_count() or 1)))),
+        "timeout": float(os.getenv("SANDBOX_TIMEOUT_SECONDS", "5")),
+        "memory_mb": int(os.getenv("SANDBOX_MEMORY_MB", "512")),
+    }
+
+
+_pool = None
+_pool_unavailable = False
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool():
+    """
+    获取进程内共享的沙箱进程池（首次调用时创建，线程安全）；SANDBOX_WORKERS=0 时返回 None。
+    工作进程无法启动时（通常是调用脚本缺少 if __name__ == "__main__": 保护）打印警告并返回 None，
+    之后在当前进程内执行
+    """
+    global _pool, _pool_unavailable
+    if _pool is None and not _pool_unavailable:
+        with _pool_lock:
+            if _pool is None and not _pool_unavailable:
+                config = get_sandbox_config()
+                if config["workers"] <= 0:
+                    return None
+                try:
+                    _pool = SandboxPool(**config)
+                except SandboxError as e:
+                    _pool_unavailable = True
+                    print(f"Warning: {e}, executing code in-process without timeout or memory limit "
+                          f"(the main script needs an if __name__ == \"__main__\": guard)")
+    return _pool
+
+
+def close_sandbox_pool():
+    """
+    停止共享的沙箱进程池；之后再调用 get_sandbox_pool() 会按当前环境变量重新创建
+    """
+    global _pool, _pool_unavailable
+    with _pool_lock:
+        _pool_unavailable = False
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+atexit.register(close_sandbox_pool)
+
+
+def execute_in_sandbox(code, test_input):
+    """
+    执行 code 中的 transform(test_input)，见 execute_batch_in_sandbox
+
+    返回:
+    transform 的返回值（没有 transform 函数时为 None）
+
+    异常:
+    SandboxError: 执行失败
+    """
+    status, value = execute_batch_in_sandbox(code, [test_input])[0]
+    if status == "error":
+        raise SandboxError(value)
+    return value
+
+
+# 与工作进程当时的状态（已用内存、调用栈深度）有关、不只取决于 (代码, 输入) 的错误，不写入结果缓存
+TRANSIENT_ERRORS = ("MemoryError", "RecursionError")
+
+
+def _is_transient(outcome):
+    status, value = outcome
+    return status == "error" and str(value).split(":", 1)[0] in TRANSIENT_ERRORS
+
+
+def execute_batch_in_sandbox(code, inputs):
+    """
+    对每个输入执行 code 中的 transform（代码只执行一次）：默认在共享进程池中执行，
+    SANDBOX_WORKERS=0 时在当前进程内执行。已缓存的 (代码, 输入) 直接返回缓存的结果，
+    只把其余输入发给沙箱；MemoryError / RecursionError（TRANSIENT_ERRORS）的结果不缓存
+
+    返回:
+    list: 每个输入一项，("ok", 返回值) 或 ("error", 错误信息)
+
+    异常:
+    SandboxError: 代码本身执行失败、超时（SandboxTimeout）或工作进程崩溃
+    """
+    key = code_key(code)
+    results = get_result_cache()
+    keys = [(key, grid_key(grid)) for grid in inputs]
+    outcomes = [results.get(result_key) for result_key in keys]
+    missing = [i for i, outcome in enumerate(outcomes) if outcome is None]
+    if missing:
+        pending = [inputs[i] for i in missing]
+        pool = get_sandbox_pool()
+        if pool is not None:
+            fresh = pool.run_batch(code, pending, key=key)
+        else:
+            try:
+                fresh = run_transform_batch(code, pending, key)
+            except Exception as e:
+                raise SandboxError(f"{type(e).__name__}: {e}")
+        for i, outcome in zip(missing, fresh):
+            if not _is_transient(outcome):
+                results.put(keys[i], outcome)
+            outcomes[i] = outcome
+    return [(status, copy_output(value)) for status, value in outcomes]
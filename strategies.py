@@ -0,0 +1,500 @@
+"""
+strategies.py - 提示词策略注册表与声明式阶段执行器
+
+每个策略（V1-V5）声明自己由哪些阶段组成，而不是在评测主循环里写 if/elif 分支：
+- "prompt"：构造 messages（计入 timed("prompt")）
+- "call"：调用模型（在 call_stage(metric) 中运行，经过回答缓存和调用策略层）
+- "parse" / "vote"：解析回答、投票（计入 timed("parse")）
+- "execute"：执行代码（计入 timed("execute")）
+- "verify"：核对假设或程序（计入 timed("verify")）
+
+阶段之间的依赖用 needs 声明（默认依赖上一个阶段）。run_strategy 按依赖分批执行，
+同一批中互不依赖的阶段在线程池中并发运行（通过 submit_with_context，
+计时、调用统计和任务截止时间照常生效）。
+
+模型调用函数由调用方通过 TaskContext.calls 传入（test_prompt.MODEL_CALLS），
+本模块不依赖 test_prompt。新增策略只需 register_strategy，不需要改评测主循环：
+
+    register_strategy(Strategy(6, "my-strategy", "...", lambda config: [
+        Stage("messages", "prompt", lambda ctx: construct_prompt(ctx.prepared, version=1)),
+        Stage("reply", "call", lambda ctx: ctx.call(ctx["messages"])),
+        Stage("predicted", "parse", lambda ctx: parse_grid(ctx["reply"]), record="one"),
+    ]))
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timed, call_stage, record_parse
+from call_policy import submit_with_context
+from prompt import (prepare_task, construct_prompt, prompt_v4_repair, prompt_v5_chain1_hypothesis,
+                    prompt_v5_reflexion_verify, prompt_v5_chain2_predict, prompt_v5_conversation_verify,
+                    prompt_v5_conversation_predict)
+from grid import as_grid
+from template import (parse_grid, voting_grids, get_voting_stats, extract_python_code, execute_transform_code,
+                      verify_transform_code, group_programs, extract_hypothesis, extract_corrected_hypothesis)
+
+
+# 各类阶段的本地耗时计入哪一项（"call" 的耗时由调用记录统计）
+_STAGE_TIMERS = {
+    "prompt": "prompt",
+    "parse": "parse",
+    "vote": "parse",
+    "execute": "execute",
+    "verify": "verify",
+}
+STAGE_KINDS = ("prompt", "call", "parse", "vote", "execute", "verify")
+
+
+class Stage:
+    """
+    策略中的一个阶段
+
+    参数:
+    name (str): 阶段名，结果保存为 ctx[name]
+    kind (str): 阶段类型，STAGE_KINDS 之一
+    run (callable): run(ctx) -> 结果
+    needs (tuple): 依赖的阶段名；None 表示依赖上一个阶段，() 表示没有依赖
+    metric (str): 调用记录中的阶段标签（call_stage / record_parse 使用），默认 "predict"
+    when (callable): when(ctx) 为假时跳过本阶段（结果为 None）
+    record (str): 把结果回填到调用记录："one"（单个结果）、"all"（结果列表）或 None
+    """
+
+    __slots__ = ("name", "kind", "run", "needs", "metric", "when", "record")
+
+    def __init__(self, name, kind, run, needs=None, metric="predict", when=None, record=None):
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"Unknown stage kind: {kind} (expected one of {', '.join(STAGE_KINDS)})")
+        self.name = name
+        self.kind = kind
+        self.run = run
+        self.needs = needs
+        self.metric = metric
+        self.when = when
+        self.record = record
+
+
+class Strategy:
+    """
+    一个提示词策略
+
+    参数:
+    version (int): 版本号（PROMPT_VERSION）
+    name (str): 名称
+    description (str): 日志中显示的说明
+    build_stages (callable): build_stages(config) -> [Stage]，可按配置（如 V3_EARLY_STOP）选择阶段
+    output (str): 作为最终预测的阶段名
+    """
+
+    __slots__ = ("version", "name", "description", "build_stages", "output")
+
+    def __init__(self, version, name, description, build_stages, output="predicted"):
+        self.version = version
+        self.name = name
+        self.description = description
+        self.build_stages = build_stages
+        self.output = output
+
+
+class TaskContext:
+    """
+    一个任务执行策略时的状态：各阶段的结果、按调用顺序的模型回答和投票统计
+
+    参数:
+    task (dict): ARC 任务
+    config (dict): 评测配置（model_name / temperature / num_samples_v3 / v5_mode 等）
+    calls: 提供 speak_and_listen / speak_and_listen_multiple / speak_and_listen_adaptive 的对象
+    log (callable): 日志输出函数
+    prepared (PreparedTask): 预处理过的任务，默认在这里 prepare_task
+    """
+
+    def __init__(self, task, config, calls, log=print, prepared=None):
+        self.task = task
+        self.config = config
+        self.calls = calls
+        self.log = log
+        self.prepared = prepared if prepared is not None else prepare_task(task)
+        self.values = {}
+        self.replies = []
+        self.voting_stats = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def call(self, messages, **kwargs):
+        """
+        调用一次模型（speak_and_listen），回答按调用顺序记入 replies
+        """
+        reply = self.calls.speak_and_listen(messages, self.config["model_name"], self.config["temperature"], **kwargs)
+        self.add_replies([reply])
+        return reply
+
+    def add_replies(self, replies):
+        with self._lock:
+            self.replies.extend(replies)
+
+
+_strategies = {}
+
+
+def register_strategy(strategy):
+    """
+    注册策略；同一版本号再次注册时覆盖
+    """
+    _strategies[strategy.version] = strategy
+    return strategy
+
+
+def get_strategy(version):
+    """
+    返回版本号对应的策略
+
+    参数:
+    version (int): 版本号
+
+    返回:
+    Strategy
+    """
+    if version not in _strategies:
+        raise ValueError(f"Unknown prompt version: {version} (registered: {', '.join(map(str, sorted(_strategies)))})")
+    return _strategies[version]
+
+
+def list_strategies():
+    return [_strategies[version] for version in sorted(_strategies)]
+
+
+def _run_stage(stage, ctx):
+    if stage.when is not None and not stage.when(ctx):
+        return None
+    if stage.kind == "call":
+        with call_stage(stage.metric):
+            value = stage.run(ctx)
+    else:
+        with timed(_STAGE_TIMERS[stage.kind]):
+            value = stage.run(ctx)
+    if stage.record == "one":
+        record_parse([value], stage=stage.metric)
+    elif stage.record == "all":
+        record_parse(value, stage=stage.metric)
+    return value
+
+
+def run_strategy(strategy, ctx):
+    """
+    执行策略的全部阶段，返回最终预测（strategy.output 阶段的结果，没有时为空列表）
+
+    依赖都已完成的阶段组成一批；一批中有多个阶段时在线程池中并发执行。
+
+    参数:
+    strategy (Strategy): 要执行的策略
+    ctx (TaskContext): 任务状态，各阶段结果写入 ctx.values
+    """
+    stages = strategy.build_stages(ctx.config)
+    needs = {}
+    previous = None
+    for stage in stages:
+        needs[stage.name] = tuple(stage.needs) if stage.needs is not None else ((previous,) if previous else ())
+        previous = stage.name
+
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending if all(name in ctx.values for name in needs[stage.name])]
+        if not ready:
+            raise ValueError(f"Strategy {strategy.name}: unsatisfiable stage dependencies "
+                             f"({', '.join(stage.name for stage in pending)})")
+        pending = [stage for stage in pending if stage not in ready]
+        if len(ready) == 1:
+            ctx.values[ready[0].name] = _run_stage(ready[0], ctx)
+            continue
+        with ThreadPoolExecutor(max_workers=len(ready)) as executor:
+            futures = [submit_with_context(executor, _run_stage, stage, ctx) for stage in ready]
+            for stage, future in zip(ready, futures):
+                ctx.values[stage.name] = future.result()
+
+    return ctx.values.get(strategy.output) or []
+
+
+# ============================================================================
+# V1 / V2：单次调用
+# ============================================================================
+
+def _single_call_stages(version):
+    def call(ctx):
+        call_info = {}
+        reply = ctx.call(ctx["messages"], call_info=call_info)
+        if call_info.get("stream_time") is not None:
+            ctx.log(f"  Stream: prediction at {call_info['prediction_time']:.2f}s, "
+                    f"stream closed at {call_info['stream_time']:.2f}s"
+                    f"{' (cancelled after OUTPUT grid)' if call_info['cancelled'] else ''}")
+        return reply
+
+    return lambda config: [
+        Stage("messages", "prompt", lambda ctx: construct_prompt(ctx.prepared, version=version)),
+        Stage("reply", "call", call),
+        Stage("predicted", "parse", lambda ctx: parse_grid(ctx["reply"]), record="one"),
+    ]
+
+
+# ============================================================================
+# V3：自我一致性投票
+# ============================================================================
+
+def _v3_stages(config):
+    num_samples = config["num_samples_v3"]
+    policy = config.get("voting_policy", "exact")
+
+    def sample(ctx):
+        ctx.log(f"  Using self-consistency voting with {num_samples} samples...")
+        replies = ctx.calls.speak_and_listen_multiple(ctx["messages"], ctx.config["model_name"],
+                                                      num_samples=num_samples, log=ctx.log)
+        ctx.add_replies(replies)
+        return replies
+
+    def sample_adaptive(ctx):
+        # 自适应投票：投票结果确定后提前停止采样（解析和投票在采样循环中完成）
+        ctx.log(f"  Using adaptive self-consistency voting with up to {num_samples} samples...")
+        replies, grids, ctx.voting_stats = ctx.calls.speak_and_listen_adaptive(
+            ctx["messages"], ctx.config["model_name"], max_samples=num_samples,
+            min_samples=ctx.config.get("v3_min_samples"),
+            confidence_threshold=ctx.config.get("v3_confidence_threshold"),
+            policy=policy, log=ctx.log
+        )
+        ctx.add_replies(replies)
+        return grids
+
+    def vote(ctx):
+        grids = ctx["grids"]
+        if ctx.voting_stats is None:
+            ctx.voting_stats = get_voting_stats(grids, policy)
+        stats = ctx.voting_stats
+        ctx.log(f"  Voting: {stats['valid_predictions']} valid predictions")
+        ctx.log(f"  Winner appeared {stats['winning_count']} times")
+        ctx.log(f"  Confidence: {stats['confidence']:.2%}")
+        if policy == "cell":
+            ctx.log(f"  Cell consensus: {stats['shape_count']} same-shape predictions, "
+                    f"{stats['contested_cells']} contested cells")
+        if "samples_used" in stats:
+            ctx.log(f"  Samples used: {stats['samples_used']}/{stats['max_samples']}")
+        return voting_grids(grids, policy)
+
+    stages = [Stage("messages", "prompt", lambda ctx: construct_prompt(ctx.prepared, version=3))]
+    if config.get("v3_early_stop", False):
+        stages.append(Stage("grids", "call", sample_adaptive, metric="sample"))
+    else:
+        stages.append(Stage("replies", "call", sample, metric="sample"))
+        stages.append(Stage("grids", "parse", lambda ctx: [parse_grid(text) for text in ctx["replies"]],
+                            metric="sample", record="all"))
+    stages.append(Stage("predicted", "vote", vote))
+    return stages
+
+
+# ============================================================================
+# V4：PAL（生成代码并执行）
+# ============================================================================
+
+def _v4_stages(config):
+    if config.get("num_programs_v4", 1) > 1:
+        return _v4_best_of_k_stages(config)
+    repair = config.get("v4_repair", True)
+
+    def call(ctx):
+        ctx.log(f"  Using Program-Aided Language Models (PAL)...")
+        return ctx.call(ctx["messages"])
+
+    def verify(code_stage):
+        def run(ctx):
+            failures = verify_transform_code(ctx[code_stage], ctx.task['train'])
+            if failures:
+                ctx.log(f"  Train check failed on {len(failures)}/{len(ctx.task['train'])} examples")
+            else:
+                ctx.log(f"  Train check passed ({len(ctx.task['train'])} examples)")
+            return failures
+        return run
+
+    def repair_call(ctx):
+        ctx.log(f"  Asking the model to repair the program...")
+        return ctx.call(ctx["repair_messages"])
+
+    def program(ctx):
+        # 通过训练样本验证的程序优先；都没通过时用最后一版程序
+        if ctx["code"] is not None and ctx["verified"] == []:
+            return ctx["code"], True
+        if ctx["repair_code"] is not None and ctx["repair_verified"] == []:
+            return ctx["repair_code"], True
+        code = ctx["repair_code"] or ctx["code"]
+        return (code, False) if code is not None else None
+
+    def execute(ctx):
+        ctx.log(f"  Code extracted, executing...")
+        grid = as_grid(execute_transform_code(ctx["program"][0], ctx.task['test'][0]['input']))
+        ctx.log(f"  Code execution successful" if grid else f"  Code execution failed, trying to parse output...")
+        return grid
+
+    def choose(ctx):
+        # 程序的执行结果优先（即使没有通过训练样本验证）；V4 的回答没有 OUTPUT 标签，
+        # 直接解析只会拿到回答中第一个网格（通常是抄来的训练样本或代码里的常量），只在执行没有结果时使用。
+        # 有修复回答时优先解析修复回答
+        parsed = ctx["repair_fallback"] or ctx["fallback"]
+        if ctx["program"] is None:
+            ctx.log(f"  No code found, falling back to parse_output...")
+            return parsed
+        if not ctx["program"][1]:
+            ctx.log(f"  No program passed the train check, using its output anyway...")
+        return ctx["executed"] or parsed
+
+    has_code = lambda name: lambda ctx: ctx[name] is not None
+    needs_repair = lambda ctx: repair and bool(ctx["verified"])
+    # 直接解析回答只依赖回答本身：fallback 与代码提取同一批执行，repair_fallback 与修复代码的提取同一批执行；
+    # 两者总会执行（开销很小），只在没有通过验证的程序、或程序执行失败时使用
+    return [
+        Stage("messages", "prompt", lambda ctx: construct_prompt(ctx.prepared, version=4)),
+        Stage("reply", "call", call, metric="program"),
+        Stage("code", "parse", lambda ctx: extract_python_code(ctx["reply"]) or None),
+        Stage("verified", "verify", verify("code"), needs=("code",), when=has_code("code")),
+        Stage("repair_messages", "prompt", lambda ctx: prompt_v4_repair(ctx.prepared, ctx["messages"], ctx["reply"],
+                                                                       ctx["verified"]), when=needs_repair),
+        Stage("repair_reply", "call", repair_call, metric="repair", when=has_code("repair_messages")),
+        Stage("repair_code", "parse", lambda ctx: extract_python_code(ctx["repair_reply"]) or None,
+              metric="repair", when=has_code("repair_reply"), record="one"),
+        Stage("repair_verified", "verify", verify("repair_code"), when=has_code("repair_code")),
+        Stage("program", "parse", program, needs=("verified", "repair_verified")),
+        Stage("executed", "execute", execute, when=has_code("program")),
+        Stage("fallback", "parse", lambda ctx: parse_grid(ctx["reply"]), needs=("reply",)),
+        Stage("repair_fallback", "parse", lambda ctx: parse_grid(ctx["repair_reply"]), needs=("repair_reply",),
+              when=has_code("repair_reply")),
+        Stage("predicted", "parse", choose, needs=("executed", "fallback", "repair_fallback"), metric="program",
+              record="one"),
+    ]
+
+
+def _v4_best_of_k_stages(config):
+    num_programs = config["num_programs_v4"]
+    policy = config.get("voting_policy", "exact")
+
+    def sample(ctx):
+        ctx.log(f"  Using PAL with {num_programs} candidate programs...")
+        replies = ctx.calls.speak_and_listen_multiple(ctx["messages"], ctx.config["model_name"],
+                                                      num_samples=num_programs, log=ctx.log)
+        ctx.add_replies(replies)
+        return replies
+
+    def in_parallel(fn, items):
+        # 每个程序各占一个沙箱工作进程，并发执行
+        with ThreadPoolExecutor(max_workers=max(1, len(items))) as executor:
+            return [future.result() for future in [submit_with_context(executor, fn, item) for item in items]]
+
+    def accept(ctx):
+        candidates = ctx["candidates"]
+        ctx.log(f"  {len(candidates)} distinct programs from {len(ctx['replies'])} replies, checking train examples...")
+        results = in_parallel(lambda code: verify_transform_code(code, ctx.task['train']), [code for code, _ in candidates])
+        for index, ((code, _), failures) in enumerate(zip(candidates, results)):
+            if not failures:
+                ctx.log(f"  Program {index + 1} passed the train check")
+                return code
+        ctx.log(f"  No program passed the train check, voting on test outputs...")
+        return None
+
+    def execute(ctx):
+        return as_grid(execute_transform_code(ctx["accepted"], ctx.task['test'][0]['input']))
+
+    def execute_all(ctx):
+        test_input = ctx.task['test'][0]['input']
+        outputs = in_parallel(lambda code: execute_transform_code(code, test_input), [code for code, _ in ctx["candidates"]])
+        # 相同的程序只执行一次，但按出现次数计票
+        return [grid for grid, (_, count) in zip(outputs, ctx["candidates"]) for _ in range(count)]
+
+    def vote(ctx):
+        if ctx["accepted"] is not None and ctx["executed"]:
+            return ctx["executed"]
+        grids = ctx["test_outputs"] or []
+        if not any(grids):
+            # 没有程序能产生输出时，对回答中直接给出的网格投票
+            grids = [parse_grid(text) for text in ctx["replies"]]
+        ctx.voting_stats = get_voting_stats(grids, policy)
+        ctx.log(f"  Voting: {ctx.voting_stats['valid_predictions']} valid predictions, "
+                f"winner appeared {ctx.voting_stats['winning_count']} times")
+        return voting_grids(grids, policy)
+
+    return [
+        Stage("messages", "prompt", lambda ctx: construct_prompt(ctx.prepared, version=4)),
+        Stage("replies", "call", sample, metric="program"),
+        Stage("codes", "parse", lambda ctx: [extract_python_code(text) or None for text in ctx["replies"]],
+              metric="program", record="all"),
+        Stage("candidates", "parse", lambda ctx: group_programs(ctx["codes"])),
+        Stage("accepted", "verify", accept, when=lambda ctx: bool(ctx["candidates"])),
+        Stage("executed", "execute", execute, when=lambda ctx: ctx["accepted"] is not None),
+        Stage("test_outputs", "execute", execute_all, needs=("accepted",), when=lambda ctx: ctx["accepted"] is None),
+        Stage("predicted", "vote", vote, needs=("executed", "test_outputs")),
+    ]
+
+
+# ============================================================================
+# V5：Prompt Chaining + Reflexion
+# ============================================================================
+
+def _v5_stages(config):
+    conversation = config.get("v5_mode", "chain") == "conversation"
+
+    def hypothesis_prompt(ctx):
+        ctx.log(f"  Using Prompt Chaining + Reflexion...")
+        ctx.log(f"    Chain 1: Generating hypothesis...")
+        return prompt_v5_chain1_hypothesis(ctx.prepared)
+
+    def hypothesis(ctx):
+        text = extract_hypothesis(ctx["chain1_reply"])
+        ctx.log(f"    Hypothesis: {text[:100]}...")
+        return text
+
+    def reflexion_prompt(ctx):
+        ctx.log(f"    Reflexion: Verifying hypothesis...")
+        if conversation:
+            # 对话模式：在 Chain 1 的对话后追加，训练样本不再重复发送
+            return prompt_v5_conversation_verify(ctx.prepared, ctx["chain1_messages"], ctx["chain1_reply"],
+                                                 ctx["hypothesis"])
+        return prompt_v5_reflexion_verify(ctx.prepared, ctx["hypothesis"])
+
+    def reflexion_call(ctx):
+        reply = ctx.call(ctx["reflexion_messages"])
+        record_parse(["VERIFICATION:" in reply], stage="reflexion")
+        return reply
+
+    def verify(ctx):
+        # 检查验证结果并可能修正
+        reply = ctx["reflexion_reply"]
+        if "VERIFICATION: PASSED" in reply:
+            ctx.log(f"    ✓ Hypothesis verified!")
+            return ctx["hypothesis"]
+        ctx.log(f"    ✗ Hypothesis needs correction")
+        corrected = extract_corrected_hypothesis(reply)
+        if corrected:
+            ctx.log(f"    Corrected hypothesis: {corrected[:100]}...")
+            return corrected
+        return ctx["hypothesis"]
+
+    def predict_prompt(ctx):
+        ctx.log(f"    Chain 2: Applying final hypothesis...")
+        if conversation:
+            return prompt_v5_conversation_predict(ctx.prepared, ctx["reflexion_messages"], ctx["reflexion_reply"],
+                                                  ctx["final_hypothesis"])
+        return prompt_v5_chain2_predict(ctx.prepared, ctx["final_hypothesis"])
+
+    return [
+        Stage("chain1_messages", "prompt", hypothesis_prompt),
+        Stage("chain1_reply", "call", lambda ctx: ctx.call(ctx["chain1_messages"]), metric="chain1"),
+        Stage("hypothesis", "parse", hypothesis, metric="chain1", record="one"),
+        Stage("reflexion_messages", "prompt", reflexion_prompt),
+        Stage("reflexion_reply", "call", reflexion_call, metric="reflexion"),
+        Stage("final_hypothesis", "verify", verify),
+        Stage("chain2_messages", "prompt", predict_prompt),
+        Stage("chain2_reply", "call", lambda ctx: ctx.call(ctx["chain2_messages"]), metric="chain2"),
+        Stage("predicted", "parse", lambda ctx: parse_grid(ctx["chain2_reply"]), metric="chain2", record="one"),
+    ]
+
+
+register_strategy(Strategy(1, "simple", "Simple prompt (single call)", _single_call_stages(1)))
+register_strategy(Strategy(2, "fewshot-cot", "Few-shot + Chain of Thought (single call)", _single_call_stages(2)))
+register_strategy(Strategy(3, "self-consistency", "Self-consistency voting", _v3_stages))
+register_strategy(Strategy(4, "pal", "Program-Aided Language Models", _v4_stages))
+register_strategy(Strategy(5, "chain-reflexion", "Prompt Chaining + Reflexion", _v5_stages))
@@ -1,6 +1,13 @@
-import json
+import os
 import re
 
+import numpy as np
+
+from grid_codec import get_grid_encoding, decode_grid, decode_complete_grid
+from grid import Grid, as_grid, grids_equal
+from sandbox import SandboxError, execute_in_sandbox, execute_batch_in_sandbox
+from code_cache import code_key
+
 
 def extract_hypothesis(text):
     """
@@ -92,6 +99,28 @@ def extract_python_code(text):
     return ""
 
 
+def group_programs(codes):
+    """
+    按规范化源码（code_cache.code_key）合并相同的程序
+
+    参数:
+    codes (list): 程序源码列表（空值表示该回答中没有代码，不计入）
+
+    返回:
+    list: [(code, count)]，按首次出现的顺序；code 为该组第一次出现的源码，count 为出现次数
+    """
+    groups = {}
+    for code in codes:
+        if not code:
+            continue
+        key = code_key(code)
+        if key in groups:
+            groups[key][1] += 1
+        else:
+            groups[key] = [code, 1]
+    return [(code, count) for code, count in groups.values()]
+
+
 def execute_transform_code(code, test_input):
     """
     执行从模型生成的变换代码
@@ -107,33 +136,8 @@ def execute_transform_code(code, test_input):
         return []
     
     try:
-        # 创建一个安全的执行环境
-        exec_globals = {
-            "json": json,
-            "list": list,
-            "dict": dict,
-            "len": len,
-            "range": range,
-            "enumerate": enumerate,
-            "zip": zip,
-            "sum": sum,
-            "min": min,
-            "max": max,
-            "set": set,
-            "tuple": tuple,
-            "sorted": sorted,
-        }
-        
-        # 执行代码
-        exec(code, exec_globals)
-        
-        # 检查 transform 函数是否存在
-        if 'transform' not in exec_globals:
-            return []
-        
-        # 调用 transform 函数
-        transform_func = exec_globals['transform']
-        result = transform_func(test_input)
+        # 在沙箱工作进程中执行（超时、内存上限、受限的 import，见 sandbox.py）
+        result = execute_in_sandbox(code, test_input)
         
         # 验证结果是否为有效的网格
         if not isinstance(result, list):
@@ -152,17 +156,72 @@ def execute_transform_code(code, test_input):
         
         return result
     
-    except Exception as e:
+    except SandboxError as e:
         print(f"    Code execution error: {str(e)}")
         return []
 
 
-def parse_output(text):
+def describe_grid_mismatch(expected, actual, max_cells=8):
+    """
+    生成预测网格与期望网格差异的简短说明（用于 V4 的修复提示）
+
+    参数:
+    expected (Grid): 期望的网格
+    actual (Grid): 代码输出的网格
+    max_cells (int): 最多列出的不同格子数
+
+    返回:
+    str: 形状不同时说明两个形状，否则列出不同的格子 "(行, 列): expected X, got Y"
+    """
+    if actual.shape != expected.shape:
+        return f"wrong shape: expected {expected.shape[0]}x{expected.shape[1]}, got {actual.shape[0]}x{actual.shape[1]}"
+    rows, cols = expected.diff(actual).nonzero()
+    cells = [f"({r}, {c}): expected {expected.cells[r, c]}, got {actual.cells[r, c]}"
+             for r, c in zip(rows[:max_cells].tolist(), cols[:max_cells].tolist())]
+    more = f"; ... {len(rows) - max_cells} more" if len(rows) > max_cells else ""
+    return f"{len(rows)} of {expected.cells.size} cells differ: " + "; ".join(cells) + more
+
+
+def verify_transform_code(code, train_pairs):
+    """
+    在所有训练样本上执行代码，检查输出是否与期望输出完全相同
+
+    所有训练样本在同一个沙箱工作进程中一次执行（代码只执行一次）；超时针对整批样本。
+
+    参数:
+    code (str): 包含 transform 函数的 Python 代码
+    train_pairs (list): 训练样本，d['train']
+
+    返回:
+    list: 未通过的样本，每项为 {"index": 样本下标, "detail": 差异或错误说明}；全部通过时为空列表
+    """
+    try:
+        outcomes = execute_batch_in_sandbox(code, [example['input'] for example in train_pairs])
+    except SandboxError as e:
+        return [{"index": index, "detail": f"error: {e}"} for index in range(len(train_pairs))]
+
+    failures = []
+    for index, (example, (status, value)) in enumerate(zip(train_pairs, outcomes)):
+        if status == "error":
+            failures.append({"index": index, "detail": f"error: {value}"})
+            continue
+        actual = as_grid(value)
+        expected = as_grid(example['output'])
+        if actual is None:
+            failures.append({"index": index, "detail": "did not return a non-empty rectangular 2D list of integers"})
+        elif actual != expected:
+            failures.append({"index": index, "detail": describe_grid_mismatch(expected, actual)})
+    return failures
+
+
+def parse_output(text, encoding=None):
     """
     解析大语言模型的输出文本，提取预测的网格
     
     参数:
     text (str): 大语言模型在设计prompt下的输出文本
+    encoding (str): 提示词使用的网格格式（见 grid_codec.py），默认按 GRID_ENCODING；
+                    非 json 格式先用对应的解码器读取，读不到时再按二维列表解析
     
     返回:
     list: 从输出文本解析出的二维数组 (Python列表，元素为整数)
@@ -178,6 +237,19 @@ def parse_output(text):
         return []
     
     try:
+        # 策略 0: 紧凑格式（rows / rle / sparse）的答案
+        encoding = get_grid_encoding(encoding)
+        if encoding != "json":
+            output_idx = text.find("OUTPUT:")
+            if output_idx != -1:
+                result = decode_grid(text[output_idx + len("OUTPUT:"):], encoding)
+                if result:
+                    return result
+            # 整段回答中查找时至少要两行，推理里单独一行的数字不算网格
+            result = decode_grid(text, encoding, min_rows=2)
+            if result:
+                return result
+        
         # 策略 1: 首先尝试从 "OUTPUT:" 标签后面提取（优先级最高）
         if "OUTPUT:" in text:
             output_idx = text.find("OUTPUT:")
@@ -199,72 +271,296 @@ def parse_output(text):
         return []
 
 
+def parse_grid(text, encoding=None):
+    """
+    与 parse_output 相同，但返回 Grid（评测流程内部使用）；解析不到有效的矩形网格时返回 None
+    """
+    return as_grid(parse_output(text, encoding))
+
+
+# 网格候选的起点：后面（可隔空白）紧跟另一个 '[' 的 '['
+_GRID_START = re.compile(r'\[(?=\s*\[)')
+# 一行整数 [1, 2, 3]；一个网格是用逗号分隔的若干行，外面再包一层括号
+_GRID_ROW = r'\[\s*-?\d+(?:\s*,\s*-?\d+)*\s*\]'
+_GRID = re.compile(r'\[\s*' + _GRID_ROW + r'(?:\s*,\s*' + _GRID_ROW + r')*\s*\]')
+_GRID_ROW_BODY = re.compile(r'\[([^\[\]]*)\]')
+
+
 def _extract_grid_from_text(text):
     """
     从文本中提取第一个有效的网格
-    使用多种策略提高鲁棒性
+
+    单遍扫描：依次尝试每个 "[[" 起点（中间可有空白），在该处匹配整个网格的结构
+    （只含整数的行），匹配成功后直接把各行转成整数，不经过 json.loads。
+    有效网格内部不会出现新的起点，失败的起点也只读到第一个不合格式的字符，
+    因此总耗时与文本长度成线性（原来的非贪婪正则在很多 "[[" 时是平方级）。
     """
-    # 策略 A: 使用改进的正则表达式
-    pattern = r'\[\s*\[.*?\]\s*\]'
-    matches = re.findall(pattern, text, re.DOTALL)
-    
-    for match in matches:
-        try:
-            result = json.loads(match)
-            if _is_valid_grid(result):
-                return result
-        except (json.JSONDecodeError, ValueError):
-            continue
-    
-    # 策略 B: 手动解析 - 查找第一个 [[ 并逐个匹配括号
-    start_idx = text.find('[[')
-    if start_idx != -1:
-        bracket_count = 0
-        result_str = ""
-        
-        for i in range(start_idx, len(text)):
-            char = text[i]
-            result_str += char
-            
-            if char == '[':
-                bracket_count += 1
-            elif char == ']':
-                bracket_count -= 1
-                
-                # 当括号数回到 0 时，我们找到了完整的数组
-                if bracket_count == 0:
-                    try:
-                        result = json.loads(result_str)
-                        if _is_valid_grid(result):
-                            return result
-                    except (json.JSONDecodeError, ValueError):
-                        pass
-                    break
-    
+    for start in _GRID_START.finditer(text):
+        match = _GRID.match(text, start.start())
+        if match is not None:
+            return [list(map(int, row.split(','))) for row in _GRID_ROW_BODY.findall(match.group(), 1)]
     return None
 
 
-def _is_valid_grid(obj):
+# GridScanner 的状态
+_SCAN_OUTSIDE = 0      # 不在候选网格中
+_SCAN_GRID_OPEN = 1    # 读到外层 '['，等待第一行的 '['
+_SCAN_ROW_START = 2    # 读到行首 '[' 或行内 ','，等待数字
+_SCAN_SIGN = 3         # 读到负号，等待数字
+_SCAN_NUMBER = 4       # 正在读数字
+_SCAN_AFTER_NUMBER = 5  # 数字之后的空白，等待 ',' 或 ']'
+_SCAN_AFTER_ROW = 6    # 一行结束，等待 ',' 或外层 ']'
+_SCAN_NEXT_ROW = 7     # 行之间的 ','，等待下一行的 '['
+
+
+class GridScanner:
     """
-    检查对象是否为有效的网格（二维整数列表）
+    逐块喂入文本的网格扫描器：与 _extract_grid_from_text 识别同样的网格（只含整数的二维列表），
+    但不保存文本，块与块之间只保留括号状态、当前行和正在读的数字，
+    读到网格的最后一个 ']' 时立即给出结果。每个字符只处理一次，额外内存与文本长度无关。
+
+    tag 不为 None 时还记录第一个出现在 tag 之后的网格（after_tag），
+    result() 与 parse_output 的优先级一致：tag 之后的网格优先，其次是第一个网格。
+
+    用法:
+    scanner = GridScanner(tag="OUTPUT:")
+    for chunk in chunks:
+        for grid in scanner.feed(chunk):
+            ...
+    grid = scanner.result()
     """
-    if not isinstance(obj, list):
-        return False
-    
-    if len(obj) == 0:
-        return False
-    
-    # 检查是否为二维列表且所有元素都是整数
-    for row in obj:
-        if not isinstance(row, list):
-            return False
-        if len(row) == 0:
-            return False
-        for elem in row:
-            if not isinstance(elem, int):
-                return False
-    
-    return True
+
+    def __init__(self, tag=None, max_candidates=16):
+        self.tag = tag
+        self.max_candidates = max_candidates
+        self.candidates = []      # 目前为止读到的完整网格（最多 max_candidates 个）
+        self.first = None
+        self.after_tag = None
+        self.tag_found = tag is None
+        self._tail = ""           # 上一块末尾的若干字符，用于匹配跨块的标签
+        self._state = _SCAN_OUTSIDE
+        self._grid = []
+        self._row = []
+        self._number = 0
+        self._negative = False
+        self._started_after_tag = False
+
+    def feed(self, chunk):
+        """
+        喂入一块文本
+
+        参数:
+        chunk (str): 新收到的文本
+
+        返回:
+        list: 在这块文本中读完的网格（通常为空）
+        """
+        finished = []
+        if not chunk:
+            return finished
+
+        # tag_pos: 本块中标签结束的位置（之后的字符才算 "tag 之后"）；本块没有标签时为 None
+        tag_pos = None
+        if not self.tag_found:
+            window = self._tail + chunk
+            idx = window.find(self.tag)
+            if idx == -1:
+                self._tail = window[-(len(self.tag) - 1):]
+            else:
+                tag_pos = max(0, idx + len(self.tag) - len(self._tail))
+        # 标签结束之前的文本不会出现 "tag 之后" 的网格起点
+        limit = len(chunk) if tag_pos is None else tag_pos
+
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if tag_pos is not None and i >= tag_pos:
+                self.tag_found = True
+                tag_pos = None
+                limit = n
+            state = self._state
+            if state == _SCAN_OUTSIDE:
+                # 候选之外直接跳到下一个 '['（最多跳到标签结束处）
+                j = chunk.find('[', i, limit)
+                if j == -1:
+                    i = limit
+                    continue
+                i = j
+            char = chunk[i]
+            i += 1
+            if char in ' \t\r\n':
+                if state == _SCAN_NUMBER:
+                    self._end_number()
+                    self._state = _SCAN_AFTER_NUMBER
+                elif state == _SCAN_SIGN:
+                    self._state = _SCAN_OUTSIDE
+                continue
+            if state == _SCAN_OUTSIDE:
+                self._open_grid()
+            elif state == _SCAN_GRID_OPEN:
+                if char == '[':
+                    self._row = []
+                    self._state = _SCAN_ROW_START
+                else:
+                    self._state = _SCAN_OUTSIDE
+            elif state in (_SCAN_ROW_START, _SCAN_SIGN, _SCAN_NUMBER) and '0' <= char <= '9':
+                if state != _SCAN_NUMBER:
+                    self._number = 0
+                    self._negative = state == _SCAN_SIGN
+                self._number = self._number * 10 + ord(char) - 48
+                self._state = _SCAN_NUMBER
+            elif state == _SCAN_ROW_START and char == '-':
+                self._state = _SCAN_SIGN
+            elif state in (_SCAN_NUMBER, _SCAN_AFTER_NUMBER) and char in ',]':
+                if state == _SCAN_NUMBER:
+                    self._end_number()
+                if char == ',':
+                    self._state = _SCAN_ROW_START
+                else:
+                    self._grid.append(self._row)
+                    self._state = _SCAN_AFTER_ROW
+            elif state == _SCAN_AFTER_ROW and char == ',':
+                self._state = _SCAN_NEXT_ROW
+            elif state == _SCAN_AFTER_ROW and char == ']':
+                grid = self._grid
+                self._grid = []
+                self._state = _SCAN_OUTSIDE
+                self._finish(grid)
+                finished.append(grid)
+            elif state == _SCAN_NEXT_ROW and char == '[':
+                self._row = []
+                self._state = _SCAN_ROW_START
+            elif char == '[':
+                # 候选失败在一个 '[' 上：若它紧跟在一个空行首 '[' 之后，那个 '[' 成为新的外层括号
+                if state == _SCAN_ROW_START and not self._row:
+                    self._open_grid()
+                    self._row = []
+                    self._state = _SCAN_ROW_START
+                else:
+                    self._open_grid()
+            else:
+                self._state = _SCAN_OUTSIDE
+
+        if tag_pos is not None:
+            self.tag_found = True
+        return finished
+
+    def _open_grid(self):
+        self._grid = []
+        self._started_after_tag = self.tag_found
+        self._state = _SCAN_GRID_OPEN
+
+    def _end_number(self):
+        self._row.append(-self._number if self._negative else self._number)
+
+    def _finish(self, grid):
+        if self.first is None:
+            self.first = grid
+        if self.after_tag is None and self.tag is not None and self._started_after_tag:
+            self.after_tag = grid
+        if len(self.candidates) < self.max_candidates:
+            self.candidates.append(grid)
+
+    def result(self):
+        """
+        按 parse_output 的优先级返回网格：tag 之后的第一个网格，其次是第一个网格；都没有时返回 None
+        """
+        return self.after_tag if self.after_tag is not None else self.first
+
+
+def scan_grid(chunks, tag="OUTPUT:"):
+    """
+    用 GridScanner 从逐块到达的文本（如逐行读取的超长回答）中提取网格，不保存整段文本
+
+    参数:
+    chunks: 可迭代的文本块
+    tag (str): 优先取该标签之后的网格
+
+    返回:
+    list: 网格；没有时返回空列表
+    """
+    scanner = GridScanner(tag=tag)
+    for chunk in chunks:
+        scanner.feed(chunk)
+    return scanner.result() or []
+
+
+class StreamingOutputParser:
+    """
+    增量版 parse_output：逐块喂入模型的流式输出，
+    一旦 "OUTPUT:" 标签之后出现一个完整且有效的网格就立即给出结果，
+    调用方据此可以提前取消流，不再为标签后面多余的文字付费和等待。
+    json 格式的网格由 GridScanner 增量识别，不会在每块到达时重新扫描已收到的文本；
+    rows / rle / sparse 格式（GRID_ENCODING）在标签之后、网格后面出现不属于网格的内容时
+    由 decode_complete_grid 识别（每块到达时检查标签之后的文本，这段文本不超过网格本身的长度）。
+
+    参数:
+    encoding (str): 回答中网格的格式，默认按 GRID_ENCODING
+
+    用法:
+    parser = StreamingOutputParser()
+    for chunk in stream:
+        grid = parser.feed(chunk)
+        if grid is not None:
+            break
+    reply_text = parser.text
+    """
+
+    TAG = "OUTPUT:"
+
+    def __init__(self, encoding=None):
+        self.grid = None
+        self.encoding = get_grid_encoding(encoding)
+        self._chunks = []
+        self._scanner = GridScanner(tag=self.TAG) if self.encoding == "json" else None
+        # 紧凑格式：标签之前只保留末尾几个字符（标签可能跨块），标签之后的文本单独保存
+        self._tail = ""
+        self._after_tag = None
+
+    @property
+    def text(self):
+        """
+        目前为止收到的完整文本
+        """
+        return "".join(self._chunks)
+
+    @property
+    def candidates(self):
+        """
+        目前为止读到的完整网格（包括标签之前的）
+        """
+        return self._scanner.candidates
+
+    def feed(self, chunk):
+        """
+        喂入一块文本
+
+        参数:
+        chunk (str): 新收到的文本
+
+        返回:
+        list: 标签后的网格已完整时返回该网格（之后每次调用都返回同一个），否则返回 None
+        """
+        if not chunk:
+            return self.grid
+        self._chunks.append(chunk)
+        if self.grid is not None:
+            return self.grid
+        if self._scanner is not None:
+            self._scanner.feed(chunk)
+            self.grid = self._scanner.after_tag
+            return self.grid
+        if self._after_tag is None:
+            window = self._tail + chunk
+            position = window.find(self.TAG)
+            if position == -1:
+                self._tail = window[-(len(self.TAG) - 1):]
+                return None
+            self._after_tag = [window[position + len(self.TAG):]]
+        else:
+            self._after_tag.append(chunk)
+        self.grid = decode_complete_grid("".join(self._after_tag), self.encoding)
+        return self.grid
 
 
 def format_grid_for_markdown(grid, expected_grid=None):
@@ -272,7 +568,7 @@ def format_grid_for_markdown(grid, expected_grid=None):
     将网格格式化为 markdown 表格中可用的格式
     
     参数:
-    grid: 预测或期望的网格 (二维列表)
+    grid: 预测或期望的网格 (Grid 或二维列表)
     expected_grid: 期望的网格（用于对比标记差异）
     
     返回:
@@ -281,16 +577,18 @@ def format_grid_for_markdown(grid, expected_grid=None):
     if not grid:
         return "Error: Empty prediction"
     
+    # 差异位置一次性用数组比较得到（重叠区域内不同的格子）
+    grid_obj, expected_obj = as_grid(grid), as_grid(expected_grid)
+    rows = grid_obj.tolist() if grid_obj is not None else grid
+    diff = grid_obj.diff(expected_obj).tolist() if grid_obj is not None and expected_obj is not None else None
+    
     lines = []
-    for i, row in enumerate(grid):
+    for i, row in enumerate(rows):
         row_str = "| "
         for j, elem in enumerate(row):
-            if expected_grid and i < len(expected_grid) and j < len(expected_grid[i]):
-                if elem != expected_grid[i][j]:
-                    # 差异位置标记为粗斜体
-                    row_str += f"***{elem}*** | "
-                else:
-                    row_str += f"{elem} | "
+            if diff is not None and diff[i][j]:
+                # 差异位置标记为粗斜体
+                row_str += f"***{elem}*** | "
             else:
                 row_str += f"{elem} | "
         lines.append(row_str)
@@ -324,12 +622,13 @@ def generate_markdown_report(tasks, predictions, ground_truths, prompt_version=1
     markdown_content = f"# ARC Task Results - {version_name}\n\n"
     markdown_content += f"**Prompt Version:** {version_name}\n\n"
     markdown_content += f"Total Tasks: {len(tasks)}\n"
-    markdown_content += f"Correct: {sum(p == g for p, g in zip(predictions, ground_truths))}\n"
-    markdown_content += f"Accuracy: {sum(p == g for p, g in zip(predictions, ground_truths)) / len(tasks) if tasks else 0:.2%}\n\n"
+    correct = [grids_equal(p, g) for p, g in zip(predictions, ground_truths)]
+    markdown_content += f"Correct: {sum(correct)}\n"
+    markdown_content += f"Accuracy: {sum(correct) / len(tasks) if tasks else 0:.2%}\n\n"
     markdown_content += "---\n\n"
     
     for idx, (task, pred, ground_truth) in enumerate(zip(tasks, predictions, ground_truths)):
-        is_correct = pred == ground_truth
+        is_correct = correct[idx]
         status = "✓ CORRECT" if is_correct else "✗ INCORRECT"
         
         markdown_content += f"## Task {idx + 1} {status}\n\n"
@@ -384,92 +683,280 @@ def generate_input_visualization(tasks):
     return markdown_content
 
 
-def voting_grids(grid_list):
+# 投票规则：exact = 整个网格完全相同才算同一票；cell = 按形状分组后逐格多数表决
+VOTING_POLICIES = ("exact", "cell")
+
+
+def get_voting_policy(policy=None):
+    """
+    返回投票规则：policy 不为 None 时直接使用，否则读取环境变量 VOTING_POLICY（默认 exact）
+    """
+    if policy is None:
+        policy = os.getenv("VOTING_POLICY", "exact")
+    policy = policy.strip().lower()
+    if policy not in VOTING_POLICIES:
+        raise ValueError(f"Unknown voting policy: {policy} (expected one of {', '.join(VOTING_POLICIES)})")
+    return policy
+
+
+def cell_consensus(grid_list):
+    """
+    逐格多数表决
+
+    有效预测按形状分组，取预测最多的形状（数量相同时取先出现的）；该组网格堆叠成
+    (n, h, w) 数组，一次算出每个格子各颜色的票数、多数颜色和一致程度。
+    某格票数相同时，取该组中最先出现的、投给最高票颜色的预测的值，
+    因此所有预测完全相同时结果与 voting_grids 一致。
+
+    参数:
+    grid_list: 预测网格列表（Grid 或二维列表；空值 / 无效网格不计票）
+
+    返回:
+    dict: 没有有效预测时为 None，否则包含
+        - "grid": 逐格多数表决得到的 Grid
+        - "valid_predictions": 有效预测数
+        - "shape_count": 与赢家形状相同的预测数
+        - "runner_up_shape_count": 其他形状中预测最多的一种的预测数
+        - "cell_votes": (h, w) 数组，每格多数颜色的票数
+        - "cell_margin": (h, w) 数组，每格多数颜色领先第二名颜色的票数
+    """
+    shapes = {}
+    for grid in grid_list:
+        grid = as_grid(grid)
+        if grid is not None:
+            shapes.setdefault(grid.shape, []).append(grid)
+    if not shapes:
+        return None
+
+    group = max(shapes.values(), key=len)
+    shape_counts = sorted((len(grids) for grids in shapes.values()), reverse=True)
+    stack = np.stack([grid.cells for grid in group])
+
+    # 每格各颜色的票数：(颜色数, h, w)
+    colors, inverse = np.unique(stack, return_inverse=True)
+    inverse = inverse.reshape(stack.shape)
+    counts = (inverse[None] == np.arange(len(colors))[:, None, None, None]).sum(axis=1)
+    ranked = np.sort(counts, axis=0)
+    votes = ranked[-1]
+    margin = votes - ranked[-2] if len(colors) > 1 else votes
+
+    # 每格取最先出现的、投给最高票颜色的预测的值
+    sample_votes = np.take_along_axis(counts, inverse, axis=0)
+    first = (sample_votes == votes).argmax(axis=0)
+    cells = np.take_along_axis(stack, first[None], axis=0)[0]
+
+    return {
+        "grid": Grid(np.ascontiguousarray(cells)),
+        "valid_predictions": sum(shape_counts),
+        "shape_count": shape_counts[0],
+        "runner_up_shape_count": shape_counts[1] if len(shape_counts) > 1 else 0,
+        "cell_votes": votes,
+        "cell_margin": margin,
+    }
+
+
+def count_grids(grid_list):
+    """
+    按网格计票
+
+    参数:
+    grid_list: 预测网格列表（Grid 或二维列表；空值 / 无效网格不计票）
+
+    返回:
+    tuple: (counts, grids)，counts 为 {Grid.key: 票数}，按首次出现的顺序排列；
+           grids 为 {Grid.key: 首次出现的 Grid}
+    """
+    counts = {}
+    grids = {}
+    for grid in grid_list:
+        grid = as_grid(grid)
+        if grid is None:
+            continue
+        key = grid.key
+        if key not in counts:
+            counts[key] = 0
+            grids[key] = grid
+        counts[key] += 1
+    return counts, grids
+
+
+def voting_grids(grid_list, policy="exact"):
     """
     自我一致性投票：从多个预测网格中选择最常见的一个
     
     参数:
-    grid_list: 列表，包含多个预测网格 (每个都是二维列表)
+    grid_list: 列表，包含多个预测网格 (Grid 或二维列表)
+    policy: 投票规则，"exact"（整格匹配）或 "cell"（逐格多数表决，见 cell_consensus）
     
     返回:
-    list: 出现频率最高的网格，如果 grid_list 为空则返回空列表
+    Grid: 出现频率最高的网格（票数相同时取先出现的），如果没有有效网格则返回空列表
     """
-    if not grid_list:
-        return []
-    
-    # 过滤掉空列表
-    valid_grids = [g for g in grid_list if g]
-    
-    if not valid_grids:
+    if get_voting_policy(policy) == "cell":
+        consensus = cell_consensus(grid_list or [])
+        return consensus["grid"] if consensus else []
+    counts, grids = count_grids(grid_list or [])
+    if not counts:
         return []
-    
-    # 将每个网格转换为可哈希的格式（用于计数）
-    grid_counts = {}
-    for grid in valid_grids:
-        # 转换为 tuple of tuples 以便作为字典键
-        grid_key = tuple(tuple(row) for row in grid)
-        grid_counts[grid_key] = grid_counts.get(grid_key, 0) + 1
-    
-    # 找出出现频率最高的网格
-    most_common_key = max(grid_counts, key=grid_counts.get)
-    most_common_grid = [list(row) for row in most_common_key]
-    
-    return most_common_grid
+    return grids[max(counts, key=counts.get)]
 
 
-def get_voting_stats(grid_list):
+def get_voting_stats(grid_list, policy="exact"):
     """
     获取投票统计信息
     
     参数:
     grid_list: 列表，包含多个预测网格
+    policy: 投票规则，"exact" 或 "cell"
     
     返回:
-    dict: 包含投票统计信息
+    dict: 包含投票统计信息（可直接写入 JSON）
         - "total_predictions": 总预测数
         - "valid_predictions": 有效预测数
-        - "winning_grid": 投票赢家
-        - "winning_count": 赢家出现次数
-        - "confidence": 信心指数 (0-1)
-    """
-    if not grid_list:
-        return {
-            "total_predictions": 0,
-            "valid_predictions": 0,
-            "winning_grid": [],
-            "winning_count": 0,
-            "confidence": 0.0
-        }
-    
-    valid_grids = [g for g in grid_list if g]
-    
-    if not valid_grids:
-        return {
-            "total_predictions": len(grid_list),
-            "valid_predictions": 0,
-            "winning_grid": [],
-            "winning_count": 0,
-            "confidence": 0.0
-        }
-    
-    # 计数
-    grid_counts = {}
-    for grid in valid_grids:
-        grid_key = tuple(tuple(row) for row in grid)
-        grid_counts[grid_key] = grid_counts.get(grid_key, 0) + 1
+        - "winning_grid": 投票赢家（二维列表）
+        - "winning_count": 与赢家完全相同的预测数
+        - "confidence": 信心指数 (0-1)；cell 规则下为各格多数颜色票数占有效预测数的平均值
+        cell 规则下另有:
+        - "policy": "cell"
+        - "shape_count": 与赢家形状相同的预测数
+        - "min_cell_agreement": 一致程度最低的格子的多数票占比
+        - "contested_cells": 多数颜色票数未过半（相对有效预测数）的格子数
+    """
+    if get_voting_policy(policy) == "cell":
+        return _cell_voting_stats(grid_list or [])
+    counts, grids = count_grids(grid_list or [])
+    if not counts:
+        return _empty_voting_stats(grid_list)
     
     # 找出赢家
-    most_common_key = max(grid_counts, key=grid_counts.get)
-    winning_count = grid_counts[most_common_key]
-    winning_grid = [list(row) for row in most_common_key]
-    
-    # 计算信心指数
-    confidence = winning_count / len(valid_grids)
+    most_common_key = max(counts, key=counts.get)
+    winning_count = counts[most_common_key]
+    valid_predictions = sum(counts.values())
     
     return {
         "total_predictions": len(grid_list),
-        "valid_predictions": len(valid_grids),
-        "winning_grid": winning_grid,
+        "valid_predictions": valid_predictions,
+        "winning_grid": grids[most_common_key].tolist(),
         "winning_count": winning_count,
-        "confidence": confidence
-    }
\ No newline at end of file
+        "confidence": winning_count / valid_predictions
+    }
+
+def _empty_voting_stats(grid_list):
+    return {
+        "total_predictions": len(grid_list or []),
+        "valid_predictions": 0,
+        "winning_grid": [],
+        "winning_count": 0,
+        "confidence": 0.0
+    }
+
+
+def _cell_voting_stats(grid_list):
+    """
+    cell 规则的投票统计（字段见 get_voting_stats）
+    """
+    consensus = cell_consensus(grid_list)
+    if consensus is None:
+        stats = _empty_voting_stats(grid_list)
+        stats["policy"] = "cell"
+        return stats
+
+    valid = consensus["valid_predictions"]
+    agreement = consensus["cell_votes"] / valid
+    winner = consensus["grid"]
+    return {
+        "total_predictions": len(grid_list),
+        "valid_predictions": valid,
+        "winning_grid": winner.tolist(),
+        "winning_count": sum(grids_equal(grid, winner) for grid in grid_list),
+        "confidence": float(agreement.mean()),
+        "policy": "cell",
+        "shape_count": consensus["shape_count"],
+        "min_cell_agreement": float(agreement.min()),
+        "contested_cells": int((agreement <= 0.5).sum()),
+    }
+
+
+def is_vote_decided(grid_list, max_samples, policy="exact"):
+    """
+    判断在还剩 (max_samples - len(grid_list)) 个采样的情况下，
+    当前的投票赢家是否已经不可能被推翻
+
+    与 voting_grids 的规则保持一致：票数相同时先出现的网格获胜。
+    因此只有当剩余采样全部投给任何一个其他网格（包括尚未出现的网格）
+    也无法超过当前赢家时，才认为投票已经确定。
+
+    cell 规则下（保守判断）：赢家形状的预测数严格多于其他任一形状加上剩余采样数，
+    且每个格子多数颜色领先第二名的票数严格多于剩余采样数。
+
+    参数:
+    grid_list: 已获得的预测网格列表（空值表示该采样无效）
+    max_samples: 最大采样数
+    policy: 投票规则，"exact" 或 "cell"
+
+    返回:
+    bool: True 表示继续采样也不会改变赢家
+    """
+    remaining = max(0, max_samples - len(grid_list))
+    if remaining == 0:
+        return True
+
+    if get_voting_policy(policy) == "cell":
+        consensus = cell_consensus(grid_list)
+        return (consensus is not None
+                and consensus["shape_count"] > consensus["runner_up_shape_count"] + remaining
+                and bool((consensus["cell_margin"] > remaining).all()))
+
+    grid_counts, _ = count_grids(grid_list)
+    if not grid_counts:
+        return False
+
+    leader_key = max(grid_counts, key=grid_counts.get)
+    leader_count = grid_counts[leader_key]
+
+    # 尚未出现的网格排在赢家之后，票数相同也不能获胜
+    if remaining > leader_count:
+        return False
+
+    seen_leader = False
+    for grid_key, count in grid_counts.items():
+        if grid_key == leader_key:
+            seen_leader = True
+            continue
+        # 排在赢家之前的网格打平即可获胜，排在之后的必须严格超过
+        if count + remaining > leader_count or (count + remaining == leader_count and not seen_leader):
+            return False
+
+    return True
+
+
+def should_stop_sampling(grid_list, max_samples, min_samples=1, confidence_threshold=None, policy="exact"):
+    """
+    自适应自我一致性：判断是否可以提前停止采样
+
+    停止条件（满足任一即可）：
+    1. 已达到 max_samples
+    2. 剩余采样无法推翻当前赢家（不改变最终结果）
+    3. 已有至少 min_samples 个采样，且赢家信心指数达到 confidence_threshold
+
+    参数:
+    grid_list: 已获得的预测网格列表
+    max_samples: 最大采样数
+    min_samples: 使用信心阈值前至少需要的采样数
+    confidence_threshold: 信心阈值 (0-1)，None 表示不使用
+    policy: 投票规则，"exact" 或 "cell"
+
+    返回:
+    bool: True 表示可以停止采样
+    """
+    if len(grid_list) >= max_samples:
+        return True
+
+    if is_vote_decided(grid_list, max_samples, policy):
+        return True
+
+    if confidence_threshold is not None and len(grid_list) >= min_samples:
+        stats = get_voting_stats(grid_list, policy)
+        if stats["valid_predictions"] > 0 and stats["confidence"] >= confidence_threshold:
+            return True
+
+    return False
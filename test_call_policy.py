@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+测试调用策略层（限流 / 重试 / 截止时间 / 对冲），使用注入故障的本地替身服务器
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import openai
+from mock_server import start_mock_server
+from llm_client import create_client, get_api_config
+from call_policy import CallPolicy, TokenBucket, LatencyTracker, DeadlineExceeded, task_deadline, request_cancelled
+
+
+def make_client(base_url, timeout=10):
+    config = get_api_config()
+    config.update(api_key="mock", base_url=base_url, timeout=timeout)
+    return create_client(config)
+
+
+def make_request(client):
+    messages = [{"role": "user", "content": "ping"}]
+
+    def request(timeout):
+        request_client = client if timeout is None else client.with_options(timeout=timeout)
+        return request_client.chat.completions.create(model="mock", messages=messages, max_tokens=10)
+
+    return request
+
+
+def check_retries():
+    """30% 的请求返回 429/500，重试后全部成功"""
+    server, base_url = start_mock_server(error_rate=0.3)
+    policy = CallPolicy(max_retries=8, base_delay=0.01, max_delay=0.05)
+    request = make_request(make_client(base_url))
+
+    total_retries = 0
+    for _ in range(50):
+        stats = {}
+        policy.call(request, stats=stats)
+        total_retries += stats["retries"]
+    server.shutdown()
+    return total_retries > 0, f"50/50 calls succeeded, {total_retries} retries, {server.request_count} requests"
+
+
+def check_non_retryable():
+    """400 错误不重试，直接抛出"""
+    server, base_url = start_mock_server(error_rate=1.0, error_statuses=(400,))
+    policy = CallPolicy(max_retries=5, base_delay=0.01)
+    request = make_request(make_client(base_url))
+    try:
+        policy.call(request)
+        ok = False
+    except openai.BadRequestError:
+        ok = server.request_count == 1
+    server.shutdown()
+    return ok, f"{server.request_count} request(s) sent"
+
+
+def check_deadline():
+    """单次请求 0.5s，任务截止时间 0.2s，应在截止时间附近失败"""
+    server, base_url = start_mock_server(latency=0.5)
+    policy = CallPolicy(max_retries=3, base_delay=0.01)
+    request = make_request(make_client(base_url))
+    start = time.monotonic()
+    try:
+        with task_deadline(0.2):
+            policy.call(request)
+        ok = False
+    except (DeadlineExceeded, openai.APITimeoutError):
+        ok = True
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    return ok and elapsed < 0.45, f"gave up after {elapsed:.2f}s"
+
+
+def check_stream_deadline():
+    """流式回答每 0.05s 一个分块，共约 2s：单次读写都不会超时，但截止时间 0.3s 到达时调用方立即返回，
+    流在下一个分块处关闭"""
+    server, base_url = start_mock_server(reply="x" * 320, stream_chunk_chars=8, stream_chunk_delay=0.05)
+    client = make_client(base_url)
+    messages = [{"role": "user", "content": "ping"}]
+
+    def request(timeout):
+        request_client = client if timeout is None else client.with_options(timeout=timeout)
+        stream = request_client.chat.completions.create(model="mock", messages=messages, max_tokens=10, stream=True)
+        parts = []
+        try:
+            for chunk in stream:
+                if request_cancelled():
+                    break
+                if chunk.choices:
+                    parts.append(chunk.choices[0].delta.content or "")
+        finally:
+            stream.close()
+        return "".join(parts)
+
+    policy = CallPolicy(max_retries=3, base_delay=0.01)
+    start = time.monotonic()
+    try:
+        with task_deadline(0.3):
+            reply = policy.call(request)
+        ok, detail = False, f"got {len(reply)} chars"
+    except DeadlineExceeded as e:
+        ok, detail = True, str(e)
+    elapsed = time.monotonic() - start
+    time.sleep(0.3)
+    cancelled = server.cancelled_streams
+    server.shutdown()
+    return ok and elapsed < 0.45 and cancelled == 1, f"{detail} after {elapsed:.2f}s, cancelled streams: {cancelled}"
+
+
+def check_token_bucket():
+    """600 RPM、容量 1 的令牌桶：5 次请求约需 0.4s"""
+    bucket = TokenBucket(600, capacity=1)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+    return 0.35 < elapsed < 0.6, f"5 acquires took {elapsed:.2f}s"
+
+
+def check_hedging():
+    """2% 的请求额外慢 1s（落在 p95 之外的长尾），对冲后慢调用明显减少"""
+    random.seed(0)
+    server, base_url = start_mock_server(latency=0.01, slow_rate=0.02, slow_latency=1.0)
+    request = make_request(make_client(base_url))
+
+    def slow_calls(policy):
+        latencies = []
+        for _ in range(220):
+            start = time.monotonic()
+            policy.call(request)
+            latencies.append(time.monotonic() - start)
+        # 前 20 次用于积累 p95，不计入
+        return sum(latency > 0.5 for latency in latencies[20:])
+
+    plain = slow_calls(CallPolicy(hedge=False))
+    hedged = slow_calls(CallPolicy(hedge=True, tracker=LatencyTracker(min_samples=20)))
+    server.shutdown()
+    return hedged < plain, f"calls slower than 0.5s: {plain} without hedging, {hedged} with hedging"
+
+
+def main():
+    checks = [
+        ("重试可恢复错误", check_retries),
+        ("不可重试错误直接抛出", check_non_retryable),
+        ("任务截止时间", check_deadline),
+        ("流式回答的截止时间", check_stream_deadline),
+        ("令牌桶限流", check_token_bucket),
+        ("对冲请求", check_hedging),
+    ]
+
+    print("=" * 70)
+    print("Testing call policy against a fault-injecting mock server")
+    print("=" * 70)
+
+    passed = 0
+    failed = 0
+    for name, check in checks:
+        try:
+            ok, detail = check()
+        except Exception as e:
+            ok, detail = False, f"{type(e).__name__}: {e}"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+        print(f"\n[{'PASS' if ok else 'FAIL'}] {name}")
+        print(f"  {detail}")
+
+    print("\n" + "=" * 70)
+    print(f"Results: {passed} passed, {failed} failed")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,9 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(__file__))
 
-from template import parse_output
+from template import (parse_output, parse_grid, scan_grid, voting_grids, get_voting_stats,
+                      is_vote_decided, StreamingOutputParser)
+from grid_codec import encode_grid, decode_grid
 
 # 测试用例集合
 test_cases = [
@@ -25,6 +27,10 @@ Better attempt: [[5, 6], [7, 8]]
 FINAL OUTPUT: [[0, 1], [2, 3]]""", [[0, 1], [2, 3]]),
     ("空网格返回空列表", "No grid here", []),
     ("嵌套网格with spaces", "OUTPUT: [ [ 1 , 2 ] , [ 3 , 4 ] ]", [[1, 2], [3, 4]]),
+    ("多行网格", "OUTPUT:\n[[1, 2],\n [3, 4]]\nDone.", [[1, 2], [3, 4]]),
+    ("跳过无效候选", "Lists [[a, b]] and [[1, 2.5]] first, then [[7, 8], [9, 0]]", [[7, 8], [9, 0]]),
+    ("OUTPUT 标签优先", "Example [[1]] before the tag. OUTPUT: [[2, 3]]", [[2, 3]]),
+    ("未闭合的网格返回空列表", "OUTPUT: [[1, 2], [3, 4]", []),
 ]
 
 print("=" * 70)
@@ -50,6 +56,148 @@ for test_name, input_text, expected_output in test_cases:
     print(f"  Expected: {expected_output}")
     print(f"  Got: {result}")
 
+# 逐块喂入（GridScanner）的结果应与 parse_output 一致，与分块大小无关
+for test_name, input_text, expected_output in test_cases:
+    for chunk_size in (1, 3, 64):
+        chunks = [input_text[i:i + chunk_size] for i in range(0, len(input_text), chunk_size)]
+        result = scan_grid(chunks)
+        if result == expected_output:
+            passed += 1
+        else:
+            failed += 1
+            print(f"\n[FAIL] {test_name} (chunked, size {chunk_size})")
+            print(f"  Expected: {expected_output}")
+            print(f"  Got: {result}")
+
+# parse_grid 返回 Grid：与 parse_output 的列表相等；无效结果为 None
+for test_name, input_text, expected_output in test_cases:
+    result = parse_grid(input_text)
+    if (result == expected_output) if expected_output else result is None:
+        passed += 1
+    else:
+        failed += 1
+        print(f"\n[FAIL] {test_name} (parse_grid)")
+        print(f"  Expected: {expected_output}")
+        print(f"  Got: {result}")
+
+# 投票按 Grid.key 计数：列表与 Grid 混合、无效预测不计票、票数相同取先出现的
+voting_cases = [
+    ("mixed list / Grid", [[[1, 2]], parse_grid("[[3, 4]]"), [[3, 4]], [], None], [[3, 4]], 2, 3),
+    ("ragged ignored", [[[1], [2, 3]], [[5]]], [[5]], 1, 1),
+    ("tie keeps first", [[[7]], [[8]]], [[7]], 1, 2),
+    ("no valid grids", [[], None], [], 0, 0),
+]
+for test_name, grids, expected_winner, expected_count, expected_valid in voting_cases:
+    winner = voting_grids(grids)
+    stats = get_voting_stats(grids)
+    if (winner == expected_winner and stats["winning_grid"] == expected_winner
+            and stats["winning_count"] == expected_count and stats["valid_predictions"] == expected_valid):
+        passed += 1
+    else:
+        failed += 1
+        print(f"\n[FAIL] voting: {test_name}")
+        print(f"  Expected: {expected_winner} x{expected_count} ({expected_valid} valid)")
+        print(f"  Got: {winner}, {stats}")
+
+# cell 规则：按形状分组后逐格多数表决；每个采样错一个不同的格子时仍能还原正确网格
+near_misses = [[[1, 2], [3, 5]], [[1, 0], [3, 4]], [[9, 2], [3, 4]], [[1, 2], [0, 4]], [[1, 2, 0]]]
+cell_cases = [
+    ("one wrong cell per sample", near_misses, [[1, 2], [3, 4]]),
+    ("most common shape wins", [[[1, 2, 0]], [[4]], [[5]], [[4]]], [[4]]),
+    ("tied cell keeps first sample", [[[1, 2]], [[3, 4]]], [[1, 2]]),
+    ("no valid grids", [[], None], []),
+]
+for test_name, grids, expected_winner in cell_cases:
+    winner = voting_grids(grids, policy="cell")
+    stats = get_voting_stats(grids, policy="cell")
+    if winner == expected_winner and stats["winning_grid"] == expected_winner:
+        passed += 1
+    else:
+        failed += 1
+        print(f"\n[FAIL] cell voting: {test_name}")
+        print(f"  Expected: {expected_winner}")
+        print(f"  Got: {winner}, {stats}")
+
+# cell 规则的提前停止：剩余采样不足以改变形状或任何一个格子时才停止
+early_stop_cases = [
+    ("unanimous, 2 left", [[[1, 2]]] * 3, 5, True),
+    ("one cell margin 1, 2 left", [[[1, 2]], [[1, 2]], [[1, 3]]], 5, False),
+    ("shape not settled", [[[1, 2]], [[1, 2]], [[1]]], 5, False),
+]
+for test_name, grids, max_samples, expected in early_stop_cases:
+    result = is_vote_decided(grids, max_samples, policy="cell")
+    if result == expected:
+        passed += 1
+    else:
+        failed += 1
+        print(f"\n[FAIL] cell early stop: {test_name}")
+        print(f"  Expected: {expected}")
+        print(f"  Got: {result}")
+
+# 紧凑格式（GRID_ENCODING）：编码后再解码得到原网格；parse_output 能从回答中读回
+codec_grids = [
+    [[0, 1, 1], [0, 0, 2]],
+    [[3]],
+    [[1, 2, 3, 4]],
+    [[5, 5], [5, 5]],
+    [[7], [0], [7]],
+    [[(r * 3 + c * 7) % 10 if (r + c) % 4 else 0 for c in range(12)] for r in range(9)],
+]
+for encoding in ("rows", "rle", "sparse"):
+    for grid in codec_grids:
+        encoded = encode_grid(grid, encoding)
+        reply = f"OBSERVATIONS: the year 2024\n3\nOUTPUT:\n{encoded}\nThe rule fills the gaps.\nDone."
+        decoded = decode_grid(encoded, encoding)
+        parsed = parse_output(reply, encoding=encoding)
+        if decoded == grid and parsed == grid:
+            passed += 1
+        else:
+            failed += 1
+            print(f"\n[FAIL] {encoding} round trip {len(grid)}x{len(grid[0])}")
+            print(f"  Encoded: {encoded!r}")
+            print(f"  Got: decode={decoded}, parse_output={parsed}")
+
+# 没有 "OUTPUT:" 时在整段回答中查找：单独一行的数字不算网格，至少两行等宽的行才算
+whole_text_cases = [
+    ("rows", "The year 2024 matters.\n2024\n3\n\nno grid here", []),
+    ("rows", "Count:\n3\n\nGrid:\n011\n002\n", [[0, 1, 1], [0, 0, 2]]),
+    ("rows", "Ragged:\n01\n002\n\nGrid:\n12\n34", [[1, 2], [3, 4]]),
+    ("rle", "Answer has 3 colors\n3\n\nthat is all", []),
+    ("rle", "3\n\n0 1*2\n0*2 2", [[0, 1, 1], [0, 0, 2]]),
+]
+for encoding, text, expected in whole_text_cases:
+    result = parse_output(text, encoding=encoding)
+    if result == expected:
+        passed += 1
+    else:
+        failed += 1
+        print(f"\n[FAIL] {encoding} whole-text fallback: {text!r}")
+        print(f"  Expected: {expected}")
+        print(f"  Got: {result}")
+
+# 流式解析：紧凑格式的网格在后面出现一整行其他内容时即可提前给出结果；网格在回答末尾时等到结束
+streaming_cases = [(encoding, ending) for encoding in ("json", "rows", "rle", "sparse")
+                   for ending in ("\nThe rule fills the gaps.\n", "\nThe rule fills the gaps. ")]
+for encoding, ending in streaming_cases:
+    grid = codec_grids[0]
+    full = f"Reasoning 2024\n3\nOUTPUT:\n{encode_grid(grid, encoding)}{ending}" + "x" * 200
+    for chunk_size in (1, 3, 64):
+        parser = StreamingOutputParser(encoding=encoding)
+        result = None
+        for i in range(0, len(full), chunk_size):
+            result = parser.feed(full[i:i + chunk_size])
+            if result is not None:
+                break
+        tail_parser = StreamingOutputParser(encoding=encoding)
+        tail_result = tail_parser.feed(f"OUTPUT:\n{encode_grid(grid, encoding)}")
+        early = result == grid and len(parser.text) < len(full) and parse_output(parser.text, encoding=encoding) == grid
+        if early and (tail_result is None or encoding == "json"):
+            passed += 1
+        else:
+            failed += 1
+            print(f"\n[FAIL] {encoding} streaming (chunk size {chunk_size})")
+            print(f"  Got: {result} after {len(parser.text)}/{len(full)} chars, unterminated: {tail_result}")
+
 print("\n" + "=" * 70)
 print(f"Results: {passed} passed, {failed} failed")
 print("=" * 70)
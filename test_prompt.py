@@ -6,11 +6,25 @@
 # 5）统计有多少完全匹配 ground truth 并计算 accuracy
 
 import os, json, time
+import argparse
+import asyncio
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from openai import OpenAI
-from httpx import Timeout
-from prompt import construct_prompt, prompt_v5_chain1_hypothesis, prompt_v5_reflexion_verify, prompt_v5_chain2_predict
-from template import parse_output, generate_markdown_report, voting_grids, get_voting_stats, extract_python_code, execute_transform_code, extract_hypothesis, extract_corrected_hypothesis
+from openai import BadRequestError
+from llm_client import get_client, get_api_config
+from results_log import ResultsLog
+from metrics import CallMetricsLog, set_call_metrics_log, collect_task_metrics, timed, call_sample, record_api_call, record_cache_hit, record_parse
+from call_policy import get_call_policy, estimate_tokens, submit_with_context, task_deadline, request_cancelled
+from response_cache import get_response_cache, make_cache_key, CacheMissError
+from prompt import prepare_task, get_v5_mode
+from strategies import TaskContext, get_strategy, run_strategy
+from grid import grids_equal, to_list
+from code_cache import get_result_cache
+from sandbox import get_sandbox_pool
+from template import (parse_grid, generate_markdown_report, get_voting_stats, should_stop_sampling,
+                      get_voting_policy, StreamingOutputParser)
 
 # 加载 .env 文件
 load_dotenv()
@@ -56,13 +70,13 @@ def check_accuracy(predictions, ground_truths):
     
     correct_count = 0
     for pred, ground_truth in zip(predictions, ground_truths):
-        if pred == ground_truth:
+        if grids_equal(pred, ground_truth):
             correct_count += 1
     
     accuracy = correct_count / len(predictions)
     return accuracy
 
-def speak_and_listen(messages, model_name, temperature=0.0):
+def speak_and_listen(messages, model_name, temperature=0.0, sample_index=0, call_info=None):
     """
     功能：
         调用大语言模型 API，将 messages 作为对话输入，返回模型生成的文本回答。
@@ -76,77 +90,513 @@ def speak_and_listen(messages, model_name, temperature=0.0):
             ...
           ]
         - 本函数只负责“发送请求 + 接收模型回答”，不做解析。
+        - 设置 RESPONSE_CACHE_PATH 后，相同请求的回答直接从本地缓存读取；
+          回放模式（RESPONSE_CACHE_MODE=replay）下未命中会抛出 CacheMissError。
+        - 设置 API_STREAM=1 后使用流式输出，"OUTPUT:" 之后的网格一旦完整即取消剩余输出。
 
     输入参数：
         messages: 列表（list），对话内容，由 construct_prompt(d) 返回。
         model_name: 字符串（str），要调用的模型名称，例如 "gpt-4o-mini"。
         temperature: 浮点数（float），采样温度，控制随机性，默认 0.0。
         timeout: 整数（int），API 调用超时时间（秒），默认 60 秒。
+        sample_index: 整数（int），采样序号，作为缓存键的一部分区分同一请求的多次采样，默认 0。
+        call_info: 字典（dict），可选。调用结束后写入本次调用的信息：
+                   "cache_hit"，以及流式模式下的 "first_token_time" / "prediction_time" /
+                   "stream_time" / "cancelled"（秒，从发出请求开始计）。
 
     返回值：
         reply_text: 字符串（str），表示模型的主回答文本内容。
                     之后会被交给 parse_output(reply_text) 进行网格解析。
-    """    # 从环境变量读取 API 配置
-    api_key = os.getenv("DEEPSEEK_API_KEY")
-    base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-    timeout = int(os.getenv("API_TIMEOUT_SECONDS", "60"))
-    max_tokens = int(os.getenv("API_MAX_TOKENS", "1000"))
+    """
+    cache = get_response_cache()
+    cache_key = None
+    if cache is not None:
+        max_tokens = get_api_config()["max_tokens"]
+        cache_key = make_cache_key(messages, model_name, temperature, max_tokens, sample_index)
+        cached_text = cache.get(cache_key)
+        if cached_text is not None:
+            record_cache_hit(sample_index)
+            if call_info is not None:
+                call_info["cache_hit"] = True
+            return cached_text
+        if cache.readonly:
+            raise CacheMissError(f"Response not in cache (replay mode), sample {sample_index}")
+    
+    if call_info is not None:
+        call_info["cache_hit"] = False
+    with call_sample(sample_index):
+        reply_text = _call_model(messages, model_name, temperature, call_info=call_info)
+    
+    if cache is not None:
+        cache.put(cache_key, reply_text)
+    return reply_text
+
+
+def _policy_call(request, estimated_tokens):
+    """
+    通过调用策略层发送一次请求，返回 (结果, 策略统计, 耗时秒数)
+    请求最终失败时记录一条失败的调用记录后重新抛出异常
+    """
+    stats = {}
+    start = time.perf_counter()
+    try:
+        result = get_call_policy().call(request, estimated_tokens=estimated_tokens, stats=stats)
+    except Exception as e:
+        record_api_call(time.perf_counter() - start, stats=stats, error=e)
+        raise
+    return result, stats, time.perf_counter() - start
+
+
+def _call_model(messages, model_name, temperature, call_info=None):
+    """
+    实际发送一次 API 请求（不经过缓存），返回回答文本
+    请求经过调用策略层（限流 / 重试 / 截止时间 / 对冲），见 call_policy.py
+    """
+    api_config = get_api_config()
+    if api_config["stream"]:
+        return _call_model_stream(messages, model_name, temperature, call_info=call_info)
     
-    # 初始化 OpenAI 客户端（DeepSeek 兼容 OpenAI 接口）
-    client = OpenAI(api_key=api_key, base_url=base_url, timeout=Timeout(timeout))
+    # 使用共享客户端（连接池 + keep-alive），不再每次调用都新建 OpenAI 客户端
+    client = get_client()
+    max_tokens = api_config["max_tokens"]
+    
+    def request(timeout):
+        request_client = client if timeout is None else client.with_options(timeout=timeout)
+        return request_client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
     
     # 调用 API
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    response, stats, latency = _policy_call(request, estimate_tokens(messages, max_tokens))
+    record_api_call(latency, response.usage, stats=stats)
     
     # 提取回答文本
     reply_text = response.choices[0].message.content
     return reply_text
 
 
-def speak_and_listen_multiple(messages, model_name, num_samples=5, temperature=None):
+def _call_model_stream(messages, model_name, temperature, call_info=None):
+    """
+    流式发送一次 API 请求，边接收边用 StreamingOutputParser 解析；
+    "OUTPUT:" 之后出现完整有效的网格时立即关闭流，不再等待后续 tokens。
+    返回已收到的回答文本（在网格处截断），计时信息写入 call_info。
+    调用方放弃这次请求时（call_policy.request_cancelled()），也在下一个分块处关闭流。
+    """
+    client = get_client()
+    max_tokens = get_api_config()["max_tokens"]
+    
+    def request(timeout):
+        request_client = client if timeout is None else client.with_options(timeout=timeout)
+        start = time.perf_counter()
+        stream = request_client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        
+        parser = StreamingOutputParser()
+        timings = {"first_token_time": None, "prediction_time": None, "stream_time": None, "cancelled": False}
+        try:
+            for chunk in stream:
+                if request_cancelled():
+                    # 任务截止时间已到（或对冲的另一个请求已先返回），调用方不再等待这个回答
+                    break
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if timings["first_token_time"] is None:
+                    timings["first_token_time"] = time.perf_counter() - start
+                if parser.feed(delta) is not None:
+                    timings["prediction_time"] = time.perf_counter() - start
+                    timings["cancelled"] = chunk.choices[0].finish_reason is None
+                    break
+        finally:
+            # 提前 break 时关闭底层连接，服务端随之停止生成
+            stream.close()
+        
+        timings["stream_time"] = time.perf_counter() - start
+        if timings["prediction_time"] is None:
+            # 没有提前得到网格：预测要等到整个回答结束后再解析
+            timings["prediction_time"] = timings["stream_time"]
+        return parser.text, timings
+    
+    (reply_text, timings), stats, latency = _policy_call(request, estimate_tokens(messages, max_tokens))
+    # 提前取消的流拿不到 usage，按字符数估算 tokens
+    usage = SimpleNamespace(prompt_tokens=estimate_tokens(messages), completion_tokens=len(reply_text) // 4)
+    record_api_call(latency, usage, stats=stats)
+    if call_info is not None:
+        call_info.update(timings)
+    return reply_text
+
+
+def speak_and_listen_n(messages, model_name, n, temperature=1.0, sample_indices=None):
+    """
+    功能：
+        在一次请求中通过 API 的 n 参数获取 n 个独立采样的回答。
+
+    输入参数：
+        messages: 列表（list），对话内容。
+        model_name: 字符串（str），模型名称。
+        n: 整数（int），需要的回答数。
+        temperature: 浮点数（float），采样温度。
+        sample_indices: 列表（list），可选。这 n 个回答对应的采样序号，写入调用记录。
+
+    返回值：
+        reply_texts: 列表（list），每个 choice 的回答文本。
+                     不支持 n 的后端可能只返回 1 个，调用方需要检查数量。
+    """
+    client = get_client()
+    max_tokens = get_api_config()["max_tokens"]
+    
+    def request(timeout):
+        request_client = client if timeout is None else client.with_options(timeout=timeout)
+        return request_client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n=n
+        )
+    
+    response, stats, latency = _policy_call(request, estimate_tokens(messages, max_tokens * n))
+    returned = len(response.choices)
+    record_api_call(latency, response.usage, stats=stats, samples=returned,
+                    sample_indices=sample_indices[:returned] if sample_indices is not None else None)
+    
+    return [choice.message.content for choice in response.choices]
+
+
+# 记录各 (base_url, model) 是否支持 n 参数，避免每次都先试探一次
+_n_support = {}
+_n_support_lock = threading.Lock()
+
+
+def _supports_n(model_name):
+    """
+    判断当前后端是否应尝试使用 n 参数
+    API_SUPPORTS_N: "1" 强制使用, "0" 禁用, "auto"（默认）首次试探后记住结果
+    """
+    setting = os.getenv("API_SUPPORTS_N", "auto")
+    if setting in ("0", "1"):
+        return setting == "1"
+    key = (get_api_config()["base_url"], model_name)
+    return _n_support.get(key, True)
+
+
+def _remember_n_support(model_name, supported):
+    key = (get_api_config()["base_url"], model_name)
+    with _n_support_lock:
+        _n_support[key] = supported
+
+
+def speak_and_listen_multiple(messages, model_name, num_samples=5, temperature=None, log=print, sample_offset=0):
     """
-    多次调用模型获取多个预测（用于自我一致性投票）
+    多次采样获取多个预测（用于自我一致性投票）
+    
+    采样策略：
+    0. 启用回答缓存时，先读取已缓存的采样
+    1. 后端支持 n 参数时，一次请求拿到全部采样
+    2. 否则（或 n 请求失败 / 返回数量不足时），剩余采样并发发送，每个采样独立处理失败
     
     参数:
     messages: 对话消息列表
     model_name: 模型名称
     num_samples: 采样次数
     temperature: 采样温度，默认为 1.0
+    log: 日志输出函数，默认为 print
+    sample_offset: 第一个采样的全局序号（用于缓存键），分批采样时传入已用的采样数
     
     返回:
-    list: 多个预测结果列表
+    list: 多个预测结果列表（按采样顺序，失败的采样不计入）
     """
-    results = []
+    # 使用固定的温度 1.0
+    temp = 1.0 if temperature is None else temperature
     
-    for i in range(num_samples):
+    # texts[i] 为第 i 个采样的回答，None 表示尚未获得
+    texts = [None] * num_samples
+    
+    # 策略 0: 先从本地缓存读取已有的采样
+    cache = get_response_cache()
+    cache_keys = [None] * num_samples
+    if cache is not None:
+        max_tokens = get_api_config()["max_tokens"]
+        for i in range(num_samples):
+            cache_keys[i] = make_cache_key(messages, model_name, temp, max_tokens, sample_offset + i)
+            texts[i] = cache.get(cache_keys[i])
+            if texts[i] is not None:
+                record_cache_hit(sample_offset + i)
+                log(f"    Sample {i+1}/{num_samples} completed (cached)")
+    
+    missing = [i for i in range(num_samples) if texts[i] is None]
+    offline = cache is not None and cache.readonly
+    
+    # 策略 1: 单次请求 + n 参数
+    if len(missing) > 1 and not offline and _supports_n(model_name):
         try:
-            # 使用固定的温度 1.0
-            if temperature is None:
-                temp = 1.0
-            else:
-                temp = temperature
+            reply_texts = speak_and_listen_n(messages, model_name, len(missing), temperature=temp,
+                                             sample_indices=[sample_offset + i for i in missing])
+            _remember_n_support(model_name, len(reply_texts) >= len(missing))
+            for i, reply_text in zip(missing, reply_texts):
+                texts[i] = reply_text
+                if cache is not None:
+                    cache.put(cache_keys[i], reply_text)
+                log(f"    Sample {i+1}/{num_samples} completed (n={len(missing)} request)")
+        except BadRequestError as e:
+            # 后端不接受 n 参数，记住后改为并发采样
+            _remember_n_support(model_name, False)
+            log(f"    n={len(missing)} request rejected, falling back to concurrent samples: {str(e)}")
+        except Exception as e:
+            log(f"    n={len(missing)} request failed, falling back to concurrent samples: {str(e)}")
+    
+    # 策略 2: 剩余的采样并发发送
+    missing = [i for i in range(num_samples) if texts[i] is None]
+    if missing and offline:
+        for i in missing:
+            log(f"    Sample {i+1}/{num_samples} failed: not in cache (replay mode)")
+        missing = []
+    
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = []
+            for i in missing:
+                # 调用记录带上采样序号：并发采样的完成顺序与采样顺序不一定相同
+                with call_sample(sample_offset + i):
+                    futures.append(submit_with_context(executor, _call_model, messages, model_name, temp))
+            for i, future in zip(missing, futures):
+                try:
+                    texts[i] = future.result()
+                    if cache is not None:
+                        cache.put(cache_keys[i], texts[i])
+                    log(f"    Sample {i+1}/{num_samples} completed")
+                except Exception as e:
+                    log(f"    Sample {i+1}/{num_samples} failed: {str(e)}")
+                    continue
+    
+    return [text for text in texts if text is not None]
+
+def speak_and_listen_adaptive(messages, model_name, max_samples=5, min_samples=None, confidence_threshold=None, temperature=None,
+                              policy="exact", log=print):
+    """
+    自适应自我一致性投票：逐步采样，投票结果确定后提前停止
+    
+    流程：
+    1. 先（并行）获取 min_samples 个采样，默认为 max_samples 的多数票数
+    2. 之后每次只追加 1 个采样，直到 should_stop_sampling 判定可以停止
+    
+    不设置 confidence_threshold 时，只有在剩余采样无法推翻赢家时才停止，
+    因此最终赢家与采满 max_samples 个时相同。
+    
+    参数:
+    messages: 对话消息列表
+    model_name: 模型名称
+    max_samples: 最大采样数
+    min_samples: 首批采样数，默认为 max_samples // 2 + 1
+    confidence_threshold: 信心阈值 (0-1)，None 表示不使用
+    temperature: 采样温度，默认为 1.0
+    policy: 投票规则，"exact"（整格匹配）或 "cell"（逐格多数表决）
+    log: 日志输出函数，默认为 print
+    
+    返回:
+    tuple: (reply_texts, predicted_grids, voting_stats)
+           voting_stats 在 get_voting_stats 的基础上增加
+           "samples_used" / "max_samples" / "early_stopped" 字段
+    """
+    if min_samples is None:
+        min_samples = max_samples // 2 + 1
+    min_samples = max(1, min(min_samples, max_samples))
+    
+    reply_texts = []
+    predicted_grids = []
+    samples_used = 0
+    # 用于停止判断的网格列表：失败的采样记为无效预测（None）
+    attempted_grids = []
+    
+    batch_size = min_samples
+    while True:
+        replies = speak_and_listen_multiple(messages, model_name, num_samples=batch_size, temperature=temperature,
+                                            log=log, sample_offset=samples_used)
+        with timed("parse"):
+            grids = [parse_grid(text) for text in replies]
+        record_parse(grids)
+        
+        reply_texts.extend(replies)
+        predicted_grids.extend(grids)
+        attempted_grids.extend(grids + [None] * (batch_size - len(replies)))
+        samples_used += batch_size
+        
+        if should_stop_sampling(attempted_grids, max_samples, min_samples, confidence_threshold, policy):
+            break
+        batch_size = 1
+    
+    voting_stats = get_voting_stats(predicted_grids, policy)
+    voting_stats["samples_used"] = samples_used
+    voting_stats["max_samples"] = max_samples
+    voting_stats["early_stopped"] = samples_used < max_samples
+    
+    return reply_texts, predicted_grids, voting_stats
+
+# 策略执行时使用的模型调用函数（见 strategies.TaskContext）
+MODEL_CALLS = SimpleNamespace(
+    speak_and_listen=speak_and_listen,
+    speak_and_listen_multiple=speak_and_listen_multiple,
+    speak_and_listen_adaptive=speak_and_listen_adaptive,
+)
+
+
+def process_task(idx, total, task, config, log=print):
+    """
+    功能：
+        处理单个任务：按 prompt_version 对应的策略（strategies.py）构造 prompt、调用模型、
+        解析输出，并记录耗时。顺序模式与并发模式共用此函数，保证两种模式下的行为一致。
+
+    输入参数：
+        idx: 整数（int），任务在数据集中的下标。
+        total: 整数（int），任务总数，仅用于日志显示。
+        task: 字典（dict），一个 ARC 任务。
+        config: 字典（dict），评测配置（model_name / temperature / prompt_version / num_samples_v3 / task_deadline 等）。
+        log: 可调用对象，用于输出本任务的日志，默认直接 print。
+             并发模式下传入缓冲函数，任务结束后再整体输出，避免日志交错。
+
+    返回值：
+        result: 字典（dict），包含 "index" / "replies" / "predicted_grid" /
+                "ground_truth" / "voting_stats" / "task_time" / "metrics" /
+                "dropped_train_pairs" / "error" 字段。
+                "replies" 为本任务所有模型原始回答（按调用顺序）。
+                "dropped_train_pairs" 为因 tokens 预算未放入提示词的训练样本下标。
+                "error" 为任务出错时的错误信息（截止时间、API 错误、回放缓存未命中等），
+                正常完成时为 None；--resume 会重新执行出错的任务。
+    """
+    prompt_version = config["prompt_version"]
+    strategy = get_strategy(prompt_version)
+
+    task_start_time = time.time()
+    log(f"[{idx + 1}/{total}] Processing task...")
+
+    predicted_grid = []
+    voting_stats = None
+    replies = []
+    dropped_train = []
+    error = None
+    ground_truth_grid = task['test'][0]['output']
+
+    # 本任务内的所有模型调用共享同一个截止时间（TASK_DEADLINE_SECONDS），并计入同一份统计
+    with task_deadline(config.get("task_deadline")), collect_task_metrics(prompt_version=prompt_version, task_index=idx) as metrics:
+        try:
+            # 网格只序列化一次，各阶段共用；超出 tokens 预算的训练样本在这里被丢弃
+            with timed("prompt"):
+                prepared = prepare_task(task)
+            dropped_train = list(prepared.dropped_train)
+            if dropped_train:
+                log(f"  Token budget {prepared.token_budget}: dropped train pairs {dropped_train} "
+                    f"(kept {prepared.num_train}/{len(task['train'])})")
             
-            reply_text = speak_and_listen(messages, model_name, temperature=temp)
-            results.append(reply_text)
+            # 调用大模型：按策略声明的阶段执行（见 strategies.py）
+            log(f"  Calling model...")
+            ctx = TaskContext(task, config, MODEL_CALLS, log=log, prepared=prepared)
+            try:
+                predicted_grid = run_strategy(strategy, ctx)
+            finally:
+                replies = ctx.replies
+                voting_stats = ctx.voting_stats
             
-            print(f"    Sample {i+1}/{num_samples} completed")
+            # 输出本任务结果
+            if grids_equal(predicted_grid, ground_truth_grid):
+                log(f"  ✓ Correct!")
+            else:
+                log(f"  ✗ Incorrect")
+                log(f"    Predicted: {predicted_grid}")
+                log(f"    Expected:  {ground_truth_grid}")
+        
         except Exception as e:
-            print(f"    Sample {i+1}/{num_samples} failed: {str(e)}")
-            continue
-    
+            log(f"  Error: {str(e)}")
+            predicted_grid = []
+            error = f"{type(e).__name__}: {e}"
+        
+    # 记录任务耗时
+    task_time = time.time() - task_start_time
+    log(f"  Time: {task_time:.2f}s")
+    log()
+
+    return {
+        "index": idx,
+        "replies": replies,
+        "predicted_grid": to_list(predicted_grid),
+        "ground_truth": ground_truth_grid,
+        "voting_stats": voting_stats,
+        "task_time": task_time,
+        "metrics": metrics.as_dict(),
+        "dropped_train_pairs": dropped_train,
+        "error": error,
+    }
+
+
+async def run_tasks_async(pending, total, config, concurrency, on_result=None):
+    """
+    功能：
+        并发评测任务。每个任务在线程池中运行 process_task，
+        用信号量限制同时处理（即同时在途请求）的任务数量。
+
+        - 每个任务的日志先缓冲，任务结束后一次性输出，避免多个任务的日志交错；
+        - 返回结果以任务下标为键，由调用方按下标排列，与顺序模式完全一致，
+          因此 task_times 统计和 generate_markdown_report 的输出顺序不变。
+
+    输入参数：
+        pending: 列表（list），待处理的 (任务下标, 任务) 二元组。
+        total: 整数（int），任务总数，仅用于日志显示。
+        config: 字典（dict），评测配置，原样传给 process_task。
+        concurrency: 整数（int），同时在途的任务数上限。
+        on_result: 可调用对象，每个任务完成时以其结果调用一次（例如写入结果日志），可选。
+
+    返回值：
+        results: 字典（dict），任务下标 -> process_task 结果。
+    """
+    # 默认线程池的线程数有上限，这里按并发数显式创建，保证信号量才是唯一的限制
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {}
+
+    async def run_one(idx, task):
+        async with semaphore:
+            lines = []
+            log = lambda msg="": lines.append(msg)
+            results[idx] = await asyncio.to_thread(process_task, idx, total, task, config, log)
+        print("\n".join(lines))
+        if on_result is not None:
+            on_result(results[idx])
+
+    await asyncio.gather(*(run_one(idx, task) for idx, task in pending))
     return results
 
+
 def main():
     """
     功能：
         串联整个评测流程，形成完整的 pipeline。
         主要步骤示意（具体实现由你在填代码时决定）：
+
+        每个任务完成后立即追加到结果日志（--results-log，默认 results_log.jsonl）。
+        使用 --resume 时跳过日志中已完成的任务，并用日志中的结果重建准确率和报告。
     """
+    parser = argparse.ArgumentParser(description="Evaluate prompts on ARC tasks")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip tasks already in the results log and rebuild the report from it")
+    parser.add_argument("--results-log", default=os.getenv("RESULTS_LOG", "results_log.jsonl"),
+                        help="append-only per-task results log (default: results_log.jsonl)")
+    parser.add_argument("--call-metrics", default=os.getenv("CALL_METRICS_LOG", "call_metrics.jsonl"),
+                        help="per-call metrics log, empty to disable (default: call_metrics.jsonl)")
+    parser.add_argument("--metrics-prom", default=os.getenv("METRICS_PROM_PATH", "metrics.prom"),
+                        help="Prometheus text snapshot written at the end, empty to disable (default: metrics.prom)")
+    args = parser.parse_args()
+    
     # 配置参数
     data_path = "val.jsonl"  # 可改为 "val_hard.jsonl"
     model_name = os.getenv("MODEL_NAME", "nex-n1")
@@ -155,158 +605,153 @@ def main():
     num_samples_v3 = int(os.getenv("NUM_SAMPLES_V3", "5"))  # V3 的采样次数
     fast_mode = os.getenv("FAST_MODE", "0") == "1"  # 快速模式（仅测试前5个任务）
     api_timeout = int(os.getenv("API_TIMEOUT_SECONDS", "60"))  # API 超时时间（秒）
+    concurrency = max(1, int(os.getenv("EVAL_CONCURRENCY", "1")))  # 同时处理的任务数（1 表示顺序执行）
+    v3_early_stop = os.getenv("V3_EARLY_STOP", "0") == "1"  # V3 自适应投票（结果确定后提前停止采样）
+    v3_min_samples = os.getenv("V3_MIN_SAMPLES")  # 自适应投票的首批采样数，默认为多数票数
+    v3_confidence_threshold = os.getenv("V3_CONFIDENCE_THRESHOLD")  # 自适应投票的信心阈值，默认不使用
+    task_deadline_seconds = float(os.getenv("TASK_DEADLINE_SECONDS", "0"))  # 单个任务的截止时间（秒），0 表示不限制
+    v5_mode = get_v5_mode()  # V5 三个阶段是独立请求（chain）还是同一段对话（conversation）
+    voting_policy = get_voting_policy()  # V3 投票规则：整格匹配（exact）或逐格多数表决（cell）
+    v4_repair = os.getenv("V4_REPAIR", "1") == "1"  # V4 代码未通过训练样本验证时，带差异说明再请求一次修正
+    num_programs_v4 = int(os.getenv("NUM_PROGRAMS_V4", "1"))  # V4 每个任务的候选程序数（>1 时并发采样，取第一个通过训练样本的程序）
+    
+    config = {
+        "model_name": model_name,
+        "temperature": temperature,
+        "prompt_version": prompt_version,
+        "num_samples_v3": num_samples_v3,
+        "v3_early_stop": v3_early_stop,
+        "v3_min_samples": int(v3_min_samples) if v3_min_samples else None,
+        "v3_confidence_threshold": float(v3_confidence_threshold) if v3_confidence_threshold else None,
+        "task_deadline": task_deadline_seconds,
+        "v5_mode": v5_mode,
+        "voting_policy": voting_policy,
+        "v4_repair": v4_repair,
+        "num_programs_v4": num_programs_v4,
+    }
     
     # 1) 加载数据
     print(f"Loading data from {data_path}...")
     data = load_jsonl(data_path)
     print(f"Loaded {len(data)} tasks")
-    print(f"Using prompt version: {prompt_version}")
+    print(f"Using prompt version: {prompt_version} ({get_strategy(prompt_version).description})")
     print(f"API timeout: {api_timeout} seconds")
     if fast_mode:
         print(f"⚡ FAST MODE: Testing on first 5 tasks only")
         data = data[:5]
     if prompt_version == 3:
         print(f"V3 will use {num_samples_v3} samples per task (self-consistency voting)")
+        print(f"V3 voting policy: {voting_policy}")
+        if v3_early_stop:
+            print(f"V3 early stopping enabled (stops once the winner can no longer change)")
+    elif prompt_version == 4 and num_programs_v4 > 1:
+        print(f"V4 will sample {num_programs_v4} programs and keep the first that passes the training examples (voting otherwise)")
+    elif prompt_version == 4:
+        print(f"V4 will check each program on the training examples ({'one repair turn on failure' if v4_repair else 'no repair turn'})")
     elif prompt_version == 5:
-        print(f"V5 will use Prompt Chaining + Reflexion (multi-turn verification)")
+        print(f"V5 will use Prompt Chaining + Reflexion (multi-turn verification, {v5_mode} mode)")
+    if concurrency > 1:
+        print(f"Async mode: up to {concurrency} tasks in flight")
     print()
     
-    # 2) 初始化存储预测和真值的列表
-    predictions = []
-    ground_truths = []
-    voting_stats_list = []  # 用于存储 V3 的投票统计
-    task_times = []  # 用于记录每个任务的耗时
+    # 2) 读取已完成的任务（断点续跑），其余任务待处理
+    results_log = ResultsLog(args.results_log)
+    if args.resume:
+        # 出错的任务（截止时间、API 错误、回放缓存未命中等）不算完成，重新放回待处理
+        logged = results_log.load(include_errors=True, prompt_version=prompt_version, data_path=data_path)
+        logged = {idx: record for idx, record in logged.items() if idx < len(data)}
+        completed = {idx: record for idx, record in logged.items() if not record.get("error")}
+        print(f"Resuming: {len(completed)}/{len(data)} tasks already in {args.results_log}")
+        if len(logged) > len(completed):
+            print(f"Retrying {len(logged) - len(completed)} tasks that failed with an error")
+        print()
+    else:
+        results_log.reset()
+        completed = {}
+    
+    # 每次模型调用的记录（阶段、耗时、tokens、重试、缓存命中、解析是否成功）
+    call_metrics = CallMetricsLog(args.call_metrics or None)
+    if not args.resume:
+        call_metrics.reset()
+    set_call_metrics_log(call_metrics)
+    pending = [(idx, task) for idx, task in enumerate(data) if idx not in completed]
+    
+    def record_result(result):
+        results_log.append({"prompt_version": prompt_version, "data_path": data_path, **result})
+    
+    # V4 会执行生成的代码：在启动评测线程之前创建沙箱进程池，启动开销不计入第一个任务
+    if prompt_version == 4 and pending:
+        get_sandbox_pool()
     
     total_start_time = time.time()
     
-    # 3) 遍历每个任务
-    for idx, task in enumerate(data):
-        task_start_time = time.time()
-        print(f"[{idx + 1}/{len(data)}] Processing task...")
-        
-        try:
-            # 构造 prompt（使用指定版本）
-            messages = construct_prompt(task, version=prompt_version)
-            
-            # 调用大模型
-            print(f"  Calling model...")
-            
-            if prompt_version == 3:
-                # V3: 自我一致性投票
-                print(f"  Using self-consistency voting with {num_samples_v3} samples...")
-                reply_texts = speak_and_listen_multiple(messages, model_name, num_samples=num_samples_v3)
-                
-                # 解析所有回答
-                predicted_grids = [parse_output(text) for text in reply_texts]
-                
-                # 投票选择最常见的输出
-                predicted_grid = voting_grids(predicted_grids)
-                voting_stats = get_voting_stats(predicted_grids)
-                voting_stats_list.append(voting_stats)
-                
-                print(f"  Voting: {voting_stats['valid_predictions']} valid predictions")
-                print(f"  Winner appeared {voting_stats['winning_count']} times")
-                print(f"  Confidence: {voting_stats['confidence']:.2%}")
-            elif prompt_version == 4:
-                # V4: Program-Aided Language Models (PAL)
-                print(f"  Using Program-Aided Language Models (PAL)...")
-                reply_text = speak_and_listen(messages, model_name, temperature)
-                
-                # 从回答中提取 Python 代码
-                code = extract_python_code(reply_text)
-                if code:
-                    print(f"  Code extracted, executing...")
-                    # 执行代码获得结果
-                    test_input = task['test'][0]['input']
-                    predicted_grid = execute_transform_code(code, test_input)
-                    if predicted_grid:
-                        print(f"  Code execution successful")
-                    else:
-                        print(f"  Code execution failed, trying to parse output...")
-                        predicted_grid = parse_output(reply_text)
-                else:
-                    print(f"  No code found, falling back to parse_output...")
-                    predicted_grid = parse_output(reply_text)
-            elif prompt_version == 5:
-                # V5: Prompt Chaining + Reflexion
-                print(f"  Using Prompt Chaining + Reflexion...")
-                
-                # Chain 1: 假设
-                print(f"    Chain 1: Generating hypothesis...")
-                chain1_messages = prompt_v5_chain1_hypothesis(task)
-                chain1_reply = speak_and_listen(chain1_messages, model_name, temperature)
-                hypothesis = extract_hypothesis(chain1_reply)
-                print(f"    Hypothesis: {hypothesis[:100]}...")
-                
-                # Reflexion: 验证
-                print(f"    Reflexion: Verifying hypothesis...")
-                reflexion_messages = prompt_v5_reflexion_verify(task, hypothesis)
-                reflexion_reply = speak_and_listen(reflexion_messages, model_name, temperature)
-                
-                # 检查验证结果并可能修正
-                if "VERIFICATION: PASSED" in reflexion_reply:
-                    print(f"    ✓ Hypothesis verified!")
-                    final_hypothesis = hypothesis
-                else:
-                    print(f"    ✗ Hypothesis needs correction")
-                    corrected = extract_corrected_hypothesis(reflexion_reply)
-                    if corrected:
-                        final_hypothesis = corrected
-                        print(f"    Corrected hypothesis: {corrected[:100]}...")
-                    else:
-                        final_hypothesis = hypothesis
-                
-                # Chain 2: 应用修正后的假设
-                print(f"    Chain 2: Applying final hypothesis...")
-                chain2_messages = prompt_v5_chain2_predict(task, final_hypothesis)
-                chain2_reply = speak_and_listen(chain2_messages, model_name, temperature)
-                predicted_grid = parse_output(chain2_reply)
-            else:
-                # V1 和 V2: 单次调用
-                reply_text = speak_and_listen(messages, model_name, temperature)
-                predicted_grid = parse_output(reply_text)
-            
-            # 获取真值
-            ground_truth_grid = task['test'][0]['output']
-            
-            # 存储预测和真值
-            predictions.append(predicted_grid)
-            ground_truths.append(ground_truth_grid)
-            
-            # 输出本任务结果
-            if predicted_grid == ground_truth_grid:
-                print(f"  ✓ Correct!")
-            else:
-                print(f"  ✗ Incorrect")
-                print(f"    Predicted: {predicted_grid}")
-                print(f"    Expected:  {ground_truth_grid}")
-        
-        except Exception as e:
-            print(f"  Error: {str(e)}")
-            predictions.append([])
-            ground_truths.append(task['test'][0]['output'])
-        
-        # 记录任务耗时
-        task_time = time.time() - task_start_time
-        task_times.append(task_time)
-        print(f"  Time: {task_time:.2f}s")
-        print()
+    # 3) 遍历每个待处理任务（顺序或并发），完成一个写入一个
+    if concurrency > 1:
+        new_results = asyncio.run(run_tasks_async(pending, len(data), config, concurrency, on_result=record_result))
+    else:
+        new_results = {}
+        for idx, task in pending:
+            new_results[idx] = process_task(idx, len(data), task, config)
+            record_result(new_results[idx])
     
     total_time = time.time() - total_start_time
     
-    # 4) 计算准确率
+    # 结果按任务下标排列：已完成的取自日志，其余取自本次运行
+    results = [completed[idx] if idx in completed else new_results[idx] for idx in range(len(data))]
+    
+    # 4) 汇总预测、真值、投票统计和耗时
+    predictions = [r["predicted_grid"] for r in results]
+    ground_truths = [r["ground_truth"] for r in results]
+    voting_stats_list = [r["voting_stats"] for r in results if r["voting_stats"] is not None]  # V3 的投票统计
+    task_times = [r["task_time"] for r in results]  # 每个任务的耗时
+    
+    # 5) 计算准确率
     accuracy = check_accuracy(predictions, ground_truths)
     
-    # 5) 输出结果到控制台
+    # 6) 输出结果到控制台
     print("=" * 50)
     print(f"Final Results:")
     print(f"  Accuracy: {accuracy:.2%} ({sum(p == g for p, g in zip(predictions, ground_truths))}/{len(data)})")
-    print(f"  Total time: {total_time:.2f}s")
+    print(f"  Total time: {total_time:.2f}s" + (f" (this session, {len(pending)} tasks)" if completed else ""))
     print(f"  Avg time per task: {sum(task_times)/len(task_times):.2f}s")
     print(f"  Min/Max time: {min(task_times):.2f}s / {max(task_times):.2f}s")
+    adaptive_stats = [s for s in voting_stats_list if "samples_used" in s]
+    if adaptive_stats:
+        used = sum(s["samples_used"] for s in adaptive_stats)
+        budget = sum(s["max_samples"] for s in adaptive_stats)
+        print(f"  V3 samples used: {used}/{budget} ({sum(s['early_stopped'] for s in adaptive_stats)} tasks stopped early)")
+    trimmed = [r["dropped_train_pairs"] for r in results if r.get("dropped_train_pairs")]
+    if trimmed:
+        print(f"  Token budget: {len(trimmed)} tasks trimmed, {sum(len(d) for d in trimmed)} train pairs dropped")
+    cache = get_response_cache()
+    if cache is not None:
+        cache_stats = cache.stats()
+        print(f"  Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+              f"({cache_stats['hit_rate']:.1%}), {cache_stats['entries']} entries, "
+              f"{cache_stats['size_bytes'] / 1024 / 1024:.1f} MB")
+    code_cache_stats = get_result_cache().stats()
+    if code_cache_stats["hits"] + code_cache_stats["misses"]:
+        print(f"  Code result cache: {code_cache_stats['hits']} hits / {code_cache_stats['misses']} misses "
+              f"({code_cache_stats['hit_rate']:.1%}), {code_cache_stats['entries']} entries, "
+              f"{code_cache_stats['stored_hits']} hits from {code_cache_stats['stored_entries']} stored results")
+    call_summary = call_metrics.summary()
+    prompt_tokens = sum(totals["prompt_tokens"] for totals in call_summary.values())
+    cached_tokens = sum(totals["cached_tokens"] for totals in call_summary.values())
+    if prompt_tokens:
+        print(f"  Prompt cache: {cached_tokens}/{prompt_tokens} prompt tokens served from the provider cache "
+              f"({cached_tokens / prompt_tokens:.1%})")
+    for (_, stage), totals in sorted(call_summary.items()):
+        api_calls = totals["calls"] - totals["cache_hits"]
+        avg_latency = totals["latency_sum"] / api_calls if api_calls else 0.0
+        print(f"  Stage {stage}: {totals['calls']} calls ({totals['cache_hits']} cached, {totals['errors']} failed), "
+              f"avg {avg_latency:.2f}s, {totals['prompt_tokens']}+{totals['completion_tokens']} tokens, "
+              f"{totals['retries']} retries, {totals['parse_failed']} parse failures")
     print("=" * 50)
+    if args.metrics_prom:
+        call_metrics.write_prometheus(args.metrics_prom)
+        print(f"Metrics snapshot written to {args.metrics_prom}")
     
-    # 6) 生成 markdown 报告并追加保存
+    # 7) 生成 markdown 报告并追加保存
     print("\nGenerating markdown report...")
     markdown_report = generate_markdown_report(data, predictions, ground_truths, prompt_version=prompt_version)
     
@@ -324,4 +769,4 @@ def main():
 if __name__ == "__main__":
     main()
 
-# 上面的函数只是作为示例框架，你可以任意修改和实现其中的逻辑
\ No newline at end of file
+# 上面的函数只是作为示例框架，你可以任意修改和实现其中的逻辑
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+测试 PAL 代码沙箱（sandbox.py）：正常执行、完整的类 / getattr 支持、超时、内存上限、受限的 import / builtins、工作进程复用、
+没有 main 保护的调用脚本退回到当前进程内执行、执行结果跨进程持久化
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from sandbox import SandboxPool, SandboxError, execute_batch_in_sandbox
+from code_cache import LRUCache, get_result_cache
+from template import execute_transform_code, verify_transform_code, group_programs
+
+
+FLIP = """
+def transform(grid):
+    return [row[::-1] for row in grid]
+"""
+
+USES_IMPORTS = """
+import copy
+from collections import Counter
+
+def transform(grid):
+    out = copy.deepcopy(grid)
+    common = Counter(v for row in grid for v in row).most_common(1)[0][0]
+    return [[common if v == 0 else v for v in row] for row in out]
+"""
+
+LOOP = """
+def transform(grid):
+    while True:
+        pass
+"""
+
+MEMORY = """
+def transform(grid):
+    blocks = []
+    while True:
+        blocks.append([0] * (16 * 1024 * 1024))
+"""
+
+IMPORT_OS = """
+import os
+
+def transform(grid):
+    return [[len(os.listdir("."))]]
+"""
+
+USES_STDLIB = """
+import re
+import sys
+import random
+
+sys.setrecursionlimit(5000)
+
+
+def transform(grid):
+    random.seed(0)
+    digits = re.findall(r"[0-9]", str(grid))
+    return [[int(d) for d in reversed(digits)]]
+"""
+
+OPEN_FILE = """
+def transform(grid):
+    return [[len(open("/etc/hostname").read())]]
+"""
+
+USES_CLASSES = """
+class Shape(object):
+    def __init__(self, cells):
+        self.cells = cells
+
+
+class Mirrored(Shape):
+    def __init__(self, cells):
+        super().__init__([row[::-1] for row in cells])
+
+
+def transform(grid):
+    shape = Mirrored(grid)
+    try:
+        shape.missing
+    except AttributeError:
+        pass
+    return getattr(shape, "cells")
+"""
+
+RECURSES = """
+def transform(grid):
+    return transform(grid)
+"""
+
+# 没有 if __name__ == "__main__": 保护的调用脚本
+UNGUARDED_SCRIPT = """
+import sys
+sys.path.insert(0, {package!r})
+from template import execute_transform_code
+print("result", execute_transform_code("def transform(grid):\\n    return grid[::-1]", [[1], [2]]))
+"""
+
+# 在新进程中执行同一段代码并打印结果缓存的统计
+RESULT_STORE_SCRIPT = """
+import sys
+sys.path.insert(0, {package!r})
+from code_cache import get_result_cache
+from template import execute_transform_code
+
+if __name__ == "__main__":
+    outputs = [execute_transform_code("def transform(grid):\\n    return grid[::-1]", [[n], [n + 1]]) for n in range(3)]
+    stats = get_result_cache().stats()
+    print("outputs", outputs)
+    print("stats", stats["stored_hits"], stats["misses"], stats["stored_entries"])
+"""
+
+RAISES = """
+def transform(grid):
+    return grid[10]
+"""
+
+
+def expect_error(pool, code, text):
+    try:
+        result = pool.run(code, [[1, 2]])
+    except SandboxError as e:
+        return text in str(e), str(e)
+    return False, f"no error, got {result}"
+
+
+def check_basic(pool):
+    """正常代码的结果与在当前进程中执行相同，可以 import 常用模块（包括 sys、re、random）"""
+    flipped = pool.run(FLIP, [[1, 2], [3, 4]])
+    filled = pool.run(USES_IMPORTS, [[0, 2], [2, 3]])
+    stdlib = pool.run(USES_STDLIB, [[1, 2, 3]])
+    ok = flipped == [[2, 1], [4, 3]] and filled == [[2, 2], [2, 3]] and stdlib == [[3, 2, 1]]
+    return ok, f"flip={flipped}, fill={filled}, stdlib={stdlib}"
+
+
+def check_full_builtins(pool):
+    """类、继承、super()、getattr 和 except AttributeError 可以正常使用"""
+    result = pool.run(USES_CLASSES, [[1, 2], [3, 4]])
+    in_process = execute_transform_code(USES_CLASSES, [[5, 6]])
+    return result == [[2, 1], [4, 3]] and in_process == [[6, 5]], f"pool={result}, execute_transform_code={in_process}"
+
+
+def check_reuse(pool):
+    """工作进程被复用：多次执行不会启动新进程"""
+    before = sorted(worker.process.pid for worker in pool._all)
+    for _ in range(20):
+        pool.run(FLIP, [[1, 2]])
+    after = sorted(worker.process.pid for worker in pool._all)
+    return before == after and pool.restarts == 0, f"pids {before} -> {after}, restarts {pool.restarts}"
+
+
+def check_timeout(pool):
+    """死循环在超时后返回错误，之后的执行正常"""
+    start = time.perf_counter()
+    ok, detail = expect_error(pool, LOOP, "timed out")
+    elapsed = time.perf_counter() - start
+    recovered = pool.run(FLIP, [[1, 2]]) == [[2, 1]]
+    return ok and recovered and elapsed < pool.timeout + 1, f"{detail} after {elapsed:.2f}s, recovered={recovered}"
+
+
+def check_memory(pool):
+    """超出内存上限时抛出 MemoryError，不影响评测进程"""
+    ok, detail = expect_error(pool, MEMORY, "MemoryError")
+    recovered = pool.run(FLIP, [[1, 2]]) == [[2, 1]]
+    return ok and recovered, f"{detail}, recovered={recovered}"
+
+
+def check_restricted(pool):
+    """不允许 import os、调用 open；代码中的异常作为错误返回"""
+    results = [expect_error(pool, IMPORT_OS, "not allowed"), expect_error(pool, OPEN_FILE, "NameError"),
+               expect_error(pool, RAISES, "IndexError")]
+    return all(ok for ok, _ in results), "; ".join(detail for _, detail in results)
+
+
+def check_execute_transform_code(pool):
+    """execute_transform_code 在失败时仍返回空列表"""
+    results = [execute_transform_code(FLIP, [[1, 2]]), execute_transform_code(RAISES, [[1, 2]]),
+               execute_transform_code("x = 1", [[1, 2]]), execute_transform_code("", [[1, 2]])]
+    return results == [[[2, 1]], [], [], []], f"{results}"
+
+
+def check_verify_train(pool):
+    """训练样本验证：全部对上时没有失败项；差异说明列出不同的格子 / 形状；执行出错的样本单独记录"""
+    train = [{"input": [[1, 2]], "output": [[2, 1]]}, {"input": [[1, 2, 3]], "output": [[3, 2, 1]]}]
+    wrong = train + [{"input": [[5, 6]], "output": [[6, 0]]}, {"input": [[7]], "output": [[7, 7]]}]
+    passed = verify_transform_code(FLIP, train)
+    failures = verify_transform_code(FLIP, wrong)
+    raising = verify_transform_code(RAISES, train)
+    details = [failure["detail"] for failure in failures]
+    ok = (passed == [] and [failure["index"] for failure in failures] == [2, 3]
+          and details[0] == "1 of 2 cells differ: (0, 1): expected 0, got 5"
+          and details[1] == "wrong shape: expected 1x2, got 1x1"
+          and len(raising) == 2 and all("IndexError" in failure["detail"] for failure in raising))
+    return ok, f"{details}; {raising[0]['detail'] if raising else None}"
+
+
+def check_group_programs(pool):
+    """只有注释、空行和格式不同的程序合并为一个，并记录出现次数"""
+    reformatted = "def transform(grid):  # flip each row\n\n    return [row[::-1]   for row in grid]\n"
+    groups = group_programs([FLIP, None, reformatted, RAISES, "", FLIP])
+    ok = [(code, count) for code, count in groups] == [(FLIP, 3), (RAISES, 1)]
+    return ok, f"{[count for _, count in groups]}"
+
+
+def check_result_cache(pool):
+    """相同（或只有格式不同）的代码在相同输入上只执行一次；修改返回值不影响缓存；
+    普通异常缓存，RecursionError 不缓存；LRU 按上限淘汰"""
+    results = get_result_cache()
+    results.clear()
+    grid = [[4, 5, 6]]
+    first = execute_transform_code(FLIP, grid)
+    first[0][0] = 9
+    second = execute_transform_code("def transform(grid):\n    # same program\n    return [row[::-1] for row in grid]", grid)
+    # RecursionError / MemoryError 与工作进程当时的状态有关，不缓存，下次仍会重新执行
+    recursion = [execute_batch_in_sandbox(RECURSES, [grid])[0][1] for _ in range(2)]
+    execute_transform_code(RAISES, grid)
+    stats = results.stats()
+
+    lru = LRUCache(2)
+    for key in "abc":
+        lru.put(key, key)
+    lru.get("b")
+    lru.put("d", "d")
+    kept = sorted(key for key in "abcd" if lru.get(key) is not None)
+    ok = (second == [[6, 5, 4]] and all(error.startswith("RecursionError") for error in recursion)
+          and stats["hits"] == 1 and stats["entries"] == 2 and kept == ["b", "d"])
+    return ok, f"second={second}, cache={stats}, lru kept {kept}"
+
+
+def check_unguarded_script(pool):
+    """调用脚本没有 main 保护时，工作进程无法启动：打印警告并在当前进程内执行，结果正确"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "driver.py")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(UNGUARDED_SCRIPT.format(package=os.path.dirname(os.path.abspath(__file__))))
+        run = subprocess.run([sys.executable, path], capture_output=True, text=True, timeout=120)
+    ok = "result [[2], [1]]" in run.stdout and "Warning: sandbox worker failed to start" in run.stdout
+    lines = [line for line in run.stdout.splitlines() if line.startswith(("result", "Warning"))]
+    return ok, f"exit={run.returncode}, {lines}"
+
+
+def check_result_store(pool):
+    """执行成功的结果写入 RESULT_CACHE_PATH：第二个进程直接读到上一个进程的结果，不再执行"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "driver.py")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(RESULT_STORE_SCRIPT.format(package=os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, RESULT_CACHE_PATH=os.path.join(directory, "results.sqlite"), SANDBOX_WORKERS="1")
+        runs = [subprocess.run([sys.executable, path], capture_output=True, text=True, timeout=120, env=env)
+                for _ in range(2)]
+    lines = [[line for line in run.stdout.splitlines() if line.startswith(("outputs", "stats"))] for run in runs]
+    outputs = "outputs [[[1], [0]], [[2], [1]], [[3], [2]]]"
+    ok = lines[0] == [outputs, "stats 0 3 3"] and lines[1] == [outputs, "stats 3 0 3"]
+    return ok, f"first={lines[0]}, second={lines[1]}"
+
+
+def main():
+    pool = SandboxPool(workers=2, timeout=1.0, memory_mb=256)
+    checks = [
+        ("正常执行", check_basic),
+        ("类与 getattr", check_full_builtins),
+        ("工作进程复用", check_reuse),
+        ("超时", check_timeout),
+        ("内存上限", check_memory),
+        ("受限的 import / builtins", check_restricted),
+        ("execute_transform_code", check_execute_transform_code),
+        ("训练样本验证", check_verify_train),
+        ("程序去重", check_group_programs),
+        ("执行结果缓存", check_result_cache),
+        ("没有 main 保护的调用脚本", check_unguarded_script),
+        ("执行结果跨进程持久化", check_result_store),
+    ]
+
+    print("=" * 70)
+    print("Testing the PAL code sandbox")
+    print("=" * 70)
+
+    passed = 0
+    failed = 0
+    for name, check in checks:
+        try:
+            ok, detail = check(pool)
+        except Exception as e:
+            ok, detail = False, f"{type(e).__name__}: {e}"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+        print(f"\n[{'PASS' if ok else 'FAIL'}] {name}")
+        print(f"  {detail}")
+    pool.close()
+
+    print("\n" + "=" * 70)
+    print(f"Results: {passed} passed, {failed} failed")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
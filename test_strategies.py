@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+测试策略阶段执行器（strategies.run_strategy）：按依赖分批执行、同一批并发、when 跳过、
+needs 默认依赖上一个阶段、无法满足的依赖报错，以及 V4 的执行结果与回退网格的选择
+"""
+
+import os
+import sys
+import time
+import threading
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from strategies import Stage, Strategy, TaskContext, get_strategy, run_strategy
+
+
+TASK = {"train": [{"input": [[1, 2]], "output": [[2, 1]]}], "test": [{"input": [[3, 4]], "output": [[4, 3]]}]}
+CONFIG = {"model_name": "mock", "temperature": 1.0, "prompt_version": 4, "v4_repair": True}
+
+
+def make_context(replies=()):
+    replies = iter(replies)
+    calls = SimpleNamespace(speak_and_listen=lambda *args, **kwargs: next(replies))
+    return TaskContext(TASK, CONFIG, calls, log=lambda msg="": None)
+
+
+def run_stages(stages, ctx=None, output="predicted"):
+    ctx = ctx or make_context()
+    strategy = Strategy(99, "test", "test strategy", lambda config: stages, output=output)
+    return run_strategy(strategy, ctx), ctx
+
+
+def check_waves():
+    """依赖都完成的阶段组成一批：b、c 只依赖 a，同时运行；d 等 b、c 都完成后才运行"""
+    events = []
+    lock = threading.Lock()
+    both_started = threading.Barrier(2, timeout=2)
+
+    def step(name, wait=False):
+        def run(ctx):
+            with lock:
+                events.append(f"start {name}")
+            if wait:
+                both_started.wait()
+                time.sleep(0.05)
+            with lock:
+                events.append(f"end {name}")
+            return name
+        return run
+
+    stages = [
+        Stage("a", "parse", step("a")),
+        Stage("b", "parse", step("b", wait=True), needs=("a",)),
+        Stage("c", "parse", step("c", wait=True), needs=("a",)),
+        Stage("predicted", "parse", lambda ctx: [ctx["b"], ctx["c"]], needs=("b", "c")),
+    ]
+    result, _ = run_stages(stages)
+    overlapped = events.index("start c") < events.index("end b") and events.index("start b") < events.index("end c")
+    ok = events[:2] == ["start a", "end a"] and overlapped and result == ["b", "c"]
+    return ok, f"{events}, result={result}"
+
+
+def check_when_skipped():
+    """when 为假的阶段不运行，结果为 None，依赖它的阶段照常运行"""
+    ran = []
+
+    def skipped(ctx):
+        ran.append("skipped")
+        return "never"
+
+    stages = [
+        Stage("reply", "parse", lambda ctx: None),
+        Stage("code", "parse", skipped, when=lambda ctx: ctx["reply"] is not None),
+        Stage("predicted", "parse", lambda ctx: [[1]] if ctx["code"] is None else [[2]]),
+    ]
+    result, ctx = run_stages(stages)
+    ok = ran == [] and ctx.values["code"] is None and result == [[1]]
+    return ok, f"ran={ran}, code={ctx.values['code']}, result={result}"
+
+
+def check_default_needs():
+    """没有声明 needs 的阶段依赖上一个阶段（按声明顺序执行）；needs=() 表示没有依赖，在第一批运行"""
+    order = []
+    lock = threading.Lock()
+
+    def step(name):
+        def run(ctx):
+            with lock:
+                order.append(name)
+            return name
+        return run
+
+    stages = [
+        Stage("first", "parse", step("first")),
+        Stage("second", "parse", step("second")),
+        Stage("third", "parse", step("third")),
+        Stage("independent", "parse", step("independent"), needs=()),
+        Stage("predicted", "parse", lambda ctx: [[len(order)]], needs=("third", "independent")),
+    ]
+    result, _ = run_stages(stages)
+    ok = (order.index("first") < order.index("second") < order.index("third")
+          and order.index("independent") < order.index("second") and result == [[4]])
+    return ok, f"order={order}"
+
+
+def check_unsatisfiable():
+    """依赖不存在的阶段时抛出 ValueError，并列出无法执行的阶段"""
+    stages = [
+        Stage("reply", "parse", lambda ctx: "text"),
+        Stage("predicted", "parse", lambda ctx: [[1]], needs=("missing",)),
+    ]
+    try:
+        result, _ = run_stages(stages)
+    except ValueError as e:
+        return "unsatisfiable" in str(e) and "predicted" in str(e), str(e)
+    return False, f"no error, got {result}"
+
+
+def check_missing_output():
+    """输出阶段被跳过时返回空列表"""
+    stages = [Stage("predicted", "parse", lambda ctx: [[1]], when=lambda ctx: False)]
+    result, _ = run_stages(stages)
+    return result == [], f"{result}"
+
+
+def check_v4_unverified_output():
+    """V4：两个程序都没通过训练样本验证时，仍然用最后一版程序的执行结果，而不是回答中随便一个网格"""
+    first = "Example: [[1, 2]] -> [[2, 1]]\n```python\ndef transform(grid):\n    return grid\n```"
+    repaired = "```python\ndef transform(grid):\n    return [[0]]\n```\n[[9, 9]]"
+    ctx = make_context([first, repaired])
+    result = run_strategy(get_strategy(4), ctx)
+    ok = result == [[0]] and ctx["verified"] and ctx["repair_verified"] and len(ctx.replies) == 2
+    return ok, f"result={result}, replies={len(ctx.replies)}"
+
+
+def check_v4_repair_fallback():
+    """V4：程序执行没有结果时才直接解析回答，有修复回答时解析修复回答，而不是第一次回答"""
+    first = "```python\ndef transform(grid):\n    return grid\n```\nOUTPUT: [[3, 4]]"
+    repaired = "```python\ndef transform(grid):\n    raise ValueError\n```\nOUTPUT: [[4, 3]]"
+    ctx = make_context([first, repaired])
+    result = run_strategy(get_strategy(4), ctx)
+    ok = result == [[4, 3]] and ctx["executed"] is None and len(ctx.replies) == 2
+    return ok, f"result={result}, executed={ctx['executed']}"
+
+
+def main():
+    checks = [
+        ("按依赖分批并发执行", check_waves),
+        ("when 跳过阶段", check_when_skipped),
+        ("needs 默认依赖上一个阶段", check_default_needs),
+        ("无法满足的依赖", check_unsatisfiable),
+        ("输出阶段被跳过", check_missing_output),
+        ("V4 未通过验证的程序仍用执行结果", check_v4_unverified_output),
+        ("V4 修复回答的回退网格", check_v4_repair_fallback),
+    ]
+
+    print("=" * 70)
+    print("Testing the strategy stage executor")
+    print("=" * 70)
+
+    passed = 0
+    failed = 0
+    for name, check in checks:
+        try:
+            ok, detail = check()
+        except Exception as e:
+            ok, detail = False, f"{type(e).__name__}: {e}"
+        if ok:
+            passed += 1
+        else:
+            failed += 1
+        print(f"\n[{'PASS' if ok else 'FAIL'}] {name}")
+        print(f"  {detail}")
+
+    print("\n" + "=" * 70)
+    print(f"Results: {passed} passed, {failed} failed")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
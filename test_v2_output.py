@@ -7,12 +7,11 @@ import os
 import json
 import sys
 from dotenv import load_dotenv
-from openai import OpenAI
-from httpx import Timeout
 
 sys.path.insert(0, os.path.dirname(__file__))
 from prompt import construct_prompt
 from template import parse_output
+from llm_client import get_client, get_api_config
 
 load_dotenv()
 
@@ -28,13 +27,12 @@ print("V2 Prompt 测试 - 第一个任务")
 print("=" * 60)
 
 # 调用 API
-api_key = os.getenv("DEEPSEEK_API_KEY")
-base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-timeout = int(os.getenv("API_TIMEOUT_SECONDS", "60"))
-max_tokens = int(os.getenv("API_MAX_TOKENS", "1000"))
+api_config = get_api_config()
+timeout = api_config["timeout"]
+max_tokens = api_config["max_tokens"]
 
 try:
-    client = OpenAI(api_key=api_key, base_url=base_url, timeout=Timeout(timeout))
+    client = get_client()
     
     print(f"调用 API...")
     print(f"  超时: {timeout}s")